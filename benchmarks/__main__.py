@@ -0,0 +1,105 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import platform
+import sys
+
+import mips_assembler
+from benchmarks.cases import PHASES, run_case
+from benchmarks.generators import GENERATORS
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+# Added by --large, the scale of the biggest generated programs. A 10M-line case needs about 2 GB of memory and a
+# couple of minutes per run.
+LARGE_SIZES = (1000000, 10000000)
+
+
+def run_benchmarks(generators, sizes, repeat=3, seed=0, trace_memory=False):
+    # Every case runs in a freshly started process, the peak RSS is that of the whole process so it would
+    # otherwise carry over from the largest case run before
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in generators:
+        for lines in sizes:
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(run_case, name, lines, repeat, seed, trace_memory).result()
+            results.append(result)
+            print("{:<24}{:>10} lines  ".format(name, lines)
+                  + "  ".join("{} {:.0f} lines/s".format(phase, result["phases"][phase]["lines_per_second"] or 0)
+                              for phase in PHASES), file=sys.stderr)
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "numpy": mips_assembler.numpy is not None,
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, threshold, min_seconds=0.001):
+    # Returns a description of every phase that got slower than the baseline by more than threshold.
+    # Phases faster than min_seconds in both runs are too noisy to compare and are skipped.
+    baseline_results = {(result["generator"], result["lines"]): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        previous = baseline_results.get((result["generator"], result["lines"]))
+        if previous is None:
+            continue
+        for phase in PHASES:
+            seconds = result["phases"][phase]["seconds"]
+            previous_seconds = previous["phases"][phase]["seconds"]
+            if max(seconds, previous_seconds) < min_seconds:
+                continue
+            if previous_seconds > 0 and seconds > previous_seconds * (1 + threshold):
+                regressions.append("{} {} lines {}: {:.4f}s -> {:.4f}s ({:+.1%})".format(
+                    result["generator"], result["lines"], phase, previous_seconds, seconds,
+                    seconds / previous_seconds - 1))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Time the parse, layout and encode phases of the assembler")
+    parser.add_argument("--generator", action="append", choices=sorted(GENERATORS),
+                        help="program generator to run, may be repeated (default: all)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="source sizes in lines (default: {})".format(" ".join(map(str, DEFAULT_SIZES))))
+    parser.add_argument("--large", action="store_true",
+                        help="also run the {} line sizes".format(" and ".join(map(str, LARGE_SIZES))))
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest one is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracemalloc", action="store_true", help="also record the peak traced memory per phase")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative slowdown against the baseline that counts as a regression (default: 0.10)")
+    parser.add_argument("--min-seconds", type=float, default=0.001,
+                        help="phases faster than this in both reports are not compared (default: 0.001)")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes + [size for size in LARGE_SIZES if args.large and size not in args.sizes]
+    report = run_benchmarks(args.generator or sorted(GENERATORS), sizes, args.repeat, args.seed,
+                            args.tracemalloc)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.threshold, args.min_seconds)
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
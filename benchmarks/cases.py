@@ -0,0 +1,91 @@
+import gc
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import mips_assembler
+from benchmarks.generators import GENERATORS
+
+PHASES = ("add", "get_labels", "compile")
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_phases(code):
+    timings = {}
+
+    start = time.perf_counter()
+    assembler = mips_assembler.MipsAssembler()
+    assembler.add(code)
+    timings["add"] = time.perf_counter() - start
+
+    sections = list(assembler._sections.values())
+    start = time.perf_counter()
+    labels = {}
+    for section in sections:
+        section.get_labels(labels)
+    timings["get_labels"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for section in sections:
+        section.compile(labels)
+    timings["compile"] = time.perf_counter() - start
+
+    return timings
+
+
+def _measure_memory(code):
+    # A separate run because tracing allocations slows every phase down considerably
+    peaks = {}
+    tracemalloc.start()
+    try:
+        assembler = mips_assembler.MipsAssembler()
+        assembler.add(code)
+        peaks["add"] = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        labels = {}
+        for section in assembler._sections.values():
+            section.get_labels(labels)
+        peaks["get_labels"] = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        for section in assembler._sections.values():
+            section.compile(labels)
+        peaks["compile"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def run_case(name, lines, repeat, seed, trace_memory):
+    code = "\n".join(GENERATORS[name](lines, seed=seed))
+
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        timings = _run_phases(code)
+        if best is None:
+            best = timings
+        else:
+            best = {phase: min(best[phase], timings[phase]) for phase in PHASES}
+
+    result = {
+        "generator": name,
+        "lines": lines,
+        "phases": {phase: {"seconds": best[phase],
+                           "lines_per_second": lines / best[phase] if best[phase] > 0 else None}
+                   for phase in PHASES},
+        "peak_rss_kb": _peak_rss_kb(),
+    }
+    if trace_memory:
+        result["tracemalloc_peak_bytes"] = _measure_memory(code)
+    return result
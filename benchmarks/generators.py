@@ -0,0 +1,103 @@
+import random
+
+_REGISTERS = ["$zero", "$at", "$v0", "$v1", "$a0", "$a1", "$a2", "$a3", "$t0", "$t1", "$t2", "$t3", "$t4", "$t5",
+              "$t6", "$t7", "$s0", "$s1", "$s2", "$s3", "$s4", "$s5", "$s6", "$s7", "$t8", "$t9", "$gp", "$sp",
+              "$fp", "$ra"]
+
+_R_TYPES = ["add", "addu", "sub", "subu", "and", "or", "xor", "nor", "slt", "sltu", "mul", "sllv", "srlv", "srav"]
+_SHIFTS = ["sll", "srl", "sra"]
+_I_TYPES = ["addi", "addiu", "slti", "sltiu", "andi", "ori", "xori"]
+_MEMORY = ["lb", "lh", "lw", "lbu", "lhu", "sb", "sh", "sw"]
+_BRANCHES = ["beq", "bne"]
+_HI_LO = ["mult", "multu", "div", "divu", "madd", "msub"]
+
+
+def _register(rng):
+    return rng.choice(_REGISTERS)
+
+
+def _instruction(rng, immediate):
+    kind = rng.randrange(10)
+    if kind < 3:
+        return "{} {}, {}, {}".format(rng.choice(_R_TYPES), _register(rng), _register(rng), _register(rng))
+    if kind < 4:
+        return "{} {}, {}, {}".format(rng.choice(_SHIFTS), _register(rng), _register(rng), rng.randrange(32))
+    if kind < 6:
+        return "{} {}, {}, {}".format(rng.choice(_I_TYPES), _register(rng), _register(rng), immediate())
+    if kind < 8:
+        return "{} {}, {}({})".format(rng.choice(_MEMORY), _register(rng), immediate(), _register(rng))
+    if kind < 9:
+        return "{} {}, {}, {}".format(rng.choice(_BRANCHES), _register(rng), _register(rng), immediate())
+    return "{} {}, {}".format(rng.choice(_HI_LO), _register(rng), _register(rng))
+
+
+def instruction_mix(lines, seed=0):
+    # Straight-line code over a realistic mix of instruction formats with constant operands only
+    rng = random.Random(seed)
+    immediate = lambda: str(rng.randrange(0x8000))
+    for _ in range(lines):
+        yield "    " + _instruction(rng, immediate)
+
+
+def labels_and_expressions(lines, seed=0):
+    # A label every few lines and operands that are expressions over earlier and later labels
+    rng = random.Random(seed)
+    label_count = max(1, lines // 4)
+    immediate = lambda: "label_{} + {} * 4 - {}".format(rng.randrange(label_count), rng.randrange(16),
+                                                        rng.randrange(4))
+    defined = 0
+    for line in range(lines):
+        if line % 4 == 0 and defined < label_count:
+            yield "label_{}:".format(defined)
+            defined += 1
+        elif rng.randrange(8) == 0:
+            yield "    j label_{}".format(rng.randrange(label_count))
+        else:
+            yield "    " + _instruction(rng, immediate)
+    while defined < label_count:
+        yield "label_{}:".format(defined)
+        defined += 1
+
+
+def many_sections(lines, seed=0, sections=64):
+    # Frequent switches between many sections, each defining labels used from the others
+    rng = random.Random(seed)
+    names = [".text.unit{}".format(index) for index in range(sections)]
+    label_count = max(1, lines // 32)
+    immediate = lambda: "entry_{}".format(rng.randrange(label_count))
+    defined = 0
+    for line in range(lines):
+        if line % 16 == 0:
+            yield "    .section {}".format(rng.choice(names))
+        elif line % 32 == 1 and defined < label_count:
+            yield "entry_{}:".format(defined)
+            defined += 1
+        else:
+            yield "    " + _instruction(rng, immediate)
+    while defined < label_count:
+        yield "entry_{}:".format(defined)
+        defined += 1
+
+
+def long_comments(lines, seed=0, comment_length=160):
+    # Compiler output style code where most lines carry a long trailing or full line comment
+    rng = random.Random(seed)
+    immediate = lambda: str(rng.randrange(0x8000))
+    words = ["spill", "reload", "\"quoted # text\"", "loop", "header", "preheader", "phi", "live-in", "%vreg12"]
+    for _ in range(lines):
+        comment = []
+        while sum(len(word) + 1 for word in comment) < comment_length:
+            comment.append(rng.choice(words))
+        comment = " ".join(comment)
+        if rng.randrange(4) == 0:
+            yield "    # " + comment
+        else:
+            yield "    {:<32}# {}".format(_instruction(rng, immediate), comment)
+
+
+GENERATORS = {
+    "instruction_mix": instruction_mix,
+    "labels_and_expressions": labels_and_expressions,
+    "many_sections": many_sections,
+    "long_comments": long_comments,
+}
@@ -1,4 +1,32 @@
+import array
+import bisect
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import io
+import json
+import itertools
+import mmap
+import os
+import operator
+import pickle
 import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_WORD = struct.Struct(">I")
+_HALF_WORD = struct.Struct(">H")
 
 
 class MipsCompileError(Exception):
@@ -6,440 +34,773 @@ class MipsCompileError(Exception):
 
 
 class MipsParsingError(Exception):
-    current_parsed_line = None
+    # The location of the error is filled in by the assembler as the error passes through it. line_number and
+    # column count from 1 and are None when they aren't known.
+    def __init__(self, message, line=None, line_number=None, column=None):
+        self.message = message
+        self.line = line
+        self.line_number = line_number
+        self.column = column
+        super().__init__(self._format())
+
+    def _format(self):
+        if self.line is None:
+            return self.message
+        message = "{}\nCurrent line: <{}>".format(self.message, self.line)
+        if self.line_number is not None:
+            message += " (line {}".format(self.line_number)
+            if self.column is not None:
+                message += ", column {}".format(self.column)
+            message += ")"
+        return message
+
+    def set_location(self, line=None, line_number=None, column=None):
+        # Only fills in what isn't known yet, so the innermost caller that knows a detail wins
+        if self.line is None:
+            self.line = line
+        if self.line_number is None:
+            self.line_number = line_number
+        if self.column is None:
+            self.column = column
+        self.args = (self._format(),)
+
+    def __reduce__(self):
+        return type(self), (self.message, self.line, self.line_number, self.column)
+
+
+_REGISTERS = {}
+for _register_id, _register_names in enumerate((
+        ("$zero", "$0"), ("$at", "$1"), ("$v0", "$2"), ("$v1", "$3"),
+        ("$a0", "$4"), ("$a1", "$5"), ("$a2", "$6"), ("$a3", "$7"),
+        ("$t0", "$8"), ("$t1", "$9"), ("$t2", "$10"), ("$t3", "$11"),
+        ("$t4", "$12"), ("$t5", "$13"), ("$t6", "$14"), ("$t7", "$15"),
+        ("$s0", "$16"), ("$s1", "$17"), ("$s2", "$18"), ("$s3", "$19"),
+        ("$s4", "$20"), ("$s5", "$21"), ("$s6", "$22"), ("$s7", "$23"),
+        ("$t8", "$24"), ("$t9", "$25"), ("$k0", "$26"), ("$k1", "$27"),
+        ("$gp", "$28"), ("$sp", "$29"), ("$fp", "$30", "$s8"), ("$ra", "$31"))):
+    for _register_name in _register_names:
+        _REGISTERS[_register_name] = _register_id
+del _register_id, _register_names, _register_name
+
+# Canonical name of every register, the first name the assembler accepts for it
+_REGISTER_NAMES = [None] * 32
+for _register_name, _register_id in _REGISTERS.items():
+    if _REGISTER_NAMES[_register_id] is None:
+        _REGISTER_NAMES[_register_id] = _register_name
+del _register_name, _register_id
+
+
+def _get_register_id(register):
+    register = register.strip()
+    try:
+        return _REGISTERS[register]
+    except KeyError:
+        raise MipsParsingError("The value '{}' is not a valid register".format(register))
+
+
+_EXPRESSION_TOKEN = re.compile(r"\s*(?:(?P<number>[0-9]+\.?[0-9]*|\.[0-9]+)|(?P<label>[A-Za-z_][A-Za-z0-9_]*)"
+                               r"|(?P<operator>\*\*|//|[-+*/^()]))")
+_EXPRESSION_TRAILING_SPACE = re.compile(r"\s*$")
+
+# No field needs more bits than this. A power known to be wider is rejected before it is computed, so that an
+# expression such as 9**9**9 can not keep the parser or the linker busy.
+_MAX_POWER_BITS = 64
+
+
+def _power(base, exponent):
+    if isinstance(base, int) and isinstance(exponent, int) \
+            and exponent * (abs(base).bit_length() - 1) > _MAX_POWER_BITS:
+        raise OverflowError("The power {} ** {} is out of range".format(base, exponent))
+    return base ** exponent
+
+
+_BINARY_OPERATORS = {
+    "^": operator.xor,
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+    "//": operator.floordiv,
+    "**": _power,
+}
+
+
+# An immediate, shift amount or jump target expression compiled once into a tree of closures.
+# The grammar is the arithmetic the assembler has always accepted (numbers, labels and the ^ + - * / // ** operators
+# with Python's precedence and semantics) plus parentheses. Expressions without labels are folded to a constant.
+class _MipsExpression(object):
+
+    __slots__ = ("_expression", "_labels", "_evaluate", "_constant", "_tokens", "_position")
+
+    def __init__(self, expression):
+        self._expression = expression
+        self._labels = set()
+        self._tokens = self._tokenize(expression)
+        self._position = 0
+        if len(self._tokens) == 0:
+            raise MipsParsingError("Found illegal characters in the '{}' expression".format(expression))
 
-    def __init__(self, message):
-        message += "\nCurrent line: <{}>".format(MipsParsingError.current_parsed_line)
-        super().__init__(message)
+        self._evaluate = self._parse_xor()
+        if self._position != len(self._tokens):
+            raise MipsParsingError("Failed to calculate the '{}' expression".format(expression))
+        self._labels = frozenset(self._labels)
+        self._tokens = None
 
+        self._constant = None
+        if len(self._labels) == 0:
+            try:
+                self._constant = int(self._evaluate(None))
+            except (ArithmeticError, TypeError, ValueError):
+                raise MipsParsingError("Failed to calculate the '{}' expression".format(expression))
 
-class _MipsAssembly(object):
+    def __reduce__(self):
+        return _compile_expression, (self._expression,)
 
-    def __init__(self, assembly):
-        self._original_assembly = assembly
-        self._parse_instruction(assembly)
+    @staticmethod
+    def _tokenize(expression):
+        tokens = []
+        position = 0
+        previous_number_end = -1
+        while True:
+            match = _EXPRESSION_TOKEN.match(expression, position)
+            if match is None:
+                if _EXPRESSION_TRAILING_SPACE.match(expression, position) is None:
+                    raise MipsParsingError("Found illegal characters in the '{}' expression".format(expression))
+                return tokens
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == "label" and match.start(kind) == previous_number_end:
+                raise MipsParsingError("Label '{}' is not allowed to be prefixed with a number".format(value))
+            previous_number_end = match.end() if kind == "number" else -1
+            tokens.append((kind, value))
+            position = match.end()
+
+    def _peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position]
+        return None, None
+
+    def _accept(self, *operators):
+        kind, value = self._peek()
+        if kind == "operator" and value in operators:
+            self._position += 1
+            return value
+        return None
+
+    def _parse_binary(self, parse_operand, *operators):
+        left = parse_operand()
+        while True:
+            symbol = self._accept(*operators)
+            if symbol is None:
+                return left
+            left = self._binary(_BINARY_OPERATORS[symbol], left, parse_operand())
+
+    def _parse_xor(self):
+        return self._parse_binary(self._parse_sum, "^")
+
+    def _parse_sum(self):
+        return self._parse_binary(self._parse_term, "+", "-")
+
+    def _parse_term(self):
+        return self._parse_binary(self._parse_unary, "*", "/", "//")
+
+    def _parse_unary(self):
+        symbol = self._accept("+", "-")
+        if symbol is None:
+            return self._parse_power()
+        operand = self._parse_unary()
+        if symbol == "-":
+            return lambda labels: -operand(labels)
+        return lambda labels: +operand(labels)
+
+    def _parse_power(self):
+        base = self._parse_atom()
+        if self._accept("**") is None:
+            return base
+        return self._binary(_power, base, self._parse_unary())
+
+    def _parse_atom(self):
+        kind, value = self._peek()
+        self._position += 1
+        if kind == "number":
+            number = float(value) if "." in value else int(value)
+            return lambda labels: number
+        if kind == "label":
+            self._labels.add(value)
+            return lambda labels: labels[value]
+        if kind == "operator" and value == "(":
+            inner = self._parse_xor()
+            if self._accept(")") is not None:
+                return inner
+        raise MipsParsingError("Failed to calculate the '{}' expression".format(self._expression))
 
-    def _parse_instruction(self, assembly):
-        parts = assembly.split(maxsplit=1)
-        self._instruction = parts[0]
-        if len(parts) > 1:
-            arguments = parts[1]
-        else:
-            arguments = ""
-
-        # ---------- J Types ----------
-
-        if self._instruction == "j":
-            self._parse_arguments(arguments, instruction_type="J", argument_format_string="j", opcode=0x2)
-        elif self._instruction == "jal":
-            self._parse_arguments(arguments, instruction_type="J", argument_format_string="j", opcode=0x3)
-
-        # ---------- I Types ----------
-
-        elif self._instruction == "beq":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="sti", opcode=0x4)
-        elif self._instruction == "bne":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="sti", opcode=0x5)
-        elif self._instruction == "blez":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si", opcode=0x6)
-        elif self._instruction == "bgtz":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si", opcode=0x7)
-        elif self._instruction == "addi":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="(ts)i,tsi", opcode=0x8)
-        elif self._instruction == "addiu":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="(ts)i,tsi", opcode=0x9)
-        elif self._instruction == "slti":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="(ts)i,tsi", opcode=0xA)
-        elif self._instruction == "sltiu":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="(ts)i,tsi", opcode=0xB)
-        elif self._instruction == "andi":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="(ts)i,tsi", opcode=0xC)
-        elif self._instruction == "ori":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="(ts)i,tsi", opcode=0xD)
-        elif self._instruction == "xori":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="(ts)i,tsi", opcode=0xE)
-        elif self._instruction == "lui":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="ti", opcode=0xF)
-        elif self._instruction == "lb":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x20)
-        elif self._instruction == "lh":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x21)
-        elif self._instruction == "lwl":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x22)
-        elif self._instruction == "lw":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x23)
-        elif self._instruction == "lbu":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x24)
-        elif self._instruction == "lhu":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x25)
-        elif self._instruction == "lwr":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x26)
-        elif self._instruction == "sb":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x28)
-        elif self._instruction == "sh":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x29)
-        elif self._instruction == "swl":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x2a)
-        elif self._instruction == "sw":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x2b)
-        elif self._instruction == "swr":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="*tis", opcode=0x2e)
-
-        # -------- Opcode 0x1 Extension --------
-
-        elif self._instruction == "bltz":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$0")
-        elif self._instruction == "bgez":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$1")
-        elif self._instruction == "tgei":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$8")
-        elif self._instruction == "tgeiu":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$9")
-        elif self._instruction == "tlti":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$10")
-        elif self._instruction == "tltiu":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$11")
-        elif self._instruction == "teqi":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$12")
-        elif self._instruction == "tnei":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$14")
-        elif self._instruction == "bltzal":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$16")
-        elif self._instruction == "bgezal":
-            self._parse_arguments(arguments, instruction_type="I", argument_format_string="si",
-                                  opcode=0x1, rt="$17")
-
-        # ---------- R Types ----------
-
-        elif self._instruction == "sll":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(dt)a,dta", funct=0x0)
-        elif self._instruction == "srl":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(dt)a,dta", funct=0x2)
-        elif self._instruction == "sra":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(dt)a,dta", funct=0x3)
-        elif self._instruction == "sllv":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(dt)s,dts", funct=0x4)
-        elif self._instruction == "srav":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(dt)s,dts", funct=0x6)
-        elif self._instruction == "srlv":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(dt)s,dts", funct=0x7)
-        elif self._instruction == "jr":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="s", funct=0x8)
-        elif self._instruction == "jalr":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="s,sd", funct=0x9, rd="$ra")
-        elif self._instruction == "mult":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x18)
-        elif self._instruction == "multu":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x19)
-        elif self._instruction == "div":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x1A)
-        elif self._instruction == "divu":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x1B)
-        elif self._instruction == "add":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x20)
-        elif self._instruction == "addu":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x21)
-        elif self._instruction == "sub":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x22)
-        elif self._instruction == "subu":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x23)
-        elif self._instruction == "and":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x24)
-        elif self._instruction == "or":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x25)
-        elif self._instruction == "xor":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x26)
-        elif self._instruction == "nor":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x27)
-        elif self._instruction == "slt":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x2A)
-        elif self._instruction == "sltu":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst", funct=0x2B)
-        elif self._instruction == "tge":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x30)
-        elif self._instruction == "tgeu":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x31)
-        elif self._instruction == "tlt":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x32)
-        elif self._instruction == "tltu":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x33)
-        elif self._instruction == "teq":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x34)
-        elif self._instruction == "tne":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st", funct=0x36)
-
-        # -------- Opcode 0x1C Extension --------
-
-        elif self._instruction == "madd":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st",
-                                  opcode=0x1C, funct=0x0)
-        elif self._instruction == "maddu":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st",
-                                  opcode=0x1C, funct=0x1)
-        elif self._instruction == "mul":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst",
-                                  opcode=0x1C, funct=0x2)
-        elif self._instruction == "msub":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st",
-                                  opcode=0x1C, funct=0x4)
-        elif self._instruction == "msubu":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="st",
-                                  opcode=0x1C, funct=0x5)
-        elif self._instruction == "clz":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst",
-                                  opcode=0x1C, funct=0x20)
-        elif self._instruction == "clo":
-            self._parse_arguments(arguments, instruction_type="R", argument_format_string="(ds)t,dst",
-                                  opcode=0x1C, funct=0x21)
+    @staticmethod
+    def _binary(function, left, right):
+        return lambda labels: function(left(labels), right(labels))
 
-        else:
-            raise MipsParsingError("The '{}' instruction is not valid or is not yet supported by this assembler"
-                                   .format(self._instruction))
+    def get_expression(self):
+        return self._expression
 
-    def _parse_arguments(self, arguments, instruction_type, argument_format_string, opcode=0, funct=0,
-                         rs="$0", rt="$0", rd="$0", sa="0", immediate="0", jump_target="0"):
+    def get_labels(self):
+        return self._labels
 
-        self._instruction_type = instruction_type
-        self._opcode = opcode
-        self._funct = funct
+    def is_constant(self):
+        return self._constant is not None
 
-        # Set default values
-        self._rs = rs
-        self._rt = rt
-        self._rd = rd
-        self._sa = sa
-        self._immediate = immediate
-        self._jump_target = jump_target
+    def evaluate(self, labels):
+        if self._constant is not None:
+            return self._constant
+
+        for label in self._labels:
+            if label not in labels:
+                raise MipsCompileError("The label '{}' is undefined".format(label))
+        try:
+            return int(self._evaluate(labels))
+        except (ArithmeticError, TypeError, ValueError):
+            raise MipsCompileError("Failed to calculate the '{}' expression".format(self._expression))
+
+
+@functools.lru_cache(maxsize=65536)
+def _compile_expression(expression):
+    return _MipsExpression(expression)
+
+
+_ZERO_EXPRESSION = _compile_expression("0")
+
+
+# Maps an argument format character to the attribute it fills and whether the argument is a register
+_ARGUMENT_FIELDS = {
+    "s": ("_rs", True),
+    "t": ("_rt", True),
+    "d": ("_rd", True),
+    "a": ("_sa", False),
+    "i": ("_immediate", False),
+    "j": ("_jump_target", False),
+}
+
+
+# Everything needed to parse and encode one mnemonic, resolved once at import time.
+# The argument format string (e.g. "(ts)i,tsi") is compiled into layouts, which map each accepted argument count
+# to a tuple of slots. Each slot holds the (attribute, is_register) pairs filled by the argument at that position.
+class _InstructionSpec(object):
+
+    def __init__(self, mnemonic, instruction_type, argument_format_string, opcode=0, funct=0,
+                 rs="$0", rt="$0", rd="$0"):
+        self.mnemonic = mnemonic
+        self.instruction_type = instruction_type
+        self.opcode = opcode
+        self.funct = funct
+        self.rs = _REGISTERS[rs]
+        self.rt = _REGISTERS[rt]
+        self.rd = _REGISTERS[rd]
+        self.memory_operand = argument_format_string.startswith("*")
+        self.argument_counts, self.layouts = self._compile_layouts(argument_format_string.replace("*", ""))
+        self.reads, self.writes, self.implicit_writes = self._get_register_roles(mnemonic, instruction_type, opcode,
+                                                                                 funct)
+        self.has_delay_slot = (instruction_type == "J" or opcode in (0x4, 0x5, 0x6, 0x7)
+                               or (opcode == 0x1 and mnemonic.startswith("b"))
+                               or (opcode == 0x0 and funct in (0x8, 0x9)))
+        self.traps = mnemonic.startswith("t")
+
+    def __reduce__(self):
+        # Parsed instructions sent between processes refer to the table entry instead of carrying a copy of it
+        return _get_instruction_spec, (self.mnemonic,)
+
+    @staticmethod
+    def _get_register_roles(mnemonic, instruction_type, opcode, funct):
+        # The register fields the instruction reads and writes, and the registers it writes without naming them.
+        # HI and LO are written as register 32.
+        if instruction_type == "J":
+            return (), (), (31,) if mnemonic == "jal" else ()
+        if instruction_type == "I":
+            if opcode == 0x1:
+                # The rt field of REGIMM instructions selects the operation
+                return ("_rs",), (), (31,) if mnemonic.endswith("al") else ()
+            if opcode in (0x4, 0x5, 0x6, 0x7) or opcode >= 0x28:
+                return ("_rs", "_rt"), (), ()
+            if mnemonic in ("lwl", "lwr"):
+                return ("_rs", "_rt"), ("_rt",), ()
+            return ("_rs",), ("_rt",), ()
+        if opcode == 0x0 and funct == 0x8:
+            return ("_rs",), (), ()
+        if opcode == 0x0 and funct == 0x9:
+            return ("_rs",), ("_rd",), ()
+        if mnemonic in ("mult", "multu", "div", "divu", "madd", "maddu", "msub", "msubu"):
+            return ("_rs", "_rt"), (), (32,)
+        if mnemonic.startswith("t"):
+            return ("_rs", "_rt"), (), ()
+        if mnemonic in ("sll", "srl", "sra"):
+            return ("_rt",), ("_rd",), ()
+        return ("_rs", "_rt"), ("_rd",), ()
+
+    @staticmethod
+    def _compile_layouts(argument_format_string):
+        argument_counts = []
+        layouts = {}
+        for argument_format in argument_format_string.split(","):
+            slots = []
+            group = None
+            for char in argument_format:
+                if char == "(" and group is None:
+                    group = []
+                elif char == ")" and group is not None:
+                    slots.append(tuple(group))
+                    group = None
+                elif group is not None:
+                    group.append(_ARGUMENT_FIELDS[char])
+                else:
+                    slots.append((_ARGUMENT_FIELDS[char],))
+            argument_counts.append(len(slots))
+            layouts.setdefault(len(slots), tuple(slots))
+        return tuple(argument_counts), layouts
+
+
+_INSTRUCTIONS = {}
+
+
+def _get_instruction_spec(mnemonic):
+    return _INSTRUCTIONS[mnemonic]
+
+
+def _define_instruction(mnemonic, instruction_type, argument_format_string, **fields):
+    _INSTRUCTIONS[mnemonic] = _InstructionSpec(mnemonic, instruction_type, argument_format_string, **fields)
+
+
+# ---------- J Types ----------
+
+_define_instruction("j", "J", "j", opcode=0x2)
+_define_instruction("jal", "J", "j", opcode=0x3)
+
+# ---------- I Types ----------
+
+_define_instruction("beq", "I", "sti", opcode=0x4)
+_define_instruction("bne", "I", "sti", opcode=0x5)
+_define_instruction("blez", "I", "si", opcode=0x6)
+_define_instruction("bgtz", "I", "si", opcode=0x7)
+_define_instruction("addi", "I", "(ts)i,tsi", opcode=0x8)
+_define_instruction("addiu", "I", "(ts)i,tsi", opcode=0x9)
+_define_instruction("slti", "I", "(ts)i,tsi", opcode=0xA)
+_define_instruction("sltiu", "I", "(ts)i,tsi", opcode=0xB)
+_define_instruction("andi", "I", "(ts)i,tsi", opcode=0xC)
+_define_instruction("ori", "I", "(ts)i,tsi", opcode=0xD)
+_define_instruction("xori", "I", "(ts)i,tsi", opcode=0xE)
+_define_instruction("lui", "I", "ti", opcode=0xF)
+_define_instruction("lb", "I", "*tis", opcode=0x20)
+_define_instruction("lh", "I", "*tis", opcode=0x21)
+_define_instruction("lwl", "I", "*tis", opcode=0x22)
+_define_instruction("lw", "I", "*tis", opcode=0x23)
+_define_instruction("lbu", "I", "*tis", opcode=0x24)
+_define_instruction("lhu", "I", "*tis", opcode=0x25)
+_define_instruction("lwr", "I", "*tis", opcode=0x26)
+_define_instruction("sb", "I", "*tis", opcode=0x28)
+_define_instruction("sh", "I", "*tis", opcode=0x29)
+_define_instruction("swl", "I", "*tis", opcode=0x2a)
+_define_instruction("sw", "I", "*tis", opcode=0x2b)
+_define_instruction("swr", "I", "*tis", opcode=0x2e)
+
+# -------- Opcode 0x1 Extension --------
+
+_define_instruction("bltz", "I", "si", opcode=0x1, rt="$0")
+_define_instruction("bgez", "I", "si", opcode=0x1, rt="$1")
+_define_instruction("tgei", "I", "si", opcode=0x1, rt="$8")
+_define_instruction("tgeiu", "I", "si", opcode=0x1, rt="$9")
+_define_instruction("tlti", "I", "si", opcode=0x1, rt="$10")
+_define_instruction("tltiu", "I", "si", opcode=0x1, rt="$11")
+_define_instruction("teqi", "I", "si", opcode=0x1, rt="$12")
+_define_instruction("tnei", "I", "si", opcode=0x1, rt="$14")
+_define_instruction("bltzal", "I", "si", opcode=0x1, rt="$16")
+_define_instruction("bgezal", "I", "si", opcode=0x1, rt="$17")
+
+# ---------- R Types ----------
+
+_define_instruction("sll", "R", "(dt)a,dta", funct=0x0)
+_define_instruction("srl", "R", "(dt)a,dta", funct=0x2)
+_define_instruction("sra", "R", "(dt)a,dta", funct=0x3)
+_define_instruction("sllv", "R", "(dt)s,dts", funct=0x4)
+_define_instruction("srav", "R", "(dt)s,dts", funct=0x6)
+_define_instruction("srlv", "R", "(dt)s,dts", funct=0x7)
+_define_instruction("jr", "R", "s", funct=0x8)
+_define_instruction("jalr", "R", "s,sd", funct=0x9, rd="$ra")
+_define_instruction("mult", "R", "st", funct=0x18)
+_define_instruction("multu", "R", "st", funct=0x19)
+_define_instruction("div", "R", "st", funct=0x1A)
+_define_instruction("divu", "R", "st", funct=0x1B)
+_define_instruction("add", "R", "(ds)t,dst", funct=0x20)
+_define_instruction("addu", "R", "(ds)t,dst", funct=0x21)
+_define_instruction("sub", "R", "(ds)t,dst", funct=0x22)
+_define_instruction("subu", "R", "(ds)t,dst", funct=0x23)
+_define_instruction("and", "R", "(ds)t,dst", funct=0x24)
+_define_instruction("or", "R", "(ds)t,dst", funct=0x25)
+_define_instruction("xor", "R", "(ds)t,dst", funct=0x26)
+_define_instruction("nor", "R", "(ds)t,dst", funct=0x27)
+_define_instruction("slt", "R", "(ds)t,dst", funct=0x2A)
+_define_instruction("sltu", "R", "(ds)t,dst", funct=0x2B)
+_define_instruction("tge", "R", "st", funct=0x30)
+_define_instruction("tgeu", "R", "st", funct=0x31)
+_define_instruction("tlt", "R", "st", funct=0x32)
+_define_instruction("tltu", "R", "st", funct=0x33)
+_define_instruction("teq", "R", "st", funct=0x34)
+_define_instruction("tne", "R", "st", funct=0x36)
+
+# -------- Opcode 0x1C Extension --------
+
+_define_instruction("madd", "R", "st", opcode=0x1C, funct=0x0)
+_define_instruction("maddu", "R", "st", opcode=0x1C, funct=0x1)
+_define_instruction("mul", "R", "(ds)t,dst", opcode=0x1C, funct=0x2)
+_define_instruction("msub", "R", "st", opcode=0x1C, funct=0x4)
+_define_instruction("msubu", "R", "st", opcode=0x1C, funct=0x5)
+_define_instruction("clz", "R", "(ds)t,dst", opcode=0x1C, funct=0x20)
+_define_instruction("clo", "R", "(ds)t,dst", opcode=0x1C, funct=0x21)
+
+
+class _MipsAssembly(object):
+    # Only the resolved fields are kept; the source text is dropped once the line has been parsed
+    __slots__ = ("_spec", "_rs", "_rt", "_rd", "_sa", "_immediate", "_jump_target", "_encoded")
 
-        # Split the argument string into a list of the arguments passed in
-        arguments = self._split_arguments(arguments, argument_format_string)
-        argument_format_string = argument_format_string.replace("*", "")
+    def __init__(self, instruction, arguments, stats=None):
+        self._parse_instruction(instruction, arguments, stats)
+        self._encoded = self._encode()
 
-        # Match the argument format string with the amount of arguments passed in
-        argument_format_string = self._determine_argument_format(len(arguments), argument_format_string)
+    def _parse_instruction(self, instruction, arguments, stats=None):
+        spec = _INSTRUCTIONS.get(instruction)
+        if spec is None:
+            raise MipsParsingError("The '{}' instruction is not valid or is not yet supported by this assembler"
+                                   .format(instruction))
+        self._parse_arguments(arguments, spec, stats)
+
+    def _parse_arguments(self, arguments, spec, stats=None):
+        self._spec = spec
+
+        # Set default values
+        self._rs = spec.rs
+        self._rt = spec.rt
+        self._rd = spec.rd
+        self._sa = _ZERO_EXPRESSION
+        self._immediate = _ZERO_EXPRESSION
+        self._jump_target = _ZERO_EXPRESSION
+
+        # Split the memory operand of loads and stores into its offset and base register
+        arguments = self._split_arguments(arguments, spec)
+
+        # Match the amount of arguments passed in with one of the precompiled layouts
+        layout = spec.layouts.get(len(arguments))
+        if layout is None:
+            raise MipsParsingError("The instruction '{}' accepts {} arguments but was provided {}"
+                                   .format(spec.mnemonic, " or ".join(map(str, spec.argument_counts)),
+                                           len(arguments)))
 
         # Override the default values with the arguments that were passed in
-        self._set_argument_values(arguments, argument_format_string)
-
-        # Turn registers into their numerical equivalent
-        self._rs = self._get_register_id(self._rs)
-        self._rt = self._get_register_id(self._rt)
-        self._rd = self._get_register_id(self._rd)
-
-        # Validate that the supplied equations can be solved once we get all labels
-        self._test_evaluate(self._sa)
-        self._test_evaluate(self._immediate)
-        self._test_evaluate(self._jump_target)
-
-    def _split_arguments(self, arguments, argument_format_string):
-        arguments = arguments.split(",")
-        if argument_format_string.startswith("*"):
-            last_arg = arguments[-1]
+        for argument, slot in zip(arguments, layout):
+            for attribute, is_register in slot:
+                if is_register:
+                    setattr(self, attribute, _get_register_id(argument))
+                elif stats is None:
+                    setattr(self, attribute, _compile_expression(argument.strip()))
+                else:
+                    start = time.perf_counter()
+                    setattr(self, attribute, _compile_expression(argument.strip()))
+                    stats.add_phase("parse_expressions", time.perf_counter() - start)
+
+        if spec.instruction_type == "R":
+            if not self._sa.is_constant():
+                raise MipsParsingError("The shift amount argument does not support labels")
+            if not 0 <= self._sa.evaluate(None) < 32:
+                raise MipsParsingError("The shift amount '{}' is out of range".format(self._sa.get_expression()))
+
+    @staticmethod
+    def _split_arguments(arguments, spec):
+        if spec.memory_operand:
+            arguments = list(arguments)
+            last_arg = arguments[-1] if len(arguments) > 0 else ""
             if "(" in last_arg and last_arg[-1] == ")":
                 last_arg = last_arg.rsplit("(", maxsplit=1)
                 arguments[-1] = last_arg[0]
                 arguments.append(last_arg[1][:-1])
             else:
                 raise MipsParsingError("The '{}' instruction should be in the format '{} $0, 0($0)'"
-                                       .format(self._instruction, self._instruction))
+                                       .format(spec.mnemonic, spec.mnemonic))
         return arguments
 
-    def _determine_argument_format(self, argument_count, argument_format_string):
-        argument_formats = argument_format_string.split(",")
-        argument_counts = []
-        for argument_format in argument_formats:
-            argument_counts.append(0)
-            inside_parenthesis = False
-            for char in argument_format:
-                if char == "(" and not inside_parenthesis:
-                    inside_parenthesis = True
-                    argument_counts[-1] += 1
-                elif char == ")" and inside_parenthesis:
-                    inside_parenthesis = False
-                elif not inside_parenthesis:
-                    argument_counts[-1] += 1
-
-        if argument_count not in argument_counts:
-            raise MipsParsingError("The instruction '{}' accepts {} arguments but was provided {}"
-                                   .format(self._instruction, " or ".join(map(str, argument_counts)), argument_count))
-        argument_index = argument_counts.index(argument_count)
-        return argument_formats[argument_index]
-
-    def _set_argument_values(self, arguments, argument_format_string):
-        inside_parenthesis = False
-        argument_index = 0
-        for char in argument_format_string:
-            if char == "(" and not inside_parenthesis:
-                inside_parenthesis = True
-            elif char == ")" and inside_parenthesis:
-                inside_parenthesis = False
-                argument_index += 1
+    def get_size(self):
+        return 4
+
+    def get_mnemonic(self):
+        return self._spec.mnemonic
+
+    def has_delay_slot(self):
+        return self._spec.has_delay_slot
+
+    def can_fill_delay_slot(self):
+        # Branches can't sit in a delay slot and traps are left where they are written
+        return not self._spec.has_delay_slot and not self._spec.traps
+
+    def get_text(self):
+        # The instruction written out in full, with canonical register names
+        spec = self._spec
+        arguments = []
+        for slot in spec.layouts[max(spec.argument_counts)]:
+            attribute, is_register = slot[0]
+            value = getattr(self, attribute)
+            arguments.append(_REGISTER_NAMES[value] if is_register else value.get_expression())
+        if spec.memory_operand:
+            arguments[-2:] = ["{}({})".format(*arguments[-2:])]
+        return "{} {}".format(spec.mnemonic, ", ".join(arguments)).rstrip()
+
+    def get_destination(self):
+        # The register named as the destination, $zero when there is none
+        spec = self._spec
+        return getattr(self, spec.writes[0]) if len(spec.writes) > 0 else 0
+
+    def get_register_usage(self):
+        # The sets of registers read and written, $zero left out since writing it has no effect
+        spec = self._spec
+        reads = {getattr(self, attribute) for attribute in spec.reads}
+        writes = {getattr(self, attribute) for attribute in spec.writes}
+        writes.update(spec.implicit_writes)
+        reads.discard(0)
+        writes.discard(0)
+        return reads, writes
+
+    def encode(self):
+        # The (opcode, rs, rt, rd, shamt, funct, immediate, relocation) row stored by sections. The immediate holds
+        # the jump target for J types. When the immediate depends on a label it is left as zero and relocation is a
+        # (field, expression) pair to fill it in at link time, otherwise relocation is None.
+        return self._encoded
+
+    def _encode(self):
+        spec = self._spec
+        shamt = 0
+        immediate = 0
+        relocation = None
+        if spec.instruction_type == "R":
+            shamt = self._sa.evaluate(None)
+
+        elif spec.instruction_type == "I":
+            if self._immediate.is_constant():
+                immediate = self._immediate.evaluate(None)
             else:
-                if char == "s":
-                    self._rs = arguments[argument_index]
-                elif char == "t":
-                    self._rt = arguments[argument_index]
-                elif char == "d":
-                    self._rd = arguments[argument_index]
-                elif char == "a":
-                    self._sa = arguments[argument_index]
-                elif char == "i":
-                    self._immediate = arguments[argument_index]
-                elif char == "j":
-                    self._jump_target = arguments[argument_index]
-
-                if not inside_parenthesis:
-                    argument_index += 1
-
-    def _get_register_id(self, register):
-        register = register.strip()
-        if register in ["$zero", "$0"]:
-            register_id = 0
-        elif register in ["$at", "$1"]:
-            register_id = 1
-        elif register in ["$v0", "$2"]:
-            register_id = 2
-        elif register in ["$v1", "$3"]:
-            register_id = 3
-        elif register in ["$a0", "$4"]:
-            register_id = 4
-        elif register in ["$a1", "$5"]:
-            register_id = 5
-        elif register in ["$a2", "$6"]:
-            register_id = 6
-        elif register in ["$a3", "$7"]:
-            register_id = 7
-        elif register in ["$t0", "$8"]:
-            register_id = 8
-        elif register in ["$t1", "$9"]:
-            register_id = 9
-        elif register in ["$t2", "$10"]:
-            register_id = 10
-        elif register in ["$t3", "$11"]:
-            register_id = 11
-        elif register in ["$t4", "$12"]:
-            register_id = 12
-        elif register in ["$t5", "$13"]:
-            register_id = 13
-        elif register in ["$t6", "$14"]:
-            register_id = 14
-        elif register in ["$t7", "$15"]:
-            register_id = 15
-        elif register in ["$s0", "$16"]:
-            register_id = 16
-        elif register in ["$s1", "$17"]:
-            register_id = 17
-        elif register in ["$s2", "$18"]:
-            register_id = 18
-        elif register in ["$s3", "$19"]:
-            register_id = 19
-        elif register in ["$s4", "$20"]:
-            register_id = 20
-        elif register in ["$s5", "$21"]:
-            register_id = 21
-        elif register in ["$s6", "$22"]:
-            register_id = 22
-        elif register in ["$s7", "$23"]:
-            register_id = 23
-        elif register in ["$t8", "$24"]:
-            register_id = 24
-        elif register in ["$t9", "$25"]:
-            register_id = 25
-        elif register in ["$k0", "$26"]:
-            register_id = 26
-        elif register in ["$k1", "$27"]:
-            register_id = 27
-        elif register in ["$gp", "$28"]:
-            register_id = 28
-        elif register in ["$sp", "$29"]:
-            register_id = 29
-        elif register in ["$fp", "$30", "$s8"]:
-            register_id = 30
-        elif register in ["$ra", "$31"]:
-            register_id = 31
-        else:
-            raise MipsParsingError("The value '{}' is not a valid register".format(register))
+                relocation = (_FIELD_IMMEDIATE, self._immediate)
 
-        return register_id
+        elif spec.instruction_type == "J":
+            if self._jump_target.is_constant():
+                immediate = self._jump_target.evaluate(None)
+            else:
+                relocation = (_FIELD_JUMP_TARGET, self._jump_target)
 
-    def _test_evaluate(self, expression):
-        # Replace labels with 0 for the test
-        while True:
-            match = re.search("[A-Za-z_][A-Za-z0-9_]*", expression)
-            if match is None:
-                break
-            if self._instruction_type == "R":
-                raise MipsParsingError("The shift amount argument does not support labels")
-            if match.start() != 0 and ord("0") <= ord(expression[match.start() - 1]) <= ord("9"):
-                raise MipsParsingError("Label '{}' is not allowed to be prefixed with a number".format(match.group()))
-            expression = expression.replace(match.group(), "0", 1)
+        return spec.opcode, self._rs, self._rt, self._rd, shamt, spec.funct, immediate, relocation
 
-        # Validate that only math related characters are in the expression
-        # eval() has potential security implications so this lessens the chance eval can cause harm
-        match = re.match("^[0-9+\-/*^. ]+$", expression)
-        if match is None:
-            raise MipsParsingError("Found illegal characters in the '{}' expression".format(expression))
 
-        # Attempt to calculate the result
-        try:
-            int(eval(expression))
-        except:
-            raise MipsParsingError("Failed to calculate the '{}' expression".format(expression))
+def _plan_load_immediate(value, full=False):
+    # The shortest sequence loading value into a register, or the full lui and ori pair, as (mnemonic, whether rs is
+    # the loaded register, immediate) entries
+    if not -0x80000000 <= value <= 0xFFFFFFFF:
+        raise MipsCompileError("The value {} doesn't fit in 32 bits".format(value))
+    if full:
+        return [("lui", False, (value >> 16) & 0xFFFF), ("ori", True, value & 0xFFFF)]
+    if -0x8000 <= value < 0x8000:
+        return [("addiu", False, value)]
+    if 0 <= value < 0x10000:
+        return [("ori", False, value)]
+    if value & 0xFFFF == 0:
+        return [("lui", False, (value >> 16) & 0xFFFF)]
+    return [("lui", False, (value >> 16) & 0xFFFF), ("ori", True, value & 0xFFFF)]
 
-    def compile(self, labels):
-        compiled = 0
-        if self._instruction_type == "R":
-            shamt = eval(self._sa)
-            compiled += self._opcode << 26
-            compiled += self._rs << 21
-            compiled += self._rt << 16
-            compiled += self._rd << 11
-            compiled += shamt << 6
-            compiled += self._funct
-
-        elif self._instruction_type == "I":
-            immediate = self._evaluate(self._immediate, labels)
-            compiled += self._opcode << 26
-            compiled += self._rs << 21
-            compiled += self._rt << 16
-            compiled += immediate
-
-        elif self._instruction_type == "J":
-            jump_target = self._evaluate(self._jump_target, labels)
-            compiled += self._opcode << 26
-            compiled += jump_target
-
-        return compiled.to_bytes(4, byteorder='big')
-
-    def _evaluate(self, expression, labels):
-        # Replace labels with 0 for the test
-        while True:
-            match = re.search("[A-Za-z_][A-Za-z0-9_]*", expression)
-            if match is None:
-                break
-            if match.group() not in labels:
-                raise MipsCompileError("The label '{}' is undefined".format(match.group()))
-            expression = expression.replace(match.group(), str(labels[match.group()]), 1)
 
-        # Attempt to calculate the result
-        try:
-            value = int(eval(expression))
-        except:
-            raise MipsCompileError("Failed to calculate the '{}' expression".format(expression))
-        print(value)
-        return value
+class _MipsLoadImmediate(object):
+    # A li or la whose value depends on labels, so how many words it takes is only known once the labels are placed.
+    # Sections keep their own copy, which starts out as a single word and is grown by relax() when the value turns
+    # out not to fit, and emit it like a data directive.
+    __slots__ = ("_register", "_expression", "_size")
+
+    def __init__(self, register, expression, size=4):
+        self._register = register
+        self._expression = expression
+        self._size = size
+
+    def copy(self):
+        return _MipsLoadImmediate(self._register, self._expression)
+
+    def is_data(self):
+        return True
+
+    def has_data(self):
+        return True
+
+    def get_size(self):
+        return self._size
+
+    def get_alignment(self):
+        return 4
+
+    def get_labels(self):
+        return self._expression.get_labels()
+
+    def get_relocations(self):
+        return []
+
+    def can_grow(self):
+        return self._size < 8
+
+    def reset(self):
+        grown = self._size != 4
+        self._size = 4
+        return grown
+
+    def relax(self, labels):
+        # Returns whether the expansion had to grow to hold the value for these labels
+        if self._size == 8 or len(_plan_load_immediate(self._expression.evaluate(labels))) == 1:
+            return False
+        self._size = 8
+        return True
+
+    def is_oversized(self, labels):
+        # Whether the expansion grew to two words but the value for these labels fits in one
+        return self._size == 8 and len(_plan_load_immediate(self._expression.evaluate(labels))) == 1
+
+    def compile(self, labels):
+        plan = _plan_load_immediate(self._expression.evaluate(labels), self._size == 8)
+        if 4 * len(plan) != self._size:
+            raise MipsCompileError("The value of the '{}' expression changed after the labels were placed"
+                                   .format(self._expression.get_expression()))
+        return b"".join(_WORD.pack((_INSTRUCTIONS[mnemonic].opcode << 26)
+                                   | ((self._register if from_register else 0) << 21)
+                                   | (self._register << 16) | (immediate & 0xFFFF))
+                        for mnemonic, from_register, immediate in plan)
+
+
+def _check_pseudo_arguments(mnemonic, arguments, count):
+    if len(arguments) != count:
+        raise MipsParsingError("The instruction '{}' accepts {} arguments but was provided {}"
+                               .format(mnemonic, count, len(arguments)))
+
+
+def _expand_load_immediate(register, argument):
+    expression = _compile_expression(argument.strip())
+    if not expression.is_constant():
+        return [_MipsLoadImmediate(_get_register_id(register), expression)]
+    try:
+        plan = _plan_load_immediate(expression.evaluate(None))
+    except MipsCompileError as error:
+        raise MipsParsingError(str(error))
+    return [_MipsAssembly(instruction, [register, str(immediate)] if instruction == "lui"
+                          else [register, register if from_register else "$zero", str(immediate)])
+            for instruction, from_register, immediate in plan]
+
+
+def _expand_li(mnemonic, arguments):
+    _check_pseudo_arguments(mnemonic, arguments, 2)
+    return _expand_load_immediate(arguments[0], arguments[1])
+
+
+def _expand_move(mnemonic, arguments):
+    _check_pseudo_arguments(mnemonic, arguments, 2)
+    return [_MipsAssembly("addu", [arguments[0], arguments[1], "$zero"])]
+
+
+def _expand_nop(mnemonic, arguments):
+    _check_pseudo_arguments(mnemonic, arguments, 0)
+    return [_MipsAssembly("sll", ["$zero", "$zero", "0"])]
+
+
+def _expand_b(mnemonic, arguments):
+    _check_pseudo_arguments(mnemonic, arguments, 1)
+    return [_MipsAssembly("beq", ["$zero", "$zero", arguments[0]])]
+
+
+def _expand_branch_zero(mnemonic, arguments):
+    _check_pseudo_arguments(mnemonic, arguments, 2)
+    return [_MipsAssembly(mnemonic[:3], [arguments[0], "$zero", arguments[1]])]
+
+
+# Compare and branch pseudo-instructions as (set instruction, its immediate form, whether the operands are swapped,
+# branch taken when $at is set or clear): blt s, t is "slt $at, s, t; bne $at, $zero" and bgt s, t is
+# "slt $at, t, s; bne $at, $zero"
+_COMPARE_BRANCHES = {
+    "blt": ("slt", "slti", False, "bne"),
+    "bge": ("slt", "slti", False, "beq"),
+    "bgt": ("slt", "slti", True, "bne"),
+    "ble": ("slt", "slti", True, "beq"),
+    "bltu": ("sltu", "sltiu", False, "bne"),
+    "bgeu": ("sltu", "sltiu", False, "beq"),
+    "bgtu": ("sltu", "sltiu", True, "bne"),
+    "bleu": ("sltu", "sltiu", True, "beq"),
+}
+
+
+def _expand_compare_branch(mnemonic, arguments):
+    _check_pseudo_arguments(mnemonic, arguments, 3)
+    compare, compare_immediate, swapped, branch = _COMPARE_BRANCHES[mnemonic]
+    left, right, target = arguments
+    if right.strip().startswith("$"):
+        operands = [right, left] if swapped else [left, right]
+        return [_MipsAssembly(compare, ["$at"] + operands), _MipsAssembly(branch, ["$at", "$zero", target])]
+
+    # A small constant is compared with slti or sltiu. s > c and s <= c are tested as s < c + 1, which flips the branch.
+    # sltiu compares with its sign extended immediate as an unsigned value, so it takes the constants that are within
+    # 0x7FFF of zero modulo 2**32. An unsigned c + 1 of 2**32 has no immediate and is loaded into $at like the others.
+    expression = _compile_expression(right.strip())
+    if expression.is_constant():
+        value = expression.evaluate(None)
+        if compare == "sltu":
+            value = (value & 0xFFFFFFFF) + (1 if swapped else 0)
+            if 0xFFFF8000 <= value <= 0xFFFFFFFF:
+                value -= 1 << 32
+        else:
+            value += 1 if swapped else 0
+        if -0x8000 <= value < 0x8000:
+            if swapped:
+                branch = "beq" if branch == "bne" else "bne"
+            return [_MipsAssembly(compare_immediate, ["$at", left, str(value)]),
+                    _MipsAssembly(branch, ["$at", "$zero", target])]
+
+    operands = ["$at", left] if swapped else [left, "$at"]
+    return _expand_load_immediate("$at", right) + [_MipsAssembly(compare, ["$at"] + operands),
+                                                   _MipsAssembly(branch, ["$at", "$zero", target])]
+
+
+# Pseudo-instructions are expanded into real instructions while parsing, each entry returns the parsed items
+_PSEUDO_INSTRUCTIONS = {
+    "li": _expand_li,
+    "la": _expand_li,
+    "move": _expand_move,
+    "nop": _expand_nop,
+    "b": _expand_b,
+    "beqz": _expand_branch_zero,
+    "bnez": _expand_branch_zero,
+}
+_PSEUDO_INSTRUCTIONS.update(dict.fromkeys(_COMPARE_BRANCHES, _expand_compare_branch))
+
+
+# The encoded row of "sll $zero, $zero, 0", used to fill delay slots
+_NOP_ROW = (0, 0, 0, 0, 0, 0, 0, None)
+
+_FIELD_IMMEDIATE = 0
+_FIELD_JUMP_TARGET = 1
+_FIELD_WORD = 2
+_FIELD_HWORD = 3
+_FIELD_BYTE = 4
+_FIELD_NAMES = ("immediate", "jump_target", "word", "hword", "byte")
+_FIELD_MASKS = (0xFFFF, 0x3FFFFFF, 0xFFFFFFFF, 0xFFFF, 0xFF)
+_DATA_FIELDS = {".word": _FIELD_WORD, ".hword": _FIELD_HWORD, ".byte": _FIELD_BYTE}
+
+_KIND_ABSOLUTE = 0
+_KIND_NAMES = ("absolute",)
+
+
+class _MipsRelocation(object):
+    # A word at offset in its section whose field has to be filled in with the value of expression at link time
+    __slots__ = ("offset", "field", "expression", "kind")
+
+    def __init__(self, offset, field, expression, kind="absolute"):
+        self.offset = offset
+        self.field = field
+        self.expression = expression
+        self.kind = kind
 
 
 class _MipsLabel(object):
+    __slots__ = ("_label",)
+
     def __init__(self, label):
         self._label = label
         self._validate_label()
@@ -453,160 +814,2302 @@ class _MipsLabel(object):
         return self._label
 
 
-class _MipsDirective(object):
-    def __init__(self, directive):
-        self._parse_directive(directive)
-
-    def _parse_directive(self, directive):
-        parts = directive.split(maxsplit=1)
-        self._directive = parts[0]
-        if len(parts) > 1:
-            arguments = parts[1]
+_STRING_LITERAL = re.compile(r'^"((?:[^"\\]|\\.)*)"$', re.DOTALL)
+_STRING_ESCAPE = re.compile(r"\\(x[0-9A-Fa-f]{1,2}|[0-7]{1,3}|.)", re.DOTALL)
+_SIMPLE_ESCAPES = {"a": 0x07, "b": 0x08, "f": 0x0C, "n": 0x0A, "r": 0x0D, "t": 0x09, "v": 0x0B}
+
+
+def _decode_string(literal):
+    match = _STRING_LITERAL.match(literal)
+    if match is None:
+        raise MipsParsingError("The string {} is not a valid quoted string".format(literal))
+
+    decoded = bytearray()
+    text = match.group(1)
+    position = 0
+    for escape in _STRING_ESCAPE.finditer(text):
+        decoded += text[position:escape.start()].encode("utf-8")
+        sequence = escape.group(1)
+        if sequence[0] == "x":
+            decoded.append(int(sequence[1:], 16))
+        elif sequence[0] in "01234567":
+            decoded.append(int(sequence, 8) & 0xFF)
+        elif sequence in _SIMPLE_ESCAPES:
+            decoded.append(_SIMPLE_ESCAPES[sequence])
         else:
-            arguments = ""
+            decoded += sequence.encode("utf-8")
+        position = escape.end()
+    decoded += text[position:].encode("utf-8")
+    return bytes(decoded)
 
+
+# The element size and struct format of the directives that emit a list of integers
+_DATA_DIRECTIVES = {
+    ".word": (4, "I"),
+    ".hword": (2, "H"),
+    ".byte": (1, "B"),
+}
+
+
+class _MipsDirective(object):
+    # Data directives keep their constant elements already packed in _data. Elements that reference labels are packed
+    # as zero and listed in _relocations as (index, expression) pairs. .space and .align never hold any bytes, they
+    # are zero-fill runs that the section layout turns into gaps.
+    __slots__ = ("_directive", "_arguments", "_data", "_relocations", "_size", "_alignment")
+
+    def __init__(self, directive, arguments):
+        self._arguments = None
+        self._data = None
+        self._relocations = ()
+        self._size = 0
+        self._alignment = 1
+        self._parse_directive(directive, arguments)
+
+    def _parse_directive(self, directive, arguments):
+        self._directive = directive
         if self._directive == ".section":
             self._parse_section_arguments(arguments)
         elif self._directive == ".set":
             self._parse_set_arguments(arguments)
         elif self._directive == ".align":
-            raise MipsParsingError("The directive '{}' is unsupported".format(self._directive))
+            self._parse_align_arguments(arguments)
         elif self._directive == ".ascii":
-            raise MipsParsingError("The directive '{}' is unsupported".format(self._directive))
+            self._parse_string_arguments(arguments, terminator=b"")
         elif self._directive == ".asciiz":
-            raise MipsParsingError("The directive '{}' is unsupported".format(self._directive))
+            self._parse_string_arguments(arguments, terminator=b"\0")
         elif self._directive == ".space":
-            raise MipsParsingError("The directive '{}' is unsupported".format(self._directive))
-        elif self._directive == ".word":
-            raise MipsParsingError("The directive '{}' is unsupported".format(self._directive))
-        elif self._directive == ".hword":
-            raise MipsParsingError("The directive '{}' is unsupported".format(self._directive))
-        elif self._directive == ".byte":
-            raise MipsParsingError("The directive '{}' is unsupported".format(self._directive))
+            self._parse_space_arguments(arguments)
+        elif self._directive in _DATA_DIRECTIVES:
+            self._parse_data_arguments(arguments)
         else:
             raise MipsParsingError("The directive '{}' is unsupported".format(self._directive))
 
     def _parse_set_arguments(self, arguments):
+        arguments = ", ".join(arguments)
         if arguments not in ["reorder", "noreorder"]:
             raise MipsParsingError("The .set directive doesn't support the '{}' argument".format(arguments))
         self._arguments = arguments
 
     def _parse_section_arguments(self, arguments):
+        arguments = ", ".join(arguments)
         match = re.match("^(\.[A-Za-z][A-Za-z0-9]*)+$", arguments)
         if match is None:
             raise MipsParsingError("Section name '{}' is invalid".format(arguments))
         self._arguments = arguments
 
+    def _parse_constant_argument(self, arguments):
+        if len(arguments) != 1:
+            raise MipsParsingError("The {} directive accepts 1 argument but was provided {}"
+                                   .format(self._directive, len(arguments)))
+        expression = _compile_expression(arguments[0])
+        if not expression.is_constant():
+            raise MipsParsingError("The {} directive does not support labels".format(self._directive))
+        return expression.evaluate(None)
+
+    def _parse_align_arguments(self, arguments):
+        # As with other MIPS assemblers the argument is the power of two to align to
+        power = self._parse_constant_argument(arguments)
+        if not 0 <= power <= 16:
+            raise MipsParsingError("The alignment '{}' is out of range".format(power))
+        self._alignment = 1 << power
+
+    def _parse_space_arguments(self, arguments):
+        self._size = self._parse_constant_argument(arguments)
+        if self._size < 0:
+            raise MipsParsingError("The .space directive can't reserve a negative amount of bytes")
+
+    def _parse_string_arguments(self, arguments, terminator):
+        if len(arguments) == 0:
+            raise MipsParsingError("The {} directive requires at least one string".format(self._directive))
+        self._data = b"".join(_decode_string(argument) + terminator for argument in arguments)
+        self._size = len(self._data)
+
+    def _parse_data_arguments(self, arguments):
+        if len(arguments) == 0:
+            raise MipsParsingError("The {} directive requires at least one value".format(self._directive))
+        size, element_format = _DATA_DIRECTIVES[self._directive]
+        mask = (1 << (8 * size)) - 1
+
+        values = []
+        relocations = []
+        for index, argument in enumerate(arguments):
+            expression = _compile_expression(argument)
+            if expression.is_constant():
+                values.append(expression.evaluate(None) & mask)
+            else:
+                values.append(0)
+                relocations.append((index, expression))
+
+        # Every element is packed with a single call, label dependent ones are patched in at link time
+        self._data = struct.pack(">{}{}".format(len(values), element_format), *values)
+        self._relocations = tuple(relocations)
+        self._size = len(self._data)
+        self._alignment = size
+
     def get_directive(self):
         return self._directive
 
     def get_arguments(self):
         return self._arguments
 
+    def is_data(self):
+        return self._directive not in (".section", ".set")
+
+    def has_data(self):
+        return self._data is not None
+
     def get_size(self):
-        return 0
+        return self._size
+
+    def get_alignment(self):
+        return self._alignment
+
+    def get_relocations(self):
+        # (offset in the directive's data, field, expression) for every element that references a label
+        if len(self._relocations) == 0:
+            return []
+        size = _DATA_DIRECTIVES[self._directive][0]
+        field = _DATA_FIELDS[self._directive]
+        return [(index * size, field, expression) for index, expression in self._relocations]
+
+    def compile(self, labels):
+        # The bytes emitted by the directive, or None for zero-fill directives
+        if len(self._relocations) == 0:
+            return self._data
+
+        size, element_format = _DATA_DIRECTIVES[self._directive]
+        element = struct.Struct(">" + element_format)
+        mask = (1 << (8 * size)) - 1
+        compiled = bytearray(self._data)
+        for index, expression in self._relocations:
+            element.pack_into(compiled, index * size, expression.evaluate(labels) & mask)
+        return compiled
+
+
+# Opcodes whose immediate column holds a 26 bit jump target rather than a 16 bit immediate
+_JUMP_OPCODES = frozenset(spec.opcode for spec in _INSTRUCTIONS.values() if spec.instruction_type == "J")
+
+
+def _encode_words_python(opcodes, rs, rt, rd, shamts, functs, immediates):
+    immediate_mask = _FIELD_MASKS[_FIELD_IMMEDIATE]
+    jump_target_mask = _FIELD_MASKS[_FIELD_JUMP_TARGET]
+    words = array.array("I", [
+        (opcode << 26) | (rs << 21) | (rt << 16) | (rd << 11) | (shamt << 6) | funct
+        | (immediate & (jump_target_mask if opcode in _JUMP_OPCODES else immediate_mask))
+        for opcode, rs, rt, rd, shamt, funct, immediate in zip(opcodes, rs, rt, rd, shamts, functs, immediates)])
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words.tobytes()
+
+
+def _encode_words_numpy(opcodes, rs, rt, rd, shamts, functs, immediates):
+    opcodes = numpy.frombuffer(opcodes, dtype=numpy.uint8).astype(numpy.uint32)
+    immediates = numpy.frombuffer(immediates, dtype=numpy.int64)
+    masks = numpy.where(numpy.isin(opcodes, list(_JUMP_OPCODES)), _FIELD_MASKS[_FIELD_JUMP_TARGET],
+                        _FIELD_MASKS[_FIELD_IMMEDIATE])
+    words = opcodes << 26
+    words |= numpy.frombuffer(rs, dtype=numpy.uint8).astype(numpy.uint32) << 21
+    words |= numpy.frombuffer(rt, dtype=numpy.uint8).astype(numpy.uint32) << 16
+    words |= numpy.frombuffer(rd, dtype=numpy.uint8).astype(numpy.uint32) << 11
+    words |= numpy.frombuffer(shamts, dtype=numpy.uint8).astype(numpy.uint32) << 6
+    words |= numpy.frombuffer(functs, dtype=numpy.uint8).astype(numpy.uint32)
+    words |= (immediates & masks).astype(numpy.uint32)
+    return words.astype(">u4").tobytes()
+
+
+# The NumPy encoder is used whenever NumPy is available, both produce identical big endian words
+_encode_words = _encode_words_python if numpy is None else _encode_words_numpy
+
+
+MipsSourceLocation = collections.namedtuple("MipsSourceLocation", ["file", "line", "column"])
+
+# Entries of a line table per block, the first entry of a block is stored in full
+_LINE_TABLE_BLOCK = 32
+
+
+def _append_varint(data, value):
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class _MipsLineTable(object):
+    # Maps increasing keys, such as section offsets, to the (file, line, column) they come from. Each entry is a key
+    # that starts a new location and is stored as variable length values relative to the entry before it: the key
+    # delta, the line delta with flags for a changed column and a changed file, then the file index and the column
+    # when they changed. An instruction per line takes two bytes. Every _LINE_TABLE_BLOCK entries a block starts
+    # over from zero, so a lookup bisects the first keys of the blocks and decodes a single block.
+    def __init__(self):
+        self._files = []
+        self._file_ids = {}
+        self._data = bytearray()
+        self._block_keys = array.array("I")
+        self._block_positions = array.array("I")
+        self._count = 0
+        self._key = 0
+        self._file_id = -1
+        self._line = 0
+        self._column = 0
+        self._end = None
+        # The entries sorted by file and line, built on the first lookup by line
+        self._by_line = None
+
+    def append(self, key, file_name, line, column):
+        file_id = self._file_ids.get(file_name)
+        if file_id is None:
+            file_id = self._file_ids[file_name] = len(self._files)
+            self._files.append(file_name)
+
+        if self._count % _LINE_TABLE_BLOCK == 0:
+            self._block_keys.append(key)
+            self._block_positions.append(len(self._data))
+            self._key = 0
+            self._file_id = -1
+            self._line = 0
+            self._column = 0
+        data = self._data
+        _append_varint(data, key - self._key)
+        line_delta = line - self._line
+        line_delta = line_delta << 1 if line_delta >= 0 else (~line_delta << 1) | 1
+        _append_varint(data, line_delta << 2 | (column != self._column) << 1 | (file_id != self._file_id))
+        if file_id != self._file_id:
+            _append_varint(data, file_id)
+        if column != self._column:
+            _append_varint(data, column)
+        self._count += 1
+        self._key = key
+        self._file_id = file_id
+        self._line = line
+        self._column = column
+        self._by_line = None
+
+    def set_end(self, end):
+        # The key the last entry runs up to
+        self._end = end
+
+    def get_size(self):
+        # The bytes taken by the encoded entries and the block index
+        return len(self._data) + self._block_keys.itemsize * (len(self._block_keys) + len(self._block_positions))
+
+    def _iter_block(self, block):
+        # Yields (key, file id, line, column) for the entries of a block
+        data = self._data
+        position = self._block_positions[block]
+        end = self._block_positions[block + 1] if block + 1 < len(self._block_positions) else len(data)
+        key = 0
+        file_id = -1
+        line = 0
+        column = 0
+        while position < end:
+            # Most values fit in one byte
+            value = data[position]
+            position += 1
+            if value >= 0x80:
+                value, position = _read_varint(data, position - 1)
+            key += value
+            value = data[position]
+            position += 1
+            if value >= 0x80:
+                value, position = _read_varint(data, position - 1)
+            if value & 1:
+                file_id, position = _read_varint(data, position)
+            if value & 2:
+                column, position = _read_varint(data, position)
+            line += ~(value >> 3) if value & 4 else value >> 3
+            yield key, file_id, line, column
+
+    def __iter__(self):
+        # Yields (start key, end key, file, line, column) for every entry
+        previous = None
+        for block in range(len(self._block_keys)):
+            for key, file_id, line, column in self._iter_block(block):
+                if previous is not None:
+                    yield (previous[0], key, self._files[previous[1]]) + previous[2:]
+                previous = key, file_id, line, column
+        if previous is not None:
+            yield (previous[0], self._end, self._files[previous[1]]) + previous[2:]
+
+    def lookup(self, key):
+        # The MipsSourceLocation of the last entry at or before the key, or None
+        block = bisect.bisect_right(self._block_keys, key) - 1
+        if block < 0 or (self._end is not None and key >= self._end):
+            return None
+        found = None
+        for entry in self._iter_block(block):
+            if entry[0] > key:
+                break
+            found = entry
+        return MipsSourceLocation(self._files[found[1]], found[2], found[3])
+
+    def find(self, file_name, line):
+        # The (start key, end key) ranges of every entry of a source line, in order of key
+        file_id = self._file_ids.get(file_name)
+        if file_id is None:
+            return []
+        if self._by_line is None:
+            entries = sorted((self._file_ids[entry_file] << 32 | entry_line, start, end)
+                             for start, end, entry_file, entry_line, column in self)
+            self._by_line = (array.array("Q", [entry[0] for entry in entries]),
+                             [(start, end) for source, start, end in entries])
+        sources, ranges = self._by_line
+        source = file_id << 32 | line
+        return ranges[bisect.bisect_left(sources, source):bisect.bisect_right(sources, source)]
+
+
+# Where everything in a section ends up. runs holds a (first row, row count, offset) entry for every run of
+# consecutive instructions, data holds an (offset, directive) entry for every directive that emits bytes, and labels
+# holds (label, offset) entries. Bytes covered by none of them are zero. marker_offsets holds the offset of every
+# marker, labels and directives without data sit at the end of whatever comes before them.
+_MipsSectionLayout = collections.namedtuple("_MipsSectionLayout", ["runs", "data", "labels", "size", "alignment",
+                                                                   "marker_offsets"])
+
+# Zero-fill runs are written out in blocks of this size when the output can't seek past them
+_ZERO_BLOCK = memoryview(bytes(1 << 16))
 
 
 class _MipsSection(object):
+    # Instructions are stored as one row across parallel field columns. Expressions that reference labels are
+    # interned in a table and the relocation columns point a row at the expression that fills its immediate.
+    # Labels and directives are kept in a side list along with the row they precede.
     def __init__(self, name, address=0):
         self._name = name
-        self._items = []
         self._address = address
+        # How far past an address aligned to the section's alignment the section starts, only ever set for the
+        # pieces of a larger section, see set_phase
+        self._phase = 0
+
+        self._opcodes = array.array("B")
+        self._rs = array.array("B")
+        self._rt = array.array("B")
+        self._rd = array.array("B")
+        self._shamts = array.array("B")
+        self._functs = array.array("B")
+        self._immediates = array.array("q")
+
+        self._expressions = []
+        self._expression_ids = {}
+        self._relocation_rows = array.array("L")
+        self._relocation_fields = array.array("B")
+        self._relocation_expressions = array.array("L")
+        self._relocation_kinds = array.array("B")
+
+        self._markers = []
+        # The section's own copies of the pseudo-instructions whose size is settled when the labels are placed
+        self._relaxable = []
+
+        # Delay slot scheduling state: the instruction in the last row when it could still be moved into the delay
+        # slot of a branch added next, and whether the last row is a branch whose delay slot hasn't been filled
+        self._movable = None
+        self._slot_pending = False
+
+        # Where the items came from: the index of the item that starts each new location, counting rows and markers
+        # alike, its line and column, and an (entry, file name) pair for every entry that changes the file
+        self._source_items = array.array("I")
+        self._source_lines = array.array("I")
+        self._source_columns = array.array("I")
+        self._source_files = []
+        self._location = None
+
+        # Encoded words of every row with the relocated fields left as zero, the section layout and the line table
+        # keyed by offset, all built when first needed
+        self._image = None
+        self._layout = None
+        self._line_table = None
+
+    def add(self, line, reorder=False, location=None):
+        # In reorder mode every branch and jump gets its delay slot filled, see _fill_delay_slot. The location is a
+        # (file, line, column) tuple, items passing the same tuple object share one line table entry.
+        row = len(self._opcodes)
+        if location is not self._location and location is not None:
+            self._add_location(row + len(self._markers), location)
+        if type(line) == _MipsAssembly:
+            self._add_row(row, line.encode())
+            in_delay_slot = self._slot_pending
+            if reorder and line.has_delay_slot() and not in_delay_slot:
+                self._fill_delay_slot(row, line)
+            else:
+                self._slot_pending = line.has_delay_slot()
+                self._movable = line if line.can_fill_delay_slot() and not in_delay_slot else None
+            self._image = None
+        else:
+            if type(line) is _MipsLoadImmediate:
+                line = line.copy()
+                self._relaxable.append(line)
+            self._markers.append((row, line))
+            self._movable = None
+        self._layout = None
+
+    def end_scheduling_block(self):
+        self._movable = None
+        self._slot_pending = False
+
+    def _add_location(self, index, location):
+        self._location = location
+        file_name, line, column = location
+        if len(self._source_files) == 0 or self._source_files[-1][1] != file_name:
+            self._source_files.append((len(self._source_items), file_name))
+        self._source_items.append(index)
+        self._source_lines.append(line)
+        self._source_columns.append(column)
+
+    def _iter_sources(self):
+        # Yields (item index, file name, line, column) for every location entry
+        files = self._source_files
+        file_index = 0
+        file_name = None
+        for entry, (index, line, column) in enumerate(zip(self._source_items, self._source_lines,
+                                                          self._source_columns)):
+            if file_index < len(files) and files[file_index][0] == entry:
+                file_name = files[file_index][1]
+                file_index += 1
+            yield index, file_name, line, column
+
+    def _add_row(self, row, encoded):
+        opcode, rs, rt, rd, shamt, funct, immediate, relocation = encoded
+        self._opcodes.append(opcode)
+        self._rs.append(rs)
+        self._rt.append(rt)
+        self._rd.append(rd)
+        self._shamts.append(shamt)
+        self._functs.append(funct)
+        self._immediates.append(immediate)
+        if relocation is not None:
+            self._add_relocation(row, relocation[0], relocation[1], _KIND_ABSOLUTE)
+
+    def _fill_delay_slot(self, row, branch):
+        # The instruction right before the branch moves into its delay slot when nothing in between can be jumped
+        # to and the two don't share a register one of them writes. Otherwise a nop fills the slot.
+        previous = self._movable
+        if previous is not None:
+            previous_reads, previous_writes = previous.get_register_usage()
+            branch_reads, branch_writes = branch.get_register_usage()
+            if previous_writes & (branch_reads | branch_writes) or previous_reads & branch_writes:
+                previous = None
+
+        if previous is None:
+            self._add_row(row + 1, _NOP_ROW)
+        else:
+            for column in (self._opcodes, self._rs, self._rt, self._rd, self._shamts, self._functs,
+                           self._immediates):
+                column[row - 1], column[row] = column[row], column[row - 1]
+            # Only the last two rows can have relocations that need to follow their instruction
+            relocation_rows = self._relocation_rows
+            for index in range(max(0, len(relocation_rows) - 2), len(relocation_rows)):
+                if relocation_rows[index] == row - 1:
+                    relocation_rows[index] = row
+                elif relocation_rows[index] == row:
+                    relocation_rows[index] = row - 1
+            self._swap_locations(row + len(self._markers))
+        self._movable = None
+        self._slot_pending = False
+
+    def _swap_locations(self, index):
+        # The branch at item index went up one row and the instruction before it went into the delay slot. Only
+        # when the branch started a location of its own, in the same file, do the two rows map to different lines.
+        items = self._source_items
+        lines = self._source_lines
+        columns = self._source_columns
+        if len(items) < 2 or items[-1] != index or self._source_files[-1][0] == len(items) - 1:
+            return
+        if items[-2] == index - 1:
+            lines[-2], lines[-1] = lines[-1], lines[-2]
+            columns[-2], columns[-1] = columns[-1], columns[-2]
+        else:
+            items[-1] = index - 1
+            items.append(index)
+            lines.append(lines[-2])
+            columns.append(columns[-2])
+        # The next item starts a new entry even when it comes from the branch's line
+        self._location = None
+
+    def _add_relocation(self, row, field, expression, kind):
+        expression_id = self._expression_ids.get(expression.get_expression())
+        if expression_id is None:
+            expression_id = len(self._expressions)
+            self._expressions.append(expression)
+            self._expression_ids[expression.get_expression()] = expression_id
+        self._relocation_rows.append(row)
+        self._relocation_fields.append(field)
+        self._relocation_expressions.append(expression_id)
+        self._relocation_kinds.append(kind)
+
+    def get_name(self):
+        return self._name
+
+    def get_address(self):
+        return self._address
+
+    def set_address(self, address):
+        self._address = address
+
+    def get_size(self):
+        return self._get_layout().size
+
+    def get_alignment(self):
+        return self._get_layout().alignment
+
+    def set_phase(self, phase):
+        # Lays out a piece of a larger section that starts phase bytes past an address aligned to the piece's
+        # alignment, so its padding comes out as it would inside the larger section. The layout offsets, and the
+        # size, then count from that aligned address.
+        if phase != self._phase:
+            self._phase = phase
+            self._layout = None
+
+    def get_phase(self):
+        return self._phase
+
+    def can_split(self):
+        # Whether the items that follow can go to a separate piece with the same result: no instruction could move
+        # into a coming delay slot, no delay slot is open and no label waits for the offset of what follows
+        if self._movable is not None or self._slot_pending:
+            return False
+        row = len(self._opcodes)
+        for marker_row, item in reversed(self._markers):
+            if marker_row != row:
+                break
+            if type(item) is _MipsLabel:
+                return False
+            if item.is_data():
+                break
+        return True
+
+    def has_instructions(self):
+        return len(self._opcodes) > 0
+
+    def prepare(self):
+        # Encodes the rows and computes the layout now, so copies of the section, such as the ones stored in the
+        # section cache, carry both
+        if self._image is None:
+            self._image = self._encode_image()
+        self._get_layout()
+
+    def set_source(self, file_name, line_numbers):
+        # Moves the locations recorded with line n of a fragment, counted from 1, to line_numbers[n - 1] of the file
+        self._source_lines = array.array("I", [line_numbers[line - 1] for line in self._source_lines])
+        self._source_files = [(0, file_name)] if len(self._source_items) > 0 else []
+        self._location = None
+        self._line_table = None
+
+    def extend(self, other):
+        # Appends the rows, relocations and markers of another section as if its lines had been added to this one
+        row_offset = len(self._opcodes)
+        item_offset = row_offset + len(self._markers)
+        entry_offset = len(self._source_items)
+        self._source_items.extend([item_offset + index for index in other._source_items])
+        self._source_lines.extend(other._source_lines)
+        self._source_columns.extend(other._source_columns)
+        for entry, file_name in other._source_files:
+            if len(self._source_files) == 0 or self._source_files[-1][1] != file_name:
+                self._source_files.append((entry_offset + entry, file_name))
+        self._location = None
+        self._opcodes.extend(other._opcodes)
+        self._rs.extend(other._rs)
+        self._rt.extend(other._rt)
+        self._rd.extend(other._rd)
+        self._shamts.extend(other._shamts)
+        self._functs.extend(other._functs)
+        self._immediates.extend(other._immediates)
+        for row, field, expression_id, kind in zip(other._relocation_rows, other._relocation_fields,
+                                                   other._relocation_expressions, other._relocation_kinds):
+            self._add_relocation(row_offset + row, field, other._expressions[expression_id], kind)
+        for row, item in other._markers:
+            if type(item) is _MipsLoadImmediate:
+                item = item.copy()
+                self._relaxable.append(item)
+            self._markers.append((row_offset + row, item))
+        self._movable = None
+        self._slot_pending = False
+
+        if self._image is not None and other._image is not None:
+            self._image += other._image
+        else:
+            self._image = None
+        self._layout = None
+
+    def _get_layout(self):
+        if self._layout is None:
+            self._layout = self._compute_layout()
+            self._line_table = None
+        return self._layout
+
+    def get_line_table(self):
+        # The line table keyed by offset in the section, built from the layout when first needed. An entry that
+        # emits nothing is dropped in favour of the entry after it.
+        layout = self._get_layout()
+        if self._line_table is not None:
+            return self._line_table
+
+        runs = layout.runs
+        marker_offsets = layout.marker_offsets
+        markers = self._markers
+        row_count = len(self._opcodes)
+        line_table = _MipsLineTable()
+        marker = 0
+        previous = None
+        for index, file_name, line, column in self._iter_sources():
+            # The item index counts the rows and markers before the item, and a marker comes before the row it
+            # precedes
+            while marker < len(markers) and markers[marker][0] + marker < index:
+                marker += 1
+            if marker < len(markers) and markers[marker][0] + marker == index:
+                offset = marker_offsets[marker]
+            elif index - marker < row_count:
+                offset = self._get_row_offset(index - marker, runs)
+            else:
+                offset = layout.size
+            if previous is not None and offset > previous[0]:
+                line_table.append(*previous)
+            previous = (offset, file_name, line, column)
+        if previous is not None and previous[0] < layout.size:
+            line_table.append(*previous)
+        line_table.set_end(layout.size)
+        self._line_table = line_table
+        return line_table
+
+    def _compute_layout(self):
+        runs = []
+        data = []
+        labels = []
+        pending_labels = []
+        marker_offsets = array.array("I")
+        alignment = 4 if len(self._opcodes) > 0 else 1
+        offset = self._phase
+        row = 0
+
+        # Labels take the offset of whatever follows them, so they also pick up the padding that aligns it
+        for marker_row, item in itertools.chain(self._markers, [(len(self._opcodes), None)]):
+            if marker_row > row:
+                offset = (offset + 3) & ~3
+                if pending_labels:
+                    labels.extend([(label, offset) for label in pending_labels])
+                    pending_labels = []
+                if len(runs) > 0 and runs[-1][0] + runs[-1][1] == row and runs[-1][2] + 4 * runs[-1][1] == offset:
+                    runs[-1] = (runs[-1][0], runs[-1][1] + marker_row - row, runs[-1][2])
+                else:
+                    runs.append((row, marker_row - row, offset))
+                offset += 4 * (marker_row - row)
+                row = marker_row
 
-    def add(self, line):
-        self._items.append(line)
+            if item is None:
+                break
+            elif type(item) == _MipsLabel:
+                pending_labels.append(item.get_label())
+                marker_offsets.append(offset)
+            elif item.is_data():
+                item_alignment = item.get_alignment()
+                alignment = max(alignment, item_alignment)
+                offset = (offset + item_alignment - 1) // item_alignment * item_alignment
+                if pending_labels:
+                    labels.extend([(label, offset) for label in pending_labels])
+                    pending_labels = []
+                if item.has_data():
+                    data.append((offset, item))
+                marker_offsets.append(offset)
+                offset += item.get_size()
+            else:
+                marker_offsets.append(offset)
+
+        labels.extend((label, offset) for label in pending_labels)
+        return _MipsSectionLayout(runs, data, labels, offset, alignment, marker_offsets)
+
+    def _get_row_offset(self, row, runs):
+        run = runs[bisect.bisect_right(runs, (row, float("inf"))) - 1]
+        return run[2] + 4 * (row - run[0])
+
+    def get_relocations(self):
+        layout = self._get_layout()
+        relocations = [
+            _MipsRelocation(self._get_row_offset(row, layout.runs), _FIELD_NAMES[field],
+                            self._expressions[expression_id], _KIND_NAMES[kind])
+            for row, field, expression_id, kind in zip(self._relocation_rows, self._relocation_fields,
+                                                       self._relocation_expressions, self._relocation_kinds)]
+        for offset, directive in layout.data:
+            for data_offset, field, expression in directive.get_relocations():
+                relocations.append(_MipsRelocation(offset + data_offset, _FIELD_NAMES[field], expression))
+        relocations.sort(key=lambda relocation: relocation.offset)
+        return relocations
+
+    def get_label_references(self):
+        # Maps every label the section's bytes depend on to the references that use it: the index of a relocation
+        # for a row, or ~index for a marker
+        references = {}
+        for index, expression_id in enumerate(self._relocation_expressions):
+            for label in self._expressions[expression_id].get_labels():
+                references.setdefault(label, []).append(index)
+        for index, (row, item) in enumerate(self._markers):
+            if type(item) is _MipsLoadImmediate:
+                labels = item.get_labels()
+            elif type(item) is _MipsDirective:
+                labels = set(label for data_offset, field, expression in item.get_relocations()
+                             for label in expression.get_labels())
+            else:
+                continue
+            for label in labels:
+                references.setdefault(label, []).append(~index)
+        return references
+
+    def compile_reference(self, reference, labels):
+        # The offset and the bytes of a reference from get_label_references()
+        if self._image is None:
+            self._image = self._encode_image()
+        layout = self._get_layout()
+        if reference < 0:
+            return layout.marker_offsets[~reference], bytes(self._markers[~reference][1].compile(labels))
+        row = self._relocation_rows[reference]
+        field = self._relocation_fields[reference]
+        value = self._expressions[self._relocation_expressions[reference]].evaluate(labels) & _FIELD_MASKS[field]
+        return self._get_row_offset(row, layout.runs), _WORD.pack(_WORD.unpack_from(self._image, 4 * row)[0] | value)
+
+    def _encode_image(self):
+        return _encode_words(self._opcodes, self._rs, self._rt, self._rd, self._shamts, self._functs,
+                             self._immediates)
+
+    def _compile_words(self, labels):
+        if self._image is None:
+            self._image = self._encode_image()
+
+        # A bulk copy of the pre-encoded image, then only the label dependent words get patched
+        words = bytearray(self._image)
+        expressions = self._expressions
+        for row, field, expression_id in zip(self._relocation_rows, self._relocation_fields,
+                                             self._relocation_expressions):
+            value = expressions[expression_id].evaluate(labels) & _FIELD_MASKS[field]
+            offset = 4 * row
+            _WORD.pack_into(words, offset, _WORD.unpack_from(words, offset)[0] | value)
+        return words
+
+    def iter_chunks(self, labels=None):
+        # Yields (offset, bytes) for every part of the section that isn't zero, in order of offset
+        if labels is None:
+            labels = self.get_labels()
+        layout = self._get_layout()
+        words = memoryview(self._compile_words(labels))
+
+        data = iter(layout.data)
+        pending = next(data, None)
+        for first_row, count, offset in layout.runs:
+            while pending is not None and pending[0] < offset:
+                yield pending[0], pending[1].compile(labels)
+                pending = next(data, None)
+            yield offset, words[4 * first_row:4 * (first_row + count)]
+        while pending is not None:
+            yield pending[0], pending[1].compile(labels)
+            pending = next(data, None)
 
     def compile(self, labels=None):
         if labels is None:
             labels = self.get_labels()
+        layout = self._get_layout()
+
+        # Plain code is a single run of instructions, its words are the whole section
+        if len(layout.data) == 0 and len(layout.runs) <= 1 and layout.size == 4 * len(self._opcodes):
+            return memoryview(self._compile_words(labels))
+
+        # The zero-initialised buffer already holds every zero-fill run, so only the chunks are copied in
+        return self.compile_into(bytearray(layout.size), 0, labels, zero_fill=False)
+
+    def compile_into(self, buffer, offset=0, labels=None, zero_fill=True):
+        # Writes the section into a preallocated buffer, such as an mmap. When the buffer is known to be zeroed
+        # already, zero_fill=False leaves the gaps between chunks untouched.
+        buffer = memoryview(buffer)
+        position = 0
+        for chunk_offset, chunk in self.iter_chunks(labels):
+            if zero_fill:
+                self._fill_zero(buffer, offset + position, chunk_offset - position)
+            buffer[offset + chunk_offset:offset + chunk_offset + len(chunk)] = chunk
+            position = chunk_offset + len(chunk)
+        if zero_fill:
+            self._fill_zero(buffer, offset + position, self.get_size() - position)
+        return buffer[offset:offset + self.get_size()]
 
-        compiled_section = b""
-        for item in self._items:
-            if type(item) == _MipsAssembly:
-                compiled_section += item.compile(labels)
+    @staticmethod
+    def _fill_zero(buffer, offset, size):
+        while size > 0:
+            block = min(size, len(_ZERO_BLOCK))
+            buffer[offset:offset + block] = _ZERO_BLOCK[:block]
+            offset += block
+            size -= block
+
+    def write(self, file, labels=None):
+        # Streams the section to a binary file. Zero-fill runs are skipped over when the file can seek, which
+        # leaves holes in sparse files, and are written in fixed size blocks otherwise.
+        seekable = file.seekable()
+        position = 0
+        for chunk_offset, chunk in self.iter_chunks(labels):
+            self._write_zero(file, chunk_offset - position, seekable)
+            file.write(chunk)
+            position = chunk_offset + len(chunk)
+
+        size = self.get_size()
+        if size > position:
+            # The last byte is written so the file really grows to the full size of the section
+            self._write_zero(file, size - position - 1, seekable)
+            file.write(b"\0")
+        return size
 
-        return compiled_section
+    @staticmethod
+    def _write_zero(file, size, seekable):
+        if size <= 0:
+            return
+        if seekable:
+            file.seek(size, io.SEEK_CUR)
+            return
+        while size > 0:
+            block = min(size, len(_ZERO_BLOCK))
+            file.write(_ZERO_BLOCK[:block])
+            size -= block
+
+    def get_relaxable_items(self):
+        return self._relaxable
+
+    def reset_relaxation(self):
+        # Shrinks every pseudo-instruction back to its shortest expansion, ready to be relaxed for a new placement
+        if any([item.reset() for item in self._relaxable]):
+            self._layout = None
+
+    def invalidate_layout(self):
+        self._layout = None
 
     def get_labels(self, labels=None):
-        if labels is None:
-            labels = {}
+        if labels is not None:
+            return self._collect_labels(labels)
+
+        # On its own a section can only be relaxed against its own labels, growing items until nothing changes
+        labels = self._collect_labels({})
+        while any([item.relax(labels) for item in self._relaxable]):
+            self._layout = None
+            labels = self._collect_labels({})
+        return labels
+
+    def _collect_labels(self, labels):
         address = self._address
-        for item in self._items:
-            if type(item) == _MipsAssembly:
-                address += 4
-            elif type(item) == _MipsDirective:
-                address += item.get_size()
-            elif type(item) == _MipsLabel:
-                if item.get_label() in labels:
-                    raise MipsCompileError("The label '{}' was defined more than once".format(item.get_label()))
-                labels[item.get_label()] = address
+        for label, offset in self._get_layout().labels:
+            if label in labels:
+                raise MipsCompileError("The label '{}' was defined more than once".format(label))
+            labels[label] = address + offset
 
         return labels
 
 
+MipsPeepholeRewrite = collections.namedtuple("MipsPeepholeRewrite", ["rule", "section", "before", "after"])
+
+# Instructions without side effects besides writing their destination register, the only ones that may be removed
+_PURE_MNEMONICS = frozenset(["addu", "subu", "and", "or", "xor", "nor", "slt", "sltu", "sll", "srl", "sra", "sllv",
+                             "srlv", "srav", "mul", "clz", "clo", "addiu", "slti", "sltiu", "andi", "ori", "xori",
+                             "lui"])
+
+# How the pure instructions with a constant result compute it from (rs, rt, the row's immediate or shift amount).
+# Registers hold unsigned 32 bit values.
+_CONSTANT_RESULTS = {
+    "addu": lambda rs, rt, immediate: rs + rt,
+    "subu": lambda rs, rt, immediate: rs - rt,
+    "and": lambda rs, rt, immediate: rs & rt,
+    "or": lambda rs, rt, immediate: rs | rt,
+    "xor": lambda rs, rt, immediate: rs ^ rt,
+    "nor": lambda rs, rt, immediate: ~(rs | rt),
+    "sll": lambda rs, rt, immediate: rt << immediate,
+    "srl": lambda rs, rt, immediate: rt >> immediate,
+    "sra": lambda rs, rt, immediate: (rt - ((rt & 0x80000000) << 1)) >> immediate,
+    "addiu": lambda rs, rt, immediate: rs + ((immediate & 0xFFFF) ^ 0x8000) - 0x8000,
+    "andi": lambda rs, rt, immediate: rs & immediate & 0xFFFF,
+    "ori": lambda rs, rt, immediate: rs | immediate & 0xFFFF,
+    "xori": lambda rs, rt, immediate: rs ^ immediate & 0xFFFF,
+    "lui": lambda rs, rt, immediate: (immediate & 0xFFFF) << 16,
+}
+
+
+def _get_move_source(instruction):
+    # The register a pure instruction copies into its destination unchanged, or None
+    opcode, rs, rt, rd, shamt, funct, immediate, relocation = instruction.encode()
+    mnemonic = instruction.get_mnemonic()
+    if mnemonic in ("addu", "or", "xor", "subu") and rt == 0:
+        return rs
+    if mnemonic in ("addu", "or", "xor") and rs == 0:
+        return rt
+    if mnemonic in ("and", "or") and rs == rt:
+        return rs
+    if mnemonic in ("addiu", "ori", "xori") and relocation is None and immediate & 0xFFFF == 0:
+        return rs
+    if mnemonic in ("sll", "srl", "sra") and shamt == 0:
+        return rt
+    return None
+
+
+def _make_instruction(mnemonic, *arguments):
+    return _MipsAssembly(mnemonic, [_REGISTER_NAMES[argument] if is_register else str(argument)
+                                    for argument, is_register in arguments])
+
+
+def _remove_nop(peephole, instruction):
+    # Anything that only writes $zero, such as the "sll $zero, $zero, 0" padding
+    if len(instruction.get_register_usage()[1]) == 0:
+        return []
+    return None
+
+
+def _remove_self_move(peephole, instruction):
+    if _get_move_source(instruction) == instruction.get_destination():
+        return []
+    return None
+
+
+def _remove_redundant_move(peephole, instruction):
+    source = _get_move_source(instruction)
+    if source is not None and source != 0 and peephole.is_copy(instruction.get_destination(), source):
+        return []
+    return None
+
+
+def _remove_redundant_constant(peephole, instruction):
+    # A register written with the value it is already known to hold
+    value = peephole.get_constant_result(instruction)
+    if value is not None and peephole.get_constant(instruction.get_destination()) == value:
+        return []
+    return None
+
+
+def _reduce_multiply(peephole, instruction):
+    # mul by a register known to hold a power of two is a shift
+    opcode, rs, rt, rd, shamt, funct, immediate, relocation = instruction.encode()
+    for factor, other in ((rt, rs), (rs, rt)):
+        value = peephole.get_constant(factor)
+        if value is not None and value != 0 and value & (value - 1) == 0:
+            return [_make_instruction("sll", (rd, True), (other, True), (value.bit_length() - 1, False))]
+    return None
+
+
+def _get_load_immediate_value(first, second):
+    # The constant loaded by a lui followed by an ori or addiu completing the same register, or None
+    opcode, rs, rt, rd, shamt, funct, upper, relocation = first.encode()
+    second_opcode, second_rs, second_rt, rd, shamt, funct, lower, second_relocation = second.encode()
+    if relocation is not None or second_relocation is not None or not rt == second_rs == second_rt:
+        return None
+    return _CONSTANT_RESULTS[second.get_mnemonic()](_CONSTANT_RESULTS["lui"](0, 0, upper), 0, lower) & 0xFFFFFFFF
+
+
+def _remove_redundant_load_immediate(peephole, first, second):
+    value = _get_load_immediate_value(first, second)
+    if value is not None and peephole.get_constant(first.get_destination()) == value:
+        return []
+    return None
+
+
+def _merge_load_immediate(peephole, first, second):
+    # The pair is replaced when a single instruction loads the same value
+    value = _get_load_immediate_value(first, second)
+    if value is None:
+        return None
+    plan = _plan_load_immediate(value - ((value & 0x80000000) << 1))
+    if len(plan) != 1:
+        return None
+    mnemonic, from_register, immediate = plan[0]
+    register = first.get_destination()
+    if mnemonic == "lui":
+        return [_make_instruction(mnemonic, (register, True), (immediate, False))]
+    return [_make_instruction(mnemonic, (register, True), (0, True), (immediate, False))]
+
+
+# Rewrites of a single instruction as (rule, the mnemonics it applies to, function). The function returns the
+# replacement instructions, or None when the rule doesn't apply. The first rule that applies wins and its
+# replacement goes through the rules again.
+_PEEPHOLE_RULES = [
+    ("remove-nop", _PURE_MNEMONICS, _remove_nop),
+    ("remove-self-move", _PURE_MNEMONICS, _remove_self_move),
+    ("remove-redundant-move", _PURE_MNEMONICS, _remove_redundant_move),
+    ("remove-redundant-constant", _CONSTANT_RESULTS.keys(), _remove_redundant_constant),
+    ("mul-to-sll", ["mul"], _reduce_multiply),
+]
+
+# Rewrites of two adjacent instructions as (rule, first mnemonic, second mnemonics, function)
+_PEEPHOLE_PAIR_RULES = [
+    ("remove-redundant-constant", "lui", ["ori", "addiu"], _remove_redundant_load_immediate),
+    ("merge-lui-ori", "lui", ["ori", "addiu"], _merge_load_immediate),
+]
+
+_PEEPHOLE_RULES_BY_MNEMONIC = {}
+for _rule, _mnemonics, _function in _PEEPHOLE_RULES:
+    for _mnemonic in _mnemonics:
+        _PEEPHOLE_RULES_BY_MNEMONIC.setdefault(_mnemonic, []).append((_rule, _function))
+_PEEPHOLE_PAIR_RULES_BY_MNEMONICS = {}
+for _rule, _first_mnemonic, _mnemonics, _function in _PEEPHOLE_PAIR_RULES:
+    for _mnemonic in _mnemonics:
+        _PEEPHOLE_PAIR_RULES_BY_MNEMONICS.setdefault((_first_mnemonic, _mnemonic), []).append((_rule, _function))
+_PEEPHOLE_PAIR_FIRST_MNEMONICS = frozenset(first for first, second in _PEEPHOLE_PAIR_RULES_BY_MNEMONICS)
+del _rule, _first_mnemonic, _mnemonics, _mnemonic, _function
+
+
+class _MipsPeephole(object):
+    # Sits in front of a section and rewrites the instructions added in .set reorder mode before they reach it, so
+    # labels and delay slots are only ever worked out for the optimized code. What is known about the registers,
+    # the constants they hold and the registers they are copies of, is forgotten at every label, directive,
+    # branch and jump, so it only ever covers straight-line code.
+    def __init__(self, section, rewrites):
+        self._section = section
+        self._rewrites = rewrites
+        self._constants = {}
+        self._copies = {}
+        # A lui held back until the next instruction shows whether the pair rules apply, and its location. A
+        # replacement takes the location of the first instruction it replaces.
+        self._held = None
+        self._held_location = None
+
+    def add(self, item, reorder, location=None):
+        if type(item) != _MipsAssembly or not reorder:
+            self.flush()
+            self._section.add(item, reorder, location)
+            return
+
+        held = self._held
+        if held is not None:
+            held_location = self._held_location
+            self._held = None
+            for rule, function in _PEEPHOLE_PAIR_RULES_BY_MNEMONICS.get((held.get_mnemonic(), item.get_mnemonic()),
+                                                                        ()):
+                replacement = function(self, held, item)
+                if replacement is not None:
+                    self._record(rule, [held, item], replacement)
+                    for instruction in replacement:
+                        self._emit(instruction, held_location)
+                    return
+            self._emit(held, held_location)
+
+        if item.get_mnemonic() in _PEEPHOLE_PAIR_FIRST_MNEMONICS:
+            self._held = item
+            self._held_location = location
+        else:
+            self._emit(item, location)
+
+    def flush(self):
+        # Passes on the held instruction and forgets everything known about the registers
+        if self._held is not None:
+            self._emit(self._held, self._held_location)
+            self._held = None
+        self._constants.clear()
+        self._copies.clear()
+
+    def _emit(self, instruction, location):
+        for rule, function in _PEEPHOLE_RULES_BY_MNEMONIC.get(instruction.get_mnemonic(), ()):
+            replacement = function(self, instruction)
+            if replacement is not None:
+                self._record(rule, [instruction], replacement)
+                for replacement_instruction in replacement:
+                    self._emit(replacement_instruction, location)
+                return
+
+        self._section.add(instruction, True, location)
+        self._learn(instruction)
+
+    def _learn(self, instruction):
+        if instruction.has_delay_slot():
+            self._constants.clear()
+            self._copies.clear()
+            return
+
+        pure = instruction.get_mnemonic() in _PURE_MNEMONICS
+        value = self.get_constant_result(instruction) if pure else None
+        source = _get_move_source(instruction) if pure else None
+        for register in instruction.get_register_usage()[1]:
+            self._forget(register)
+
+        destination = instruction.get_destination() if pure else 0
+        if destination == 0:
+            return
+        if value is not None:
+            self._constants[destination] = value
+        elif source is not None and source != destination:
+            self._copies[destination] = self._copies.get(source, source)
+            if source in self._constants:
+                self._constants[destination] = self._constants[source]
+
+    def _forget(self, register):
+        self._constants.pop(register, None)
+        self._copies.pop(register, None)
+        for copy in [copy for copy, source in self._copies.items() if source == register]:
+            del self._copies[copy]
+
+    def _record(self, rule, before, after):
+        self._rewrites.append(MipsPeepholeRewrite(rule, self._section.get_name(),
+                                                  tuple(instruction.get_text() for instruction in before),
+                                                  tuple(instruction.get_text() for instruction in after)))
+
+    def get_constant(self, register):
+        if register == 0:
+            return 0
+        return self._constants.get(register)
+
+    def is_copy(self, register, source):
+        # Whether the two registers are known to hold the same value
+        copy_of = self._copies.get(register, register)
+        return copy_of == self._copies.get(source, source)
+
+    def get_constant_result(self, instruction):
+        # The value the instruction writes when it only depends on known constants, otherwise None
+        compute = _CONSTANT_RESULTS.get(instruction.get_mnemonic())
+        if compute is None:
+            return None
+        opcode, rs, rt, rd, shamt, funct, immediate, relocation = instruction.encode()
+        if relocation is not None:
+            return None
+        # The I types among them write rt, the R types have an opcode of zero and read both registers
+        rs_value = self.get_constant(rs)
+        rt_value = self.get_constant(rt) if opcode == 0 else 0
+        if rs_value is None or rt_value is None:
+            return None
+        return compute(rs_value, rt_value, shamt if opcode == 0 else immediate) & 0xFFFFFFFF
+
+
+MipsLineCacheInfo = collections.namedtuple("MipsLineCacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class _MipsLineCache(object):
+    # Maps a stripped source line to the items parsed from it. Parsed items are never modified once they are
+    # created, and instructions keep their encoding, so a hit skips both parsing and encoding.
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, line):
+        with self._lock:
+            parsed = self._entries.get(line)
+            if parsed is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(line)
+            return parsed
+
+    def put(self, line, parsed):
+        with self._lock:
+            self._entries[line] = parsed
+            if len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def info(self):
+        with self._lock:
+            return MipsLineCacheInfo(self._hits, self._misses, self._maxsize, len(self._entries))
+
+
+_line_cache = None
+
+
+def enable_line_cache(maxsize=65536):
+    global _line_cache
+    _line_cache = _MipsLineCache(maxsize)
+
+
+def disable_line_cache():
+    global _line_cache
+    _line_cache = None
+
+
+def line_cache_info():
+    if _line_cache is None:
+        return None
+    return _line_cache.info()
+
+
+MipsSectionCacheInfo = collections.namedtuple("MipsSectionCacheInfo",
+                                              ["hits", "misses", "evictions", "currsize", "maxsize"])
+
+
+def _get_assembler_version():
+    # Entries are only valid for the assembler that wrote them, so its own source is part of every key
+    try:
+        with open(__file__, "rb") as file:
+            return hashlib.sha256(file.read()).digest()
+    except OSError:
+        return b""
+
+
+class _MipsSectionCache(object):
+    # Parsed and encoded sections stored on disk under a hash of the assembler and of the lines they were parsed
+    # from. The stored sections still hold their relocations, so they only need to be linked again. Entries are
+    # written to a temporary file that is renamed into place, so concurrent builds only ever read whole entries.
+    # A hit refreshes the modification time of the entry, the oldest entries are evicted first once the total size
+    # goes over maxsize bytes.
+    def __init__(self, directory, maxsize):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._maxsize = maxsize
+        self._version = _get_assembler_version()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._size = sum(size for path, size, modified in self._scan())
+
+    def get_key(self, section_name, lines, optimize=False):
+        digest = hashlib.sha256(self._version)
+        digest.update(section_name.encode("utf-8") + (b"\1" if optimize else b"\0"))
+        for line in lines:
+            digest.update(line.rstrip("\r\n").encode("utf-8") + b"\n")
+        return digest.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, key[:2], key[2:] + ".section")
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as file:
+                entry = pickle.load(file)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            with self._lock:
+                self._misses += 1
+            return None
+        with self._lock:
+            self._hits += 1
+        return entry
+
+    def put(self, key, entry):
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(data)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+        with self._lock:
+            self._size += len(data)
+            full = self._size > self._maxsize
+        if full:
+            self._evict()
+
+    def _scan(self):
+        for directory in os.scandir(self._directory):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".section"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        # Other builders may share the directory, so the real contents are scanned rather than trusting the size
+        # this process has seen
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        evictions = 0
+        for path, entry_size, modified in entries:
+            if size <= self._maxsize:
+                break
+            try:
+                os.remove(path)
+                evictions += 1
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        with self._lock:
+            self._size = size
+            self._evictions += evictions
+
+    def info(self):
+        with self._lock:
+            return MipsSectionCacheInfo(self._hits, self._misses, self._evictions, self._size, self._maxsize)
+
+
+_section_cache = None
+
+
+def enable_section_cache(directory, maxsize=1 << 30):
+    global _section_cache
+    _section_cache = _MipsSectionCache(directory, maxsize)
+
+
+def disable_section_cache():
+    global _section_cache
+    _section_cache = None
+
+
+def section_cache_info():
+    if _section_cache is None:
+        return None
+    return _section_cache.info()
+
+
+# One match splits a whole line into its labels, its statement head (a mnemonic or a directive), the operands of the
+# statement and its comment. Everything before a colon that isn't inside a string or a comment is a label, "#"
+# outside of a string starts a comment, and backslashes escape the next character inside strings. An unterminated
+# string runs to the end of the line.
+_LINE = re.compile(r"""
+    \s*
+    (?P<labels>(?:[^\s:#".][^:#"]*:\s*)*)
+    (?:
+        (?P<head>[^\s#"]+)\s*
+        (?P<operands>(?:"(?:[^"\\]|\\.)*"|[^#"])*(?:".*)?)
+    )?
+    (?:\#.*)?
+""", re.VERBOSE | re.DOTALL)
+_LABEL = re.compile(r"([^:]*):\s*")
+_DIRECTIVE_OPERAND = re.compile(r"""\s*((?:"(?:[^"\\]|\\.)*"?|[^,"])*?)\s*(?:,|$)""", re.DOTALL)
+
+
+def _tokenize_line(line):
+    # Turns a source line into (kind, text, column) tokens: any number of "label" tokens followed by an optional
+    # "directive" or "mnemonic" token and, when the statement has operands, an "operands" token whose text is the
+    # list of operands and whose column is where the first one starts
+    match = _LINE.match(line)
+    tokens = []
+
+    labels = match.group("labels")
+    if labels:
+        start = match.start("labels")
+        for label in _LABEL.finditer(labels):
+            tokens.append(("label", label.group(1), start + label.start()))
+
+    head = match.group("head")
+    if head is None:
+        return tokens
+    operands = match.group("operands").rstrip()
+    if head[0] == ".":
+        tokens.append(("directive", head, match.start("head")))
+        if operands:
+            arguments = []
+            for operand in _DIRECTIVE_OPERAND.finditer(operands):
+                arguments.append(operand.group(1))
+                if operand.end() == len(operands):
+                    # A trailing comma leaves an empty last operand, rejected like an empty one in the middle
+                    if operand.end(1) < operand.end() and operands[-1] == ",":
+                        arguments.append("")
+                    break
+            tokens.append(("operands", arguments, match.start("operands")))
+    else:
+        tokens.append(("mnemonic", head, match.start("head")))
+        if operands:
+            tokens.append(("operands", [operand.strip() for operand in operands.split(",")], match.start("operands")))
+    return tokens
+
+
+class _MipsStats(object):
+    # Collects timings for MipsAssembler(stats=True). Phase times are summed seconds, parse_instruction includes
+    # the time spent in parse_expressions. Top level operations are also kept as Chrome trace events.
+    def __init__(self, slowest_lines=20):
+        self._phases = collections.defaultdict(float)
+        self._mnemonic_counts = collections.Counter()
+        self._mnemonic_seconds = collections.defaultdict(float)
+        self._lines = 0
+        self._slowest_lines_size = slowest_lines
+        self._slowest_lines = []
+        self._events = []
+        self._origin = time.perf_counter()
+        self._expression_cache_start = _compile_expression.cache_info()
+
+    def add_phase(self, phase, seconds):
+        self._phases[phase] += seconds
+
+    def add_instruction(self, mnemonic, seconds):
+        self._phases["parse_instruction"] += seconds
+        self._mnemonic_counts[mnemonic] += 1
+        self._mnemonic_seconds[mnemonic] += seconds
+
+    def add_line(self, line, seconds):
+        self._lines += 1
+        entry = (seconds, self._lines, line.strip())
+        if len(self._slowest_lines) < self._slowest_lines_size:
+            heapq.heappush(self._slowest_lines, entry)
+        elif seconds > self._slowest_lines[0][0]:
+            heapq.heapreplace(self._slowest_lines, entry)
+
+    def add_event(self, name, start, end, **args):
+        self._phases[name] += end - start
+        self._events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                             "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6, "args": args})
+
+    def get_stats(self):
+        expression_cache = _compile_expression.cache_info()
+        hits = expression_cache.hits - self._expression_cache_start.hits
+        misses = expression_cache.misses - self._expression_cache_start.misses
+        stats = {
+            "lines": self._lines,
+            "phases": dict(self._phases),
+            "mnemonics": {mnemonic: {"count": count, "seconds": self._mnemonic_seconds[mnemonic]}
+                          for mnemonic, count in self._mnemonic_counts.most_common()},
+            "expression_cache": {"hits": hits, "misses": misses,
+                                 "hit_rate": hits / (hits + misses) if hits + misses > 0 else None},
+            "slowest_lines": [{"line": line, "seconds": seconds, "source": source}
+                              for seconds, line, source in sorted(self._slowest_lines, reverse=True)],
+        }
+        line_cache = line_cache_info()
+        if line_cache is not None:
+            stats["line_cache"] = line_cache._asdict()
+        return stats
+
+    def write_trace(self, path):
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self._events, "displayTimeUnit": "ms"}, file)
+
+
+# Lines handed to each parser worker process at a time when parsing in parallel
+_PARALLEL_CHUNK_SIZE = 8192
+
+
+def _parse_chunk(lines, first_line_number, collect_errors):
+    # Returns a (line number, column, items) entry for every line that has items, and the errors
+    parser = MipsAssembler(collect_errors=collect_errors)
+    parsed_lines = []
+    for line_number, line in enumerate(lines, first_line_number):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        parsed_items, column = parser._parse_line(line, line_number)
+        if parsed_items:
+            parsed_lines.append((line_number, column, parsed_items))
+    return parsed_lines, parser.get_errors()
+
+
+# The most buffers handed to a single os.writev call
+_WRITEV_BATCH = 1024
+
+
+class _MipsOutput(object):
+    # A sequential binary output over a file object or a file descriptor. When there is a descriptor the buffers
+    # are gathered and handed to os.writev in batches instead of being copied together, and zero runs are seeked
+    # over whenever the output can seek.
+    def __init__(self, file):
+        self._file = file
+        self._fd = None
+        if isinstance(file, int):
+            self._fd = file
+        elif hasattr(os, "writev"):
+            try:
+                self._fd = file.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                pass
+            else:
+                file.flush()
+
+        if self._fd is None:
+            self._seekable = file.seekable()
+        else:
+            try:
+                os.lseek(self._fd, 0, os.SEEK_CUR)
+                self._seekable = True
+            except OSError:
+                self._seekable = False
+
+        self._pending = []
+        self._position = 0
+
+    def get_position(self):
+        return self._position
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        self._position += len(data)
+        if self._fd is None:
+            self._file.write(data)
+            return
+        self._pending.append(data)
+        if len(self._pending) >= _WRITEV_BATCH:
+            self._flush()
+
+    def skip(self, size):
+        # Writes size zero bytes. The last one is always written so a seek past the end still grows the file.
+        if size <= 0:
+            return
+        if not self._seekable:
+            while size > 0:
+                block = min(size, len(_ZERO_BLOCK))
+                self.write(_ZERO_BLOCK[:block])
+                size -= block
+            return
+        if self._fd is None:
+            self._file.seek(size - 1, io.SEEK_CUR)
+        else:
+            self._flush()
+            os.lseek(self._fd, size - 1, os.SEEK_CUR)
+        self._position += size - 1
+        self.write(b"\0")
+
+    def _flush(self):
+        buffers = self._pending
+        self._pending = []
+        while len(buffers) > 0:
+            written = os.writev(self._fd, buffers)
+            index = 0
+            while index < len(buffers) and written >= len(buffers[index]):
+                written -= len(buffers[index])
+                index += 1
+            buffers = buffers[index:]
+            if written > 0:
+                buffers[0] = memoryview(buffers[0])[written:]
+
+    def close(self):
+        # Returns the number of bytes written. A file object written through its descriptor is seeked to where the
+        # descriptor ended up, so its own idea of the position stays right.
+        if self._fd is not None:
+            self._flush()
+            if self._seekable and not isinstance(self._file, int):
+                self._file.seek(0, io.SEEK_CUR)
+        return self._position
+
+
+def _write_section(output, section, labels):
+    position = 0
+    for chunk_offset, chunk in section.iter_chunks(labels):
+        output.skip(chunk_offset - position)
+        output.write(chunk)
+        position = chunk_offset + len(chunk)
+    output.skip(section.get_size() - position)
+
+
+def _iter_section_blocks(section, labels):
+    # Yields (address, bytes) for every part of the section that holds bytes. The zero-fill runs of .space and .align
+    # are left out, every HEX and S-record line carries its address so the records simply resume after a gap.
+    address = section.get_address()
+    for chunk_offset, chunk in section.iter_chunks(labels):
+        if len(chunk) > 0:
+            yield address + chunk_offset, chunk
+
+
+def _write_raw(output, sections, labels, entry):
+    # A memory image from the start of the first section to the end of the last one, the gaps between them zeroed
+    position = None
+    for section in sections:
+        if section.get_size() == 0:
+            continue
+        if position is not None:
+            output.skip(section.get_address() - position)
+        _write_section(output, section, labels)
+        position = section.get_address() + section.get_size()
+
+
+# Data bytes in every Intel HEX and S-record line
+_RECORD_SIZE = 16
+
+
+def _hex_record(record_type, address, data):
+    record = bytes((len(data), (address >> 8) & 0xFF, address & 0xFF, record_type)) + bytes(data)
+    return ":{}{:02X}\n".format(record.hex().upper(), -sum(record) & 0xFF)
+
+
+def _write_hex(output, sections, labels, entry):
+    # Intel HEX with 32 bit addresses, an extended linear address record is emitted whenever the upper half changes
+    upper_address = 0
+    for section in sections:
+        for address, block in _iter_section_blocks(section, labels):
+            lines = []
+            position = 0
+            while position < len(block):
+                if address >> 16 != upper_address:
+                    upper_address = address >> 16
+                    lines.append(_hex_record(0x04, 0, _HALF_WORD.pack(upper_address)))
+                size = min(_RECORD_SIZE, len(block) - position, 0x10000 - (address & 0xFFFF))
+                lines.append(_hex_record(0x00, address, block[position:position + size]))
+                position += size
+                address += size
+            output.write("".join(lines).encode("ascii"))
+    output.write((_hex_record(0x05, 0, _WORD.pack(entry)) + _hex_record(0x01, 0, b"")).encode("ascii"))
+
+
+def _srec_record(record_type, address, address_size, data):
+    record = bytes((address_size + len(data) + 1,)) + address.to_bytes(address_size, "big") + bytes(data)
+    return "S{}{}{:02X}\n".format(record_type, record.hex().upper(), ~sum(record) & 0xFF)
+
+
+def _write_srec(output, sections, labels, entry):
+    # Motorola S-records with 32 bit addresses: an S0 header, S3 data records and an S7 record holding the entry
+    output.write(_srec_record(0, 0, 2, b"").encode("ascii"))
+    for section in sections:
+        for address, block in _iter_section_blocks(section, labels):
+            output.write("".join([_srec_record(3, address + position, 4, block[position:position + _RECORD_SIZE])
+                                  for position in range(0, len(block), _RECORD_SIZE)]).encode("ascii"))
+    output.write(_srec_record(7, entry, 4, b"").encode("ascii"))
+
+
+_ELF_HEADER = struct.Struct(">16sHHIIIIIHHHHHH")
+_ELF_PROGRAM_HEADER = struct.Struct(">IIIIIIII")
+_ELF_SECTION_HEADER = struct.Struct(">IIIIIIIIII")
+_ELF_SYMBOL = struct.Struct(">IIIBBH")
+
+_ELF_IDENT = b"\x7fELF\x01\x02\x01"  # 32 bit, big endian, version 1
+_ET_EXEC = 2
+_EM_MIPS = 8
+_EF_MIPS_ARCH_32 = 0x50000000
+_PT_LOAD = 1
+_PF_X, _PF_W, _PF_R = 0x1, 0x2, 0x4
+_SHT_PROGBITS, _SHT_SYMTAB, _SHT_STRTAB = 1, 2, 3
+_SHF_WRITE, _SHF_ALLOC, _SHF_EXECINSTR = 0x1, 0x2, 0x4
+_STB_GLOBAL = 1
+
+
+def _write_elf(output, sections, labels, entry):
+    # A MIPS32 big endian executable. Every section gets a section header and, unless it is empty, a loadable
+    # segment, and every label becomes a global symbol of the section it is defined in.
+    loaded = [section for section in sections if section.get_size() > 0]
+
+    section_names = bytearray(b"\0")
+    section_name_offsets = []
+    for name in [section.get_name() for section in sections] + [".symtab", ".strtab", ".shstrtab"]:
+        section_name_offsets.append(len(section_names))
+        section_names += name.encode("utf-8") + b"\0"
+
+    symbol_names = bytearray(b"\0")
+    symbols = [_ELF_SYMBOL.pack(0, 0, 0, 0, 0, 0)]
+    for index, section in enumerate(sections, 1):
+        # The labels as placed by the link, relaxing the section on its own would need the labels of the others
+        for label, address in sorted(section.get_labels({}).items(), key=lambda item: item[1]):
+            symbols.append(_ELF_SYMBOL.pack(len(symbol_names), address, 0, _STB_GLOBAL << 4, 0, index))
+            symbol_names += label.encode("utf-8") + b"\0"
+
+    # Section contents start on their own alignment, which their addresses share, as loadable segments require
+    offset = _ELF_HEADER.size + _ELF_PROGRAM_HEADER.size * len(loaded)
+    section_offsets = []
+    for section in sections:
+        alignment = section.get_alignment()
+        offset = (offset + alignment - 1) // alignment * alignment
+        section_offsets.append(offset)
+        offset += section.get_size()
+    symbols_offset = (offset + 3) & ~3
+    symbol_names_offset = symbols_offset + _ELF_SYMBOL.size * len(symbols)
+    section_names_offset = symbol_names_offset + len(symbol_names)
+    section_headers_offset = (section_names_offset + len(section_names) + 3) & ~3
+
+    headers = [_ELF_HEADER.pack(_ELF_IDENT, _ET_EXEC, _EM_MIPS, 1, entry, _ELF_HEADER.size,
+                                section_headers_offset, _EF_MIPS_ARCH_32, _ELF_HEADER.size,
+                                _ELF_PROGRAM_HEADER.size, len(loaded), _ELF_SECTION_HEADER.size, len(sections) + 4,
+                                len(sections) + 3)]
+    for section, section_offset in zip(sections, section_offsets):
+        if section.get_size() > 0:
+            flags = _PF_R | (_PF_X if section.has_instructions() else _PF_W)
+            headers.append(_ELF_PROGRAM_HEADER.pack(_PT_LOAD, section_offset, section.get_address(),
+                                                    section.get_address(), section.get_size(), section.get_size(),
+                                                    flags, section.get_alignment()))
+    output.write(b"".join(headers))
+
+    for section, section_offset in zip(sections, section_offsets):
+        output.skip(section_offset - output.get_position())
+        _write_section(output, section, labels)
+
+    output.skip(symbols_offset - output.get_position())
+    output.write(b"".join(symbols))
+    output.write(symbol_names)
+    output.write(section_names)
+    output.skip(section_headers_offset - output.get_position())
+
+    headers = [_ELF_SECTION_HEADER.pack(0, 0, 0, 0, 0, 0, 0, 0, 0, 0)]
+    for name_offset, section, section_offset in zip(section_name_offsets, sections, section_offsets):
+        flags = _SHF_ALLOC | (_SHF_EXECINSTR if section.has_instructions() else _SHF_WRITE)
+        headers.append(_ELF_SECTION_HEADER.pack(name_offset, _SHT_PROGBITS, flags, section.get_address(),
+                                                section_offset, section.get_size(), 0, 0, section.get_alignment(),
+                                                0))
+    headers.append(_ELF_SECTION_HEADER.pack(section_name_offsets[-3], _SHT_SYMTAB, 0, 0, symbols_offset,
+                                            _ELF_SYMBOL.size * len(symbols), len(sections) + 2, 1, 4,
+                                            _ELF_SYMBOL.size))
+    headers.append(_ELF_SECTION_HEADER.pack(section_name_offsets[-2], _SHT_STRTAB, 0, 0, symbol_names_offset,
+                                            len(symbol_names), 0, 0, 1, 0))
+    headers.append(_ELF_SECTION_HEADER.pack(section_name_offsets[-1], _SHT_STRTAB, 0, 0, section_names_offset,
+                                            len(section_names), 0, 0, 1, 0))
+    output.write(b"".join(headers))
+
+
+_OUTPUT_WRITERS = {
+    "raw": _write_raw,
+    "hex": _write_hex,
+    "srec": _write_srec,
+    "elf": _write_elf,
+}
+
+
 class MipsAssembler(object):
-    def __init__(self, code=None):
+    # Everything a run needs lives on the instance, so separate assemblers can be used from separate threads.
+    # With collect_errors=True a line that fails to parse is recorded and skipped instead of raising, every error
+    # is then available from get_errors() and link() refuses to link the program.
+    # With optimize=True the instructions added in .set reorder mode go through the peephole rules, the rewrites
+    # that were applied are listed by get_rewrites().
+    def __init__(self, code=None, workers=None, stats=False, collect_errors=False, optimize=False):
         self._default_section = ".text"
         self._default_reorder = True
+        self._reorder = True
+        self._workers = workers
+        self._stats = _MipsStats() if stats else None
+        self._errors = [] if collect_errors else None
+        self._rewrites = [] if optimize else None
+        self._peepholes = {}
 
         self._sections = {}
+        self._labels = {}
+        self._layout = []
+        self._placement = (None, 0)
 
         if code is not None:
             self.add(code)
 
-    @staticmethod
-    def _strip_comments(line):
-        i = 0
-        in_quotes = False
-        while i < len(line):
-            if line[i] == "\"":
-                in_quotes = not in_quotes
-            elif line[i] == "\\" and in_quotes:
-                i += 1
-            elif line[i] == "#":
-                line = line[:i]
-            i += 1
-        return line
-
-    def _parse_line(self, line):
-        MipsParsingError.current_parsed_line = line
-        line = line.strip()
-        line = self._strip_comments(line)
-
+    def _parse_line(self, line, line_number=None):
+        # Returns the items parsed from the line and the column their statement starts at, counted from 1
+        try:
+            cache = _line_cache
+            if cache is None:
+                return self._parse_tokens(self._tokenize(line))
+
+            # The cache keeps the column counted from the first character of the stripped line
+            key = line.strip()
+            indent = len(line) - len(line.lstrip())
+            parsed = cache.get(key)
+            if parsed is None:
+                parsed_items, column = self._parse_tokens(self._tokenize(line))
+                parsed = (tuple(parsed_items), column - indent)
+                cache.put(key, parsed)
+            return parsed[0], parsed[1] + indent
+        except MipsParsingError as error:
+            error.set_location(line.rstrip("\r\n"), line_number)
+            if self._errors is None:
+                raise
+            self._errors.append(error)
+            return (), 0
+
+    def _tokenize(self, line):
+        stats = self._stats
+        if stats is None:
+            return _tokenize_line(line)
+        start = time.perf_counter()
+        tokens = _tokenize_line(line)
+        stats.add_phase("tokenize", time.perf_counter() - start)
+        return tokens
+
+    def _parse_tokens(self, tokens):
+        # Returns the parsed items and the column of the statement, or of the first label on a line without one
+        stats = self._stats
         parsed_items = []
-        while len(line) > 0:
-            if line.startswith("."):
-                parsed_items.append(_MipsDirective(line))
-                line = ""
-            elif ":" in line:
-                parts = line.split(":", maxsplit=1)
-                parsed_items.append(_MipsLabel(parts[0]))
-                line = parts[1].strip()
-            else:
-                parsed_items.append(_MipsAssembly(line))
-                line = ""
+        statement_column = tokens[0][2] + 1 if len(tokens) > 0 else 1
+        for kind, text, column in tokens:
+            try:
+                if kind == "label":
+                    parsed_items.append(_MipsLabel(text))
+                    continue
+                elif kind == "operands":
+                    break
+
+                statement_column = column + 1
+                arguments = tokens[-1][1] if tokens[-1][0] == "operands" else []
+                if kind == "directive":
+                    parsed_items.append(_MipsDirective(text, arguments))
+                elif text in _PSEUDO_INSTRUCTIONS:
+                    if stats is None:
+                        parsed_items.extend(_PSEUDO_INSTRUCTIONS[text](text, arguments))
+                    else:
+                        start = time.perf_counter()
+                        parsed_items.extend(_PSEUDO_INSTRUCTIONS[text](text, arguments))
+                        stats.add_instruction(text, time.perf_counter() - start)
+                elif stats is None:
+                    parsed_items.append(_MipsAssembly(text, arguments))
+                else:
+                    start = time.perf_counter()
+                    item = _MipsAssembly(text, arguments, stats)
+                    stats.add_instruction(item.get_mnemonic(), time.perf_counter() - start)
+                    parsed_items.append(item)
+            except MipsParsingError as error:
+                error.set_location(column=column + 1)
+                raise
 
-        return parsed_items
+        return parsed_items, statement_column
 
-    def _add_to_section(self, section, item):
+    def _add_to_section(self, section, item, location=None):
         if section not in self._sections.keys():
             self._sections[section] = _MipsSection(section)
-        self._sections[section].add(item)
-
-    def add(self, code):
+        if self._rewrites is None:
+            self._sections[section].add(item, self._reorder, location)
+            return
+        if section not in self._peepholes:
+            self._peepholes[section] = _MipsPeephole(self._sections[section], self._rewrites)
+        self._peepholes[section].add(item, self._reorder, location)
+
+    def add(self, code, file_name=None):
+        self.add_stream(code.split("\n"), file_name)
+
+    def add_stream(self, lines, file_name=None):
+        # Accepts any iterable of str or bytes lines, such as an open file, as well as a memory-mapped file.
+        # Lines are parsed one at a time, so only the parsed items are kept alive, never the source text.
+        # Every item remembers the line and column it came from, along with the file name given here.
+        if isinstance(lines, mmap.mmap):
+            lines = iter(lines.readline, b"")
+
+        stats = self._stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        # Like the current section, .set reorder and noreorder hold from where they appear to the end of the stream.
+        # Nothing is moved across streams either, which keeps the section cache's output the same.
+        self._reorder = self._default_reorder
+        for section in self._sections.values():
+            section.end_scheduling_block()
+        if _section_cache is not None:
+            self._add_stream_cached(_section_cache, lines, file_name)
+        elif self._workers is not None and self._workers > 1:
+            self._add_stream_parallel(lines, file_name)
+        elif stats is None:
+            current_section = self._default_section
+            for line_number, line in enumerate(lines, 1):
+                if isinstance(line, bytes):
+                    line = line.decode("utf-8")
+                parsed_items, column = self._parse_line(line, line_number)
+                if parsed_items:
+                    current_section = self._add_parsed(parsed_items, current_section,
+                                                       (file_name, line_number, column))
+        else:
+            current_section = self._default_section
+            for line_number, line in enumerate(lines, 1):
+                line_start = time.perf_counter()
+                if isinstance(line, bytes):
+                    line = line.decode("utf-8")
+                parsed_items, column = self._parse_line(line, line_number)
+                if parsed_items:
+                    current_section = self._add_parsed(parsed_items, current_section,
+                                                       (file_name, line_number, column))
+                stats.add_line(line, time.perf_counter() - line_start)
+
+        for peephole in self._peepholes.values():
+            peephole.flush()
+
+        if stats is not None:
+            stats.add_event("add", start, time.perf_counter(), workers=self._workers)
+
+    def _add_stream_parallel(self, lines, file_name):
+        # Lines parse independently, so chunks are parsed in worker processes and their items are added here
+        # in source order, which is the only place section switches and label order matter.
+        # The number of chunks in flight is bounded so memory stays proportional to the output.
         current_section = self._default_section
+        lines = iter(lines)
+        line_number = 1
+        pending = collections.deque()
+        with concurrent.futures.ProcessPoolExecutor(self._workers) as executor:
+            while True:
+                chunk = list(itertools.islice(lines, _PARALLEL_CHUNK_SIZE))
+                if len(chunk) == 0:
+                    break
+                pending.append(executor.submit(_parse_chunk, chunk, line_number, self._errors is not None))
+                line_number += len(chunk)
+                if len(pending) >= 2 * self._workers:
+                    current_section = self._add_parsed_chunk(pending.popleft().result(), current_section, file_name)
+            while len(pending) > 0:
+                current_section = self._add_parsed_chunk(pending.popleft().result(), current_section, file_name)
+
+    def _add_stream_cached(self, cache, lines, file_name):
+        # The lines are looked up in the section cache one run at a time, a run being the lines from one section
+        # switch to the next, so only the lines of the current run are ever held. A .section line ends the run of the
+        # section it switches away from, which is where any labels in front of it belong. Each line is keyed with the
+        # reorder mode it starts in, since a .set carries over to the lines after it.
+        executor = None
+        if self._workers is not None and self._workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(self._workers)
+        try:
+            current_section = self._default_section
+            reorder = self._reorder
+            first_line_number = 1
+            keyed_lines = []
+            for line_number, line in enumerate(lines, 1):
+                if isinstance(line, bytes):
+                    line = line.decode("utf-8")
+                keyed_lines.append(("+" if reorder else "-") + line)
+                if ".set" in line:
+                    reorder = (self._get_directive_arguments(line, ".set")
+                               or ("reorder" if reorder else "noreorder")) == "reorder"
+                if ".section" in line:
+                    section_name = self._get_directive_arguments(line, ".section")
+                    if section_name is not None:
+                        self._add_cached_run(cache, current_section, first_line_number, keyed_lines, file_name,
+                                             executor)
+                        current_section = section_name
+                        first_line_number = line_number + 1
+                        keyed_lines = []
+            self._add_cached_run(cache, current_section, first_line_number, keyed_lines, file_name, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _add_cached_run(self, cache, section_name, first_line_number, keyed_lines, file_name, executor):
+        key = cache.get_key(section_name, keyed_lines, self._rewrites is not None)
+        entry = cache.get(key)
+        if entry is None:
+            error_count = len(self._errors) if self._errors is not None else 0
+            entry = self._parse_fragment(section_name, first_line_number, keyed_lines, executor)
+            if self._errors is None or len(self._errors) == error_count:
+                cache.put(key, entry)
+        elif self._stats is not None:
+            # The lines of a hit take no time to parse but still count, which keeps the line numbers right
+            for keyed_line in keyed_lines:
+                self._stats.add_line(keyed_line[1:], 0.0)
+        section, first_item_index, rewrites = entry
+        section.set_source(file_name, range(first_line_number, first_line_number + len(keyed_lines)))
+        if self._rewrites is not None:
+            self._rewrites.extend(rewrites)
+        if first_item_index is None:
+            return
+        # Sections are created in the order their first item appears in the source, as they are without the cache
+        if section_name in self._sections:
+            self._sections[section_name].extend(section)
+        else:
+            self._sections[section_name] = section
 
-        code = code.split("\n")
-        for line in code:
-            parsed = self._parse_line(line)
-            for item in parsed:
+    @staticmethod
+    def _get_directive_arguments(line, directive):
+        # The arguments of the directive on the line, or None when the line holds no valid one
+        tokens = _tokenize_line(line)
+        for kind, text, column in tokens:
+            if kind == "directive" and text == directive:
+                try:
+                    return _MipsDirective(text, tokens[-1][1] if tokens[-1][0] == "operands" else []).get_arguments()
+                except MipsParsingError:
+                    # Reported when the line is parsed along with the rest of its run
+                    return None
+        return None
+
+    def _parse_fragment(self, section_name, first_line_number, keyed_lines, executor=None):
+        # Returns the section parsed from the keyed lines of a run, the index of the first line that added something
+        # to it and the peephole rewrites applied to it. The section's locations count the lines of the run, see
+        # set_source.
+        section = _MipsSection(section_name)
+        rewrites = []
+        target = section if self._rewrites is None else _MipsPeephole(section, rewrites)
+        first_item_index = None
+        for index, column, parsed_items in self._parse_run(first_line_number, keyed_lines, executor):
+            reorder = keyed_lines[index][0] == "+"
+            location = (None, index + 1, column)
+            for item in parsed_items:
                 if type(item) is _MipsDirective and item.get_directive() == ".section":
-                    current_section = item.get_arguments()
-                else:
-                    self._add_to_section(current_section, item)
+                    continue
+                if type(item) is _MipsDirective and item.get_directive() == ".set":
+                    reorder = item.get_arguments() == "reorder"
+                if first_item_index is None:
+                    first_item_index = index
+                target.add(item, reorder, location)
+        if target is not section:
+            target.flush()
+        section.prepare()
+        return section, first_item_index, rewrites
+
+    def _parse_run(self, first_line_number, keyed_lines, executor):
+        # Yields (index, column, items) for the lines of a run that have items, parsed in the worker processes when
+        # the run is longer than a chunk
+        if executor is not None and len(keyed_lines) > _PARALLEL_CHUNK_SIZE:
+            starts = range(0, len(keyed_lines), _PARALLEL_CHUNK_SIZE)
+            chunks = [[keyed_line[1:] for keyed_line in keyed_lines[start:start + _PARALLEL_CHUNK_SIZE]]
+                      for start in starts]
+            for parsed_lines, errors in executor.map(_parse_chunk, chunks,
+                                                     [first_line_number + start for start in starts],
+                                                     itertools.repeat(self._errors is not None)):
+                if errors is not None:
+                    self._errors.extend(errors)
+                for line_number, column, parsed_items in parsed_lines:
+                    yield line_number - first_line_number, column, parsed_items
+            if self._stats is not None:
+                for keyed_line in keyed_lines:
+                    self._stats.add_line(keyed_line[1:], 0.0)
+            return
+
+        stats = self._stats
+        for index, keyed_line in enumerate(keyed_lines):
+            if stats is not None:
+                line_start = time.perf_counter()
+            parsed_items, column = self._parse_line(keyed_line[1:], first_line_number + index)
+            if stats is not None:
+                stats.add_line(keyed_line[1:], time.perf_counter() - line_start)
+            if parsed_items:
+                yield index, column, parsed_items
+
+    def _add_parsed_chunk(self, result, current_section, file_name):
+        parsed_lines, errors = result
+        if errors is not None:
+            self._errors.extend(errors)
+        for line_number, column, parsed_items in parsed_lines:
+            current_section = self._add_parsed(parsed_items, current_section, (file_name, line_number, column))
+        return current_section
+
+    def _end_scheduling_block(self, section):
+        # Nothing is moved across a section switch, so that the section cache can keep each run of lines between
+        # two switches on its own
+        if section in self._peepholes:
+            self._peepholes[section].flush()
+        if section in self._sections:
+            self._sections[section].end_scheduling_block()
+
+    def _add_parsed(self, parsed, current_section, location=None):
+        for item in parsed:
+            if type(item) is _MipsDirective and item.get_directive() == ".section":
+                self._end_scheduling_block(current_section)
+                current_section = item.get_arguments()
+            else:
+                if type(item) is _MipsDirective and item.get_directive() == ".set":
+                    self._reorder = item.get_arguments() == "reorder"
+                self._add_to_section(current_section, item, location)
+        return current_section
+
+    def link(self, layout=None, address=0):
+        # Places every section in memory and encodes it once against a single symbol table holding every label.
+        # The layout lists sections in the order they are placed, either by name or as a dict with a "name" and
+        # optionally a fixed "address" and an "align"ment. Sections missing from the layout follow in the order
+        # they were first used.
+        self._place(layout, address)
+
+        stats = self._stats
+        if stats is None:
+            return {section.get_name(): section.compile(self._labels) for section in self._layout}
+
+        compiled_sections = {}
+        for section in self._layout:
+            start = time.perf_counter()
+            compiled_sections[section.get_name()] = section.compile(self._labels)
+            stats.add_event("encode", start, time.perf_counter(), section=section.get_name())
+        return compiled_sections
+
+    def _place(self, layout, address):
+        if self._errors:
+            raise MipsCompileError("The program has {} errors:\n{}".format(
+                len(self._errors), "\n".join(str(error) for error in self._errors)))
+
+        entries = []
+        for entry in layout or []:
+            if isinstance(entry, str):
+                entry = {"name": entry}
+            if entry["name"] not in self._sections:
+                raise MipsCompileError("The section '{}' in the layout doesn't exist".format(entry["name"]))
+            entries.append(entry)
+        placed = set(entry["name"] for entry in entries)
+        entries += [{"name": name} for name in self._sections if name not in placed]
+
+        stats = self._stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        self._placement = (layout, address)
+        relaxable = []
+        for entry in entries:
+            section = self._sections[entry["name"]]
+            section.reset_relaxation()
+            relaxable.extend((section, item) for item in section.get_relaxable_items())
+
+        self._place_entries(entries, address)
+        if len(relaxable) > 0:
+            self._relax(entries, address, relaxable)
+
+        if stats is not None:
+            stats.add_event("layout", start, time.perf_counter(), sections=len(self._layout))
+
+    def _place_entries(self, entries, address):
+        self._labels = {}
+        self._layout = []
+        for entry in entries:
+            section = self._sections[entry["name"]]
+            align = max(entry.get("align", 4), section.get_alignment())
+            if "address" in entry:
+                if entry["address"] < address:
+                    raise MipsCompileError("The section '{}' at address {:#x} overlaps the previous section"
+                                           .format(entry["name"], entry["address"]))
+                address = entry["address"]
+            address = (address + align - 1) // align * align
+
+            section.set_address(address)
+            section.get_labels(self._labels)
+            self._layout.append(section)
+            address += section.get_size()
+
+    def _relax(self, entries, address, relaxable):
+        # Pseudo-instructions start out at their shortest expansion and only ever grow, so this reaches a fixed
+        # point. After each round of growth only the items referring to a label that moved are looked at again.
+        dependents = collections.defaultdict(list)
+        for section, item in relaxable:
+            for label in item.get_labels():
+                dependents[label].append((section, item))
+
+        worklist = relaxable
+        while len(worklist) > 0:
+            grown_sections = set()
+            for section, item in worklist:
+                if item.relax(self._labels):
+                    grown_sections.add(section)
+            if len(grown_sections) == 0:
+                break
+            for section in grown_sections:
+                section.invalidate_layout()
+
+            previous_labels = self._labels
+            self._place_entries(entries, address)
+            pending = {}
+            for label, value in self._labels.items():
+                if previous_labels.get(label) != value:
+                    for section, item in dependents.get(label, ()):
+                        if item.can_grow():
+                            pending[id(item)] = (section, item)
+            worklist = list(pending.values())
+
+    def write(self, file, output_format="raw", layout=None, address=None, entry=None):
+        # Streams the linked program to a binary file object or a file descriptor, one section at a time, as a
+        # "raw" memory image starting at the first section, an Intel "hex" or Motorola "srec" file or an "elf"
+        # executable. Sections are placed as by the last link() unless a layout or address is given. The entry point
+        # is a label or an address and defaults to the first section.
+        if output_format not in _OUTPUT_WRITERS:
+            raise ValueError("Unknown output format '{}', expected one of {}"
+                             .format(output_format, ", ".join(sorted(_OUTPUT_WRITERS))))
+        if layout is None and address is None:
+            layout, address = self._placement
+        self._place(layout, address or 0)
+
+        if entry is None:
+            entry = self._layout[0].get_address() if len(self._layout) > 0 else 0
+        elif isinstance(entry, str):
+            if entry not in self._labels:
+                raise MipsCompileError("The entry point label '{}' doesn't exist".format(entry))
+            entry = self._labels[entry]
+
+        stats = self._stats
+        if stats is not None:
+            start = time.perf_counter()
+        output = _MipsOutput(file)
+        _OUTPUT_WRITERS[output_format](output, self._layout, self._labels, entry)
+        size = output.close()
+        if stats is not None:
+            stats.add_event("write", start, time.perf_counter(), format=output_format, size=size)
+        return size
+
+    def get_labels(self):
+        return self._labels
+
+    def get_rewrites(self):
+        # The MipsPeepholeRewrite of every rewrite applied with optimize=True, in source order within each section,
+        # or None without it
+        return self._rewrites
+
+    def get_errors(self):
+        # The parsing errors recorded with collect_errors=True, in source order, or None without it
+        return self._errors
+
+    def get_sections(self):
+        return self._layout
+
+    def _get_placed_sections(self):
+        if len(self._layout) == 0 and len(self._sections) > 0:
+            self._place(*self._placement)
+        return self._layout
+
+    def get_source_location(self, address):
+        # The MipsSourceLocation the byte at an address was assembled from, or None. Sections are placed as by the
+        # last link() or write().
+        for section in self._get_placed_sections():
+            offset = address - section.get_address()
+            if 0 <= offset < section.get_size():
+                return section.get_line_table().lookup(offset)
+        return None
+
+    def get_source_addresses(self, line, file_name=None):
+        # The (start, end) address ranges of the bytes assembled from a source line, in order of address
+        ranges = []
+        for section in self._get_placed_sections():
+            address = section.get_address()
+            ranges.extend((address + start, address + end)
+                          for start, end in section.get_line_table().find(file_name, line))
+        return ranges
+
+    def iter_listing(self, sources=None):
+        # Yields the lines of a listing that puts the address and the bytes of every source line next to its text,
+        # one section at a time. sources maps a file name to its text or its list of lines, the files missing from
+        # it are read from disk when they can be. A run of zero words is shown as a single "*".
+        sources = dict(sources or {})
+        for section in self._get_placed_sections():
+            address = section.get_address()
+            yield "{} at {:#010x}, {} bytes\n".format(section.get_name(), address, section.get_size())
+            image = section.compile(self._labels)
+            for start, end, file_name, line, column in section.get_line_table():
+                location = "{}:{}:{}".format(file_name if file_name is not None else "", line, column)
+                text = self._get_source_line(sources, file_name, line)
+                previous = None
+                skipping = False
+                for offset in range(start, end, 4):
+                    word = image[offset:min(offset + 4, end)]
+                    if word == previous and not any(word):
+                        if not skipping:
+                            yield "*\n"
+                            skipping = True
+                        continue
+                    skipping = False
+                    if offset == start:
+                        yield "{:08x}  {:<8}  {:<24}  {}\n".format(address + offset, word.hex(), location, text)
+                    else:
+                        yield "{:08x}  {}\n".format(address + offset, word.hex())
+                    previous = word
+
+    @staticmethod
+    def _get_source_line(sources, file_name, line):
+        lines = sources.get(file_name)
+        if lines is None:
+            lines = []
+            if file_name is not None:
+                try:
+                    with open(file_name, "r", encoding="utf-8") as file:
+                        lines = file.read().split("\n")
+                except (OSError, UnicodeDecodeError):
+                    pass
+            sources[file_name] = lines
+        elif isinstance(lines, str):
+            lines = sources[file_name] = lines.split("\n")
+        return lines[line - 1].rstrip() if 0 < line <= len(lines) else ""
+
+    def write_listing(self, path, sources=None):
+        # Writes the listing of iter_listing to a text file
+        with open(path, "w", encoding="utf-8") as file:
+            file.writelines(self.iter_listing(sources))
+
+    def get_stats(self):
+        if self._stats is None:
+            return None
+        return self._stats.get_stats()
+
+    def write_trace(self, path):
+        # Writes the recorded add, layout and encode operations as a Chrome trace-event file
+        if self._stats is None:
+            raise ValueError("Statistics are only recorded by MipsAssembler(stats=True)")
+        self._stats.write_trace(path)
+
+
+def assemble_file(path, encoding="utf-8", workers=None):
+    assembler = MipsAssembler(workers=workers)
+    with open(path, "r", encoding=encoding) as file:
+        assembler.add_stream(file, path)
+    return assembler
+
+
+def assemble_many(programs, layout=None):
+    # Assembles and links each program (a string or an iterable of lines) in turn, yielding its linked sections.
+    # Enable the line cache with enable_line_cache() when the programs share many lines.
+    for program in programs:
+        assembler = MipsAssembler()
+        if isinstance(program, str):
+            assembler.add(program)
+        else:
+            assembler.add_stream(program)
+        yield assembler.link(layout)
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ("serve", "client"):
+        import mips_server
+        sys.exit(mips_server.main(sys.argv[1:]))
+
     assembler = MipsAssembler()
     assembler.add("""
         lui   $t0, label3
@@ -623,8 +3126,8 @@ if __name__ == "__main__":
         ori $t0, 2
         label3:
     """)
-    for section_name, mips_section in assembler._sections.items():
+    for section_name, compiled_section in assembler.link([".text.start", ".text"]).items():
         print(section_name)
 
-        print(mips_section.compile().hex())
-        print(mips_section.get_labels())
+        print(compiled_section.hex())
+    print(assembler.get_labels())
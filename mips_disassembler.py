@@ -0,0 +1,187 @@
+import array
+import itertools
+import sys
+
+from mips_assembler import MipsAssembler, _INSTRUCTIONS, _REGISTER_NAMES, numpy
+
+# Field columns extracted from every word, operands refer to them by index
+_RS, _RT, _RD, _SHAMT, _SIGNED_IMMEDIATE, _UNSIGNED_IMMEDIATE, _JUMP_TARGET = range(7)
+
+# Logical immediates are zero extended by the CPU, so they are shown unsigned
+_UNSIGNED_IMMEDIATE_MNEMONICS = frozenset(["andi", "ori", "xori", "lui"])
+
+_FIELD_BITS = {
+    "_rs": (21, 0x1F),
+    "_rt": (16, 0x1F),
+    "_rd": (11, 0x1F),
+    "_sa": (6, 0x1F),
+}
+
+
+class _DecodeEntry(object):
+    # A word decodes to mnemonic when (word & mask) == match, which pins the opcode, the funct or REGIMM rt that
+    # selected the entry and every field that isn't an operand to the value the assembler would have used for it.
+    # The text is template formatted with the field columns listed in operands.
+    __slots__ = ("mnemonic", "mask", "match", "template", "operands")
+
+    def __init__(self, spec):
+        self.mnemonic = spec.mnemonic
+
+        # The layout with the most arguments names every operand explicitly
+        layout = spec.layouts[max(spec.argument_counts)]
+        attributes = [attribute for slot in layout for attribute, is_register in slot]
+
+        self.mask = 0xFC000000
+        self.match = spec.opcode << 26
+        if spec.instruction_type == "R":
+            self.mask |= 0x3F
+            self.match |= spec.funct
+        fixed = {"_rs": spec.rs, "_rt": spec.rt, "_rd": spec.rd, "_sa": 0}
+        fields = {"R": ("_rs", "_rt", "_rd", "_sa"), "I": ("_rs", "_rt"), "J": ()}[spec.instruction_type]
+        for field in fields:
+            if field not in attributes:
+                shift, field_mask = _FIELD_BITS[field]
+                self.mask |= field_mask << shift
+                self.match |= fixed[field] << shift
+
+        columns = {
+            "_rs": _RS,
+            "_rt": _RT,
+            "_rd": _RD,
+            "_sa": _SHAMT,
+            "_immediate": _UNSIGNED_IMMEDIATE if spec.mnemonic in _UNSIGNED_IMMEDIATE_MNEMONICS else _SIGNED_IMMEDIATE,
+            "_jump_target": _JUMP_TARGET,
+        }
+        self.operands = tuple(columns[attribute] for attribute in attributes)
+        if spec.memory_operand:
+            self.template = spec.mnemonic + " {}, {}({})"
+        elif len(attributes) > 0:
+            self.template = spec.mnemonic + " " + ", ".join(["{}"] * len(attributes))
+        else:
+            self.template = spec.mnemonic
+
+
+def _decode_key(opcode, rt, funct):
+    # R types are told apart by their funct and REGIMM (opcode 0x1) instructions by their rt field
+    if opcode == 0x0 or opcode == 0x1C:
+        return (opcode << 6) | funct
+    if opcode == 0x1:
+        return (opcode << 6) | rt
+    return opcode << 6
+
+
+# A flat table indexed by _decode_key holding the entry that a word with that key decodes to, or None
+_DECODE_TABLE = [None] * (64 * 64)
+for _spec in _INSTRUCTIONS.values():
+    _DECODE_TABLE[_decode_key(_spec.opcode, _spec.rt, _spec.funct)] = _DecodeEntry(_spec)
+del _spec
+_DECODE_MASKS = [0 if entry is None else entry.mask for entry in _DECODE_TABLE]
+_DECODE_MATCHES = [1 if entry is None else entry.match for entry in _DECODE_TABLE]
+
+
+def _words_python(buffer):
+    words = array.array("I")
+    words.frombytes(memoryview(buffer).cast("B")[:len(buffer) // 4 * 4])
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words
+
+
+def _decode_python(buffer):
+    # Returns the entry (or None for words that aren't a valid instruction) and the field columns of every word
+    words = _words_python(buffer)
+    rs = [(word >> 21) & 0x1F for word in words]
+    rt = [(word >> 16) & 0x1F for word in words]
+    functs = [word & 0x3F for word in words]
+    entries = []
+    for word, word_rt, funct in zip(words, rt, functs):
+        key = _decode_key(word >> 26, word_rt, funct)
+        if word & _DECODE_MASKS[key] == _DECODE_MATCHES[key]:
+            entries.append(_DECODE_TABLE[key])
+        else:
+            entries.append(None)
+
+    columns = [
+        rs,
+        rt,
+        [(word >> 11) & 0x1F for word in words],
+        [(word >> 6) & 0x1F for word in words],
+        [(word & 0xFFFF) - ((word & 0x8000) << 1) for word in words],
+        [word & 0xFFFF for word in words],
+        [word & 0x3FFFFFF for word in words],
+    ]
+    return list(words), entries, columns
+
+
+def _decode_numpy(buffer):
+    words = numpy.frombuffer(buffer, dtype=">u4", count=len(buffer) // 4).astype(numpy.uint32)
+    opcodes = words >> 26
+    rt = (words >> 16) & 0x1F
+    functs = words & 0x3F
+    keys = numpy.where((opcodes == 0x0) | (opcodes == 0x1C), (opcodes << 6) | functs,
+                       numpy.where(opcodes == 0x1, (opcodes << 6) | rt, opcodes << 6))
+    valid = (words & numpy.asarray(_DECODE_MASKS, dtype=numpy.uint32)[keys]) == \
+        numpy.asarray(_DECODE_MATCHES, dtype=numpy.uint32)[keys]
+    table = numpy.asarray(_DECODE_TABLE + [None], dtype=object)
+    entries = table[numpy.where(valid, keys, len(_DECODE_TABLE))].tolist()
+
+    immediates = words & 0xFFFF
+    columns = [
+        ((words >> 21) & 0x1F).tolist(),
+        rt.tolist(),
+        ((words >> 11) & 0x1F).tolist(),
+        ((words >> 6) & 0x1F).tolist(),
+        immediates.astype(numpy.uint16).view(numpy.int16).tolist(),
+        immediates.tolist(),
+        (words & 0x3FFFFFF).tolist(),
+    ]
+    return words.tolist(), entries, columns
+
+
+# The NumPy decoder is used whenever NumPy is available, both return the same Python lists
+_decode = _decode_python if numpy is None else _decode_numpy
+
+
+def disassemble(buffer, labels=None):
+    # Turns a buffer of big endian words, such as the output of _MipsSection.compile, into one line of assembly per
+    # word. Words that aren't a valid instruction become .word directives, so the output always reassembles to the
+    # same bytes in .set noreorder mode, which keeps the delay slots as they are. Jump targets that match a label
+    # (after masking to 26 bits, as the assembler does) use its name.
+    words, entries, columns = _decode(buffer)
+    register_names = [_REGISTER_NAMES[register] for register in range(32)]
+    columns[_RS] = [register_names[register] for register in columns[_RS]]
+    columns[_RT] = [register_names[register] for register in columns[_RT]]
+    columns[_RD] = [register_names[register] for register in columns[_RD]]
+    if labels:
+        targets = {}
+        for label, address in sorted(labels.items(), key=lambda item: item[1], reverse=True):
+            targets[address & 0x3FFFFFF] = label
+        columns[_JUMP_TARGET] = [targets.get(target, target) for target in columns[_JUMP_TARGET]]
+
+    lines = []
+    for index, (word, entry) in enumerate(zip(words, entries)):
+        if entry is None:
+            lines.append(".word {}".format(word))
+        else:
+            lines.append(entry.template.format(*[columns[operand][index] for operand in entry.operands]))
+    return lines
+
+
+def round_trip(buffer):
+    # Disassembles buffer, assembles the text again and returns (offset, original word, reassembled word) for every
+    # word that came out differently, so an empty list means the assembler and the disassembler agree on the buffer.
+    # A word missing from either side is None.
+    assembler = MipsAssembler()
+    assembler.add_stream(itertools.chain([".set noreorder"], disassemble(buffer)))
+    reassembled = _words_python(assembler.link([".text"])[".text"])
+    original = _words_python(buffer)
+    return [(4 * index, before, after)
+            for index, (before, after) in enumerate(itertools.zip_longest(original, reassembled))
+            if before != after]
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], "rb") as binary_file:
+        print(".set noreorder")
+        for line in disassemble(binary_file.read()):
+            print(line)
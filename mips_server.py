@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import concurrent.futures
+import io
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+
+import mips_assembler
+
+# Every message is a JSON header frame followed by header["frames"] binary frames, each frame prefixed by its
+# length. A request carries the source as its only binary frame, a response carries one frame per linked section, a
+# single frame holding the whole output file for the "raw", "hex", "srec" and "elf" formats, or none on failure.
+_FRAME_LENGTH = struct.Struct(">I")
+_MAX_FRAME_SIZE = 1 << 30
+
+DEFAULT_PORT = 7730
+
+
+def _describe_error(error):
+    if isinstance(error, mips_assembler.MipsParsingError):
+        return {"message": error.message, "line": error.line, "line_number": error.line_number,
+                "column": error.column}
+    return {"message": str(error), "line": None, "line_number": None, "column": None}
+
+
+def _initialize_worker(cache_directory):
+    # Workers live as long as the server, so the line cache and the expression cache stay warm across jobs
+    mips_assembler.enable_line_cache()
+    if cache_directory is not None:
+        mips_assembler.enable_section_cache(cache_directory)
+
+
+def run_job(source, options):
+    # Assembles one program and returns the response header and its binary frames
+    assembler = mips_assembler.MipsAssembler(collect_errors=True, optimize=options.get("optimize", False))
+    output_format = options.get("format", "sections")
+    try:
+        assembler.add(source)
+        if len(assembler.get_errors()) > 0:
+            return {"ok": False, "errors": [_describe_error(error) for error in assembler.get_errors()],
+                    "frames": 0}, []
+
+        if output_format == "sections":
+            compiled_sections = assembler.link(options.get("layout"), options.get("address", 0))
+            frames = [bytes(compiled_section) for compiled_section in compiled_sections.values()]
+        else:
+            output = io.BytesIO()
+            assembler.write(output, output_format, options.get("layout"), options.get("address"),
+                            options.get("entry"))
+            frames = [output.getvalue()]
+    except (mips_assembler.MipsParsingError, mips_assembler.MipsCompileError, ValueError) as error:
+        return {"ok": False, "errors": [_describe_error(error)], "frames": 0}, []
+
+    sections = [{"name": section.get_name(), "address": section.get_address(), "size": section.get_size()}
+                for section in assembler.get_sections()]
+    return {"ok": True, "format": output_format, "sections": sections, "labels": assembler.get_labels(),
+            "frames": len(frames)}, frames
+
+
+async def _read_frame(reader):
+    length = _FRAME_LENGTH.unpack(await reader.readexactly(_FRAME_LENGTH.size))[0]
+    if length > _MAX_FRAME_SIZE:
+        raise ValueError("A frame of {} bytes is larger than the {} byte limit".format(length, _MAX_FRAME_SIZE))
+    return await reader.readexactly(length)
+
+
+def _pack_frames(header, frames):
+    header = json.dumps(header).encode("utf-8")
+    packed = [_FRAME_LENGTH.pack(len(header)), header]
+    for frame in frames:
+        packed += [_FRAME_LENGTH.pack(len(frame)), frame]
+    return packed
+
+
+async def _handle_connection(reader, writer, executor):
+    # Requests on one connection are answered in order, separate connections are served concurrently
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                header = await _read_frame(reader)
+            except asyncio.IncompleteReadError:
+                break
+            try:
+                header = json.loads(header)
+            except ValueError:
+                header = None
+            if not isinstance(header, dict) or type(header.get("frames", 0)) is not int \
+                    or not isinstance(header.get("options", {}), dict):
+                # The frames that follow can't be told apart from the next request, so the connection ends here
+                error = ValueError("A request header must be a JSON object with an integer 'frames' and an object "
+                                   "'options'")
+                writer.writelines(_pack_frames({"ok": False, "errors": [_describe_error(error)], "frames": 0}, []))
+                await writer.drain()
+                break
+            frames = [await _read_frame(reader) for index in range(header.get("frames", 0))]
+            if len(frames) != 1:
+                error = ValueError("A job needs exactly one source frame")
+                response = {"ok": False, "errors": [_describe_error(error)], "frames": 0}, []
+            else:
+                try:
+                    response = await loop.run_in_executor(executor, run_job, frames[0].decode("utf-8"),
+                                                          header.get("options", {}))
+                except Exception as error:
+                    response = {"ok": False, "errors": [_describe_error(error)], "frames": 0}, []
+            writer.writelines(_pack_frames(*response))
+            await writer.drain()
+    except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve(path, port, workers, cache_directory):
+    executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=_initialize_worker,
+                                                      initargs=(cache_directory,))
+
+    def handle(reader, writer):
+        return _handle_connection(reader, writer, executor)
+
+    if path is not None:
+        server = await asyncio.start_unix_server(handle, path)
+    else:
+        server = await asyncio.start_server(handle, "127.0.0.1", port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+def serve(path=None, port=DEFAULT_PORT, workers=None, cache_directory=None):
+    # Serves assemble jobs on a Unix socket when a path is given and on localhost TCP otherwise, until SIGINT or
+    # SIGTERM. Jobs run in a pool of worker processes.
+    asyncio.run(_serve(path, port, workers, cache_directory))
+
+
+def _receive_exactly(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise ConnectionError("The server closed the connection")
+    return data
+
+
+def _receive_frame(file):
+    return _receive_exactly(file, _FRAME_LENGTH.unpack(_receive_exactly(file, _FRAME_LENGTH.size))[0])
+
+
+class MipsClient(object):
+    # A blocking connection to a running server, jobs are sent one after the other over the same connection
+    def __init__(self, path=None, port=DEFAULT_PORT):
+        if path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(path)
+        else:
+            self._socket = socket.create_connection(("127.0.0.1", port))
+        self._file = self._socket.makefile("rb")
+
+    def assemble(self, source, **options):
+        # Returns the response header and its frames, see run_job for the options
+        if isinstance(source, str):
+            source = source.encode("utf-8")
+        buffers = _pack_frames({"options": options, "frames": 1}, [source])
+        while len(buffers) > 0:
+            sent = self._socket.sendmsg(buffers)
+            while len(buffers) > 0 and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if sent > 0:
+                buffers[0] = memoryview(buffers[0])[sent:]
+        header = json.loads(_receive_frame(self._file))
+        return header, [_receive_frame(self._file) for index in range(header["frames"])]
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+
+def _client(args):
+    options = {"format": args.format}
+    if args.layout is not None:
+        options["layout"] = args.layout
+    if args.address is not None:
+        options["address"] = args.address
+    if args.entry is not None:
+        options["entry"] = args.entry
+    if args.optimize:
+        options["optimize"] = True
+
+    with open(args.source, "rb") as file:
+        source = file.read()
+    with MipsClient(args.socket, args.port) as client:
+        header, frames = client.assemble(source, **options)
+
+    if not header["ok"]:
+        for error in header["errors"]:
+            location = args.source
+            if error["line_number"] is not None:
+                location += ":{}".format(error["line_number"])
+                if error["column"] is not None:
+                    location += ":{}".format(error["column"])
+            print("{}: {}".format(location, error["message"]), file=sys.stderr)
+        return 1
+
+    with open(args.output, "wb") as file:
+        file.writelines(frames)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m mips_assembler",
+                                     description="Run an assembler server or send a source file to one")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="serve assemble jobs until interrupted")
+    client_parser = commands.add_parser("client", help="assemble a file on a running server")
+    for command_parser in (serve_parser, client_parser):
+        command_parser.add_argument("--socket", help="Unix socket path, instead of localhost TCP")
+        command_parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                                    help="localhost TCP port (default: {})".format(DEFAULT_PORT))
+    serve_parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    serve_parser.add_argument("--cache-dir", help="also keep an on-disk section cache in this directory")
+
+    client_parser.add_argument("source", help="assembly source file")
+    client_parser.add_argument("-o", "--output", required=True, help="file the output is written to")
+    client_parser.add_argument("--format", default="raw", choices=["raw", "hex", "srec", "elf"])
+    client_parser.add_argument("--layout", nargs="+", help="section names in the order they are placed")
+    client_parser.add_argument("--address", type=lambda value: int(value, 0),
+                               help="address of the first section (default: 0)")
+    client_parser.add_argument("--entry", help="entry point label")
+    client_parser.add_argument("-O", "--optimize", action="store_true", help="apply the peephole optimizations")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.socket, args.port, args.workers, args.cache_dir)
+        return 0
+    return _client(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
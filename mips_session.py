@@ -0,0 +1,602 @@
+from mips_assembler import MipsAssembler, MipsCompileError, MipsParsingError, _MipsDirective, _MipsSection
+
+# Keeps a program assembled and linked while its source is edited, for editors and live reload tools. The source is
+# cut into blocks of lines and every block is assembled into a piece of each section it adds to. A block only ends
+# where nothing carries over to the next line: no instruction could still move into a delay slot and no label waits
+# for the offset of what follows. Laying a section's pieces out one after the other then gives the same bytes as
+# assembling the whole source at once.
+#
+# An edit reparses the lines it replaces and reassembles the blocks they fall in. The pieces after them only move,
+# so their bytes are moved along and only their labels are placed again. Since branches and jumps hold the address
+# of their label, the references to a label whose address changed are encoded again and nothing else is. Edits that
+# add or remove a .section or .set line, that change which sections exist or the order they are first used in, or
+# that leave a li or la longer than its value needs start over from the parsed lines.
+
+# A block is cut at the first line it can end at after this many lines
+_BLOCK_LINES = 256
+
+
+class _MipsSessionBlock(object):
+    # A run of source lines, the section and reorder mode they start in and the piece of every section they add to,
+    # in the order the sections are first used
+    __slots__ = ("line_count", "section", "reorder", "pieces")
+
+    def __init__(self, line_count, section, reorder, pieces):
+        self.line_count = line_count
+        self.section = section
+        self.reorder = reorder
+        self.pieces = pieces
+
+
+def _get_changed_range(old, new):
+    # The (start, end) range holding every byte that differs between the two, or None when they are the same. Past
+    # the end of the shorter one everything counts as changed.
+    old = memoryview(old)
+    new = memoryview(new)
+    if len(old) == len(new) and old == new:
+        return None
+    low = 0
+    high = min(len(old), len(new))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[:middle] == new[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    if len(old) != len(new):
+        return low, max(len(old), len(new))
+
+    end = len(new)
+    suffix = 0
+    high = end - low
+    while suffix < high:
+        middle = (suffix + high + 1) // 2
+        if old[end - middle:] == new[end - middle:]:
+            suffix = middle
+        else:
+            high = middle - 1
+    return low, end - suffix
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if start == end:
+            continue
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class MipsAssemblySession(object):
+    # Assembles and links a source once, then takes edits to it. Sections are placed as by MipsAssembler.link() with
+    # the same layout and address. An edit that fails to parse or link raises as the assembler would, the source
+    # keeps the edit and the output stays as it was until an edit assembles again.
+    def __init__(self, source="", layout=None, address=0):
+        self._parser = MipsAssembler()
+        self._layout = layout or []
+        self._address = address
+        self._lines = []
+        self._parsed = []
+
+        self._blocks = []
+        self._section_order = []
+        self._pieces = {}
+        # The (address, size) of every section in the order they are placed, the (start, phase) of every piece
+        # within its section, and the label references of every piece from get_label_references()
+        self._section_places = {}
+        self._piece_places = {}
+        self._references = {}
+        self._images = {}
+        self._labels = {}
+        # The piece defining every label, the pieces referring to it and its li and la as {id: (piece, item)}
+        self._label_owners = {}
+        self._label_users = {}
+        self._label_loads = {}
+        # Whether a full relaxation still left a li or la longer than its value needs, which growing items one edit
+        # at a time wouldn't reproduce
+        self._oversized = False
+        self._stale = True
+
+        self.edit(1, 0, source)
+
+    def get_source(self):
+        return "\n".join(self._lines)
+
+    def get_line_count(self):
+        return len(self._lines)
+
+    def get_labels(self):
+        return self._labels
+
+    def get_compiled_sections(self):
+        # The linked bytes of every section by name, in the order they are placed, as link() returns them
+        return {name: bytes(self._images[name]) for name in self._section_places}
+
+    def get_section_address(self, name):
+        return self._section_places[name][0]
+
+    def edit(self, first_line, last_line, lines):
+        # Replaces lines first_line to last_line, counted from 1 and inclusive, with the given lines, a string or a
+        # list of them. Lines are inserted in front of first_line when last_line is first_line - 1. Returns the
+        # sorted (start, end) address ranges whose bytes changed, a section that moved counting both its old and
+        # its new place.
+        if isinstance(lines, str):
+            lines = lines.split("\n")
+        if not 1 <= first_line <= len(self._lines) + 1 or not first_line - 1 <= last_line <= len(self._lines):
+            raise ValueError("Lines {} to {} are not in a source of {} lines"
+                             .format(first_line, last_line, len(self._lines)))
+        first = first_line - 1
+        old_count = last_line - first
+
+        parsed = []
+        error = None
+        for line_number, line in enumerate(lines, first_line):
+            try:
+                parsed.append(self._parser._parse_line(line, line_number)[0])
+            except MipsParsingError as parsing_error:
+                parsed.append(None)
+                error = error or parsing_error
+        old_parsed = self._parsed[first:last_line]
+        self._lines[first:last_line] = lines
+        self._parsed[first:last_line] = parsed
+
+        if error is not None:
+            self._stale = True
+            raise error
+        if self._stale and None in self._parsed:
+            # Raises the error of the first line that still doesn't parse
+            line_number = self._parsed.index(None) + 1
+            self._parser._parse_line(self._lines[line_number - 1], line_number)
+
+        try:
+            if self._stale or self._changes_state(old_parsed) or self._changes_state(parsed):
+                self._blocks = self._build_blocks(0, len(self._lines), ".text", True, [])[0]
+                ranges = self._link_all()
+            else:
+                ranges = self._update(first, old_count, len(lines))
+        except MipsCompileError:
+            self._stale = True
+            raise
+        self._stale = False
+        return ranges
+
+    @staticmethod
+    def _changes_state(parsed):
+        # Whether the lines switch the section or the reorder mode of the lines after them
+        return any(type(item) is _MipsDirective and item.get_directive() in (".section", ".set")
+                   for items in parsed for item in items)
+
+    def _build_blocks(self, first, end, section, reorder, boundaries):
+        # Assembles the lines from first on into blocks. The lines before end are always assembled, after that the
+        # last block ends at the first of the boundaries, increasing line indexes, that it can end at. Returns the
+        # blocks and the index of that boundary, or the number of boundaries when the source ran out first.
+        blocks = []
+        parsed = self._parsed
+        pieces = {}
+        block_first = first
+        block_section = section
+        block_reorder = reorder
+        boundary = 0
+        line = first
+        while line < len(parsed):
+            while boundary < len(boundaries) and boundaries[boundary] < line:
+                boundary += 1
+            at_boundary = line >= end and boundary < len(boundaries) and boundaries[boundary] == line
+            if (at_boundary or line - block_first >= _BLOCK_LINES) and all(piece.can_split()
+                                                                           for piece in pieces.values()):
+                if line > block_first:
+                    blocks.append(self._finish_block(line - block_first, block_section, block_reorder, pieces))
+                if at_boundary:
+                    return blocks, boundary
+                pieces = {}
+                block_first = line
+                block_section = section
+                block_reorder = reorder
+
+            for item in parsed[line]:
+                if type(item) is _MipsDirective:
+                    directive = item.get_directive()
+                    if directive == ".section":
+                        # Nothing is moved across a section switch, as in MipsAssembler
+                        if section in pieces:
+                            pieces[section].end_scheduling_block()
+                        section = item.get_arguments()
+                        continue
+                    if directive == ".set":
+                        reorder = item.get_arguments() == "reorder"
+                piece = pieces.get(section)
+                if piece is None:
+                    piece = pieces[section] = _MipsSection(section)
+                piece.add(item, reorder)
+            line += 1
+
+        if line > block_first or len(blocks) == 0:
+            blocks.append(self._finish_block(line - block_first, block_section, block_reorder, pieces))
+        return blocks, len(boundaries)
+
+    def _finish_block(self, line_count, section, reorder, pieces):
+        for piece in pieces.values():
+            piece.prepare()
+            self._references[piece] = piece.get_label_references()
+        return _MipsSessionBlock(line_count, section, reorder, pieces)
+
+    def _collect_pieces(self):
+        pieces = {}
+        for block in self._blocks:
+            for name, piece in block.pieces.items():
+                pieces.setdefault(name, []).append(piece)
+        return pieces
+
+    def _place(self, dirty=None, realign=(), section_places=None, piece_places=None):
+        # Lays the pieces out and places the sections as link() does. Returns the places of the sections and of the
+        # pieces, and the (first, end) indexes of the pieces whose address was set in every section. Given the places
+        # from before, dirty maps the name of every section whose pieces changed to the (first, last) indexes of
+        # those pieces. Only the pieces from the first one on are laid out again, until one past the last is back at
+        # its old place, and the other pieces only get an address when their section moved. The sections in realign
+        # lost a piece their alignment may have come from.
+        entries = []
+        for entry in self._layout:
+            if isinstance(entry, str):
+                entry = {"name": entry}
+            if entry["name"] not in self._pieces:
+                raise MipsCompileError("The section '{}' in the layout doesn't exist".format(entry["name"]))
+            entries.append(entry)
+        listed = set(entry["name"] for entry in entries)
+        entries += [{"name": name} for name in self._section_order if name not in listed]
+
+        new_section_places = {}
+        new_piece_places = {} if piece_places is None else dict(piece_places)
+        placed = {}
+        address = self._address
+        for entry in entries:
+            name = entry["name"]
+            pieces = self._pieces[name]
+            if piece_places is None or name in dirty:
+                first, last = (0, len(pieces)) if piece_places is None else dirty[name]
+                if piece_places is None or name in realign:
+                    alignment = max([piece.get_alignment() for piece in pieces] or [1])
+                else:
+                    alignment = section_places[name][2]
+                offset = 0
+                if first > 0:
+                    start, phase = new_piece_places[pieces[first - 1]]
+                    offset = start + pieces[first - 1].get_size() - phase
+                end = first
+                while end < len(pieces):
+                    piece = pieces[end]
+                    piece_alignment = piece.get_alignment()
+                    phase = offset % piece_alignment
+                    if end > last and new_piece_places.get(piece) == (offset, phase):
+                        break
+                    alignment = max(alignment, piece_alignment)
+                    piece.set_phase(phase)
+                    new_piece_places[piece] = (offset, phase)
+                    offset += piece.get_size() - phase
+                    end += 1
+                size = offset if end == len(pieces) else section_places[name][1]
+            else:
+                first = end = 0
+                size, alignment = section_places[name][1:]
+
+            align = max(entry.get("align", 4), alignment)
+            if "address" in entry:
+                if entry["address"] < address:
+                    raise MipsCompileError("The section '{}' at address {:#x} overlaps the previous section"
+                                           .format(name, entry["address"]))
+                address = entry["address"]
+            address = (address + align - 1) // align * align
+            if section_places is None or section_places[name][0] != address:
+                first, end = 0, len(pieces)
+            for piece in pieces[first:end]:
+                start, phase = new_piece_places[piece]
+                piece.set_address(address + start - phase)
+            placed[name] = (first, end)
+            new_section_places[name] = (address, size, alignment)
+            address += size
+        return new_section_places, new_piece_places, placed
+
+    @staticmethod
+    def _get_piece_labels(piece, labels, owners, saved=None):
+        # Adds the labels of a piece, first keeping the values they replace in saved
+        piece_labels = piece.get_labels({})
+        for label, value in piece_labels.items():
+            owner = owners.get(label)
+            if owner is not None and owner is not piece:
+                raise MipsCompileError("The label '{}' was defined more than once".format(label))
+            owners[label] = piece
+            if saved is not None and label not in saved:
+                saved[label] = labels.get(label)
+            labels[label] = value
+        return piece_labels
+
+    @staticmethod
+    def _compile_piece(piece, labels, phase):
+        # The bytes of a piece from its start in the section
+        compiled = bytearray(piece.get_size() - phase)
+        for offset, chunk in piece.iter_chunks(labels):
+            compiled[offset - phase:offset - phase + len(chunk)] = chunk
+        return compiled
+
+    def _link_all(self):
+        # Places, relaxes and encodes every piece, as link() does for the whole program
+        self._pieces = self._collect_pieces()
+        self._section_order = list(self._pieces)
+        self._references = {piece: self._references[piece] for pieces in self._pieces.values() for piece in pieces}
+
+        relaxable = []
+        for pieces in self._pieces.values():
+            for piece in pieces:
+                piece.reset_relaxation()
+                relaxable.extend((piece, item) for item in piece.get_relaxable_items())
+        while True:
+            section_places, piece_places, placed = self._place()
+            labels = {}
+            owners = {}
+            for pieces in self._pieces.values():
+                for piece in pieces:
+                    self._get_piece_labels(piece, labels, owners)
+            grown = False
+            for piece, item in relaxable:
+                if item.relax(labels):
+                    piece.invalidate_layout()
+                    grown = True
+            if not grown:
+                break
+
+        images = {}
+        for name, pieces in self._pieces.items():
+            images[name] = bytearray().join(self._compile_piece(piece, labels, piece_places[piece][1])
+                                            for piece in pieces)
+
+        ranges = []
+        for name in set(self._section_places) | set(section_places):
+            old_address, old_size = self._section_places.get(name, (None, 0, 1))[:2]
+            address, size = section_places.get(name, (None, 0, 1))[:2]
+            if old_address == address:
+                changed = _get_changed_range(self._images[name], images[name])
+                if changed is not None:
+                    ranges.append((address + changed[0], address + changed[1]))
+                continue
+            if old_address is not None:
+                ranges.append((old_address, old_address + old_size))
+            if address is not None:
+                ranges.append((address, address + size))
+
+        users = {}
+        for piece, references in self._references.items():
+            for label in references:
+                users.setdefault(label, set()).add(piece)
+        loads = {}
+        for piece, item in relaxable:
+            for label in item.get_labels():
+                loads.setdefault(label, {})[id(item)] = (piece, item)
+        self._label_users = users
+        self._label_loads = loads
+        self._label_owners = owners
+        self._labels = labels
+        self._section_places = section_places
+        self._piece_places = piece_places
+        self._images = images
+        self._oversized = any([item.is_oversized(labels) for piece, item in relaxable])
+        return _merge_ranges(ranges)
+
+    def _update(self, first, old_count, new_count):
+        # Reassembles the blocks holding the replaced lines, then places and encodes again only what they moved
+        blocks = self._blocks
+        starts = []
+        line = 0
+        for block in blocks:
+            starts.append(line)
+            line += block.line_count
+        first_block = 0
+        while first_block + 1 < len(blocks) and starts[first_block + 1] <= first:
+            first_block += 1
+        last_block = first_block
+        while last_block + 1 < len(blocks) and starts[last_block + 1] < first + old_count:
+            last_block += 1
+
+        # The blocks after the edit keep their lines, only moved by the change in the line count. The new blocks
+        # reach at least to the first of them and on until one they can end in front of.
+        delta = new_count - old_count
+        boundaries = [start + delta for start in starts[last_block + 1:]]
+        end = boundaries[0] if len(boundaries) > 0 else len(self._lines)
+        new_blocks, kept = self._build_blocks(starts[first_block], end, blocks[first_block].section,
+                                              blocks[first_block].reorder, boundaries)
+        old_pieces = [piece for block in blocks[first_block:last_block + 1 + kept] for piece in block.pieces.values()]
+        new_pieces = [piece for block in new_blocks for piece in block.pieces.values()]
+        blocks[first_block:last_block + 1 + kept] = new_blocks
+
+        # The new pieces of every section take the place of the old ones in its list, unless the first piece of a
+        # section changed, which can change the sections and the order they are first used in
+        firsts = {}
+        for block in blocks[:first_block]:
+            for name in block.pieces:
+                firsts[name] = firsts.get(name, 0) + 1
+        old_section_pieces = {}
+        for piece in old_pieces:
+            old_section_pieces.setdefault(piece.get_name(), []).append(piece)
+        new_section_pieces = {}
+        for piece in new_pieces:
+            new_section_pieces.setdefault(piece.get_name(), []).append(piece)
+        names = list(old_section_pieces) + [name for name in new_section_pieces if name not in old_section_pieces]
+        if self._oversized or any(name not in firsts for name in names):
+            self._pieces = self._collect_pieces()
+            if self._oversized or list(self._pieces) != self._section_order:
+                return self._link_all()
+        else:
+            for name in names:
+                index = firsts[name]
+                self._pieces[name][index:index + len(old_section_pieces.get(name, ()))] = \
+                    new_section_pieces.get(name, [])
+
+        # The labels are updated in place, so they go back to the values saved here when the edit doesn't link
+        saved = {}
+        try:
+            return self._relink(old_pieces, new_pieces, names, firsts, new_section_pieces, saved)
+        except MipsCompileError:
+            for label, value in saved.items():
+                if value is None:
+                    self._labels.pop(label, None)
+                else:
+                    self._labels[label] = value
+            raise
+
+    def _relink(self, old_pieces, new_pieces, names, firsts, new_section_pieces, saved):
+        # Places and encodes again what the new pieces changed, see _update
+        labels = self._labels
+        owners = self._label_owners
+        users = self._label_users
+        loads = self._label_loads
+
+        # A li or la mostly ends up as long as it was before the edit, so the new ones start out sized against the
+        # old labels. That keeps the code after them from moving there and back while they grow.
+        for piece in new_pieces:
+            if any([item.relax(labels) for item in piece.get_relaxable_items()
+                    if all(label in labels for label in item.get_labels())]):
+                piece.invalidate_layout()
+
+        for piece in old_pieces:
+            for label in piece.get_labels({}):
+                if owners.get(label) is piece:
+                    del owners[label]
+                    saved.setdefault(label, labels.pop(label))
+            for label in self._references.pop(piece):
+                users[label].discard(piece)
+            for item in piece.get_relaxable_items():
+                for label in item.get_labels():
+                    del loads[label][id(item)]
+        for piece in new_pieces:
+            for label in self._references[piece]:
+                users.setdefault(label, set()).add(piece)
+            for item in piece.get_relaxable_items():
+                for label in item.get_labels():
+                    loads.setdefault(label, {})[id(item)] = (piece, item)
+
+        # Only the pieces from the first replaced one on that moved are laid out again and have their labels placed
+        # again, until no li or la has to grow. The ones that can grow are the new ones and the ones depending on a
+        # label that moved.
+        old_places = self._piece_places
+        old_section_places = self._section_places
+        dirty = {}
+        for name in names:
+            index = firsts.get(name, 0)
+            dirty[name] = (index, index + len(new_section_pieces.get(name, ())) - 1)
+        # A section's alignment can only drop when it lost a piece with its alignment and got none back
+        realign = set(piece.get_name() for piece in old_pieces
+                      if piece.get_alignment() >= old_section_places[piece.get_name()][2])
+        realign.difference_update(piece.get_name() for piece in new_pieces
+                                  if piece.get_alignment() >= old_section_places[piece.get_name()][2])
+        section_places = old_section_places
+        piece_places = old_places
+        spans = {}
+        rebuilt = set(new_pieces)
+        candidates = {id(item): (piece, item) for piece in new_pieces for item in piece.get_relaxable_items()}
+        changed_labels = set()
+        while len(dirty) > 0:
+            section_places, piece_places, placed = self._place(dirty, realign, section_places, piece_places)
+            realign = ()
+            moved_labels = set()
+            for name, (first_index, end_index) in placed.items():
+                if first_index == end_index and name not in dirty:
+                    continue
+                for piece in self._pieces[name][first_index:end_index]:
+                    for label, value in self._get_piece_labels(piece, labels, owners, saved).items():
+                        if saved[label] != value:
+                            moved_labels.add(label)
+                span = spans.get(name, (first_index, end_index))
+                spans[name] = (min(span[0], first_index), max(span[1], end_index))
+            moved_labels -= changed_labels
+            changed_labels |= moved_labels
+            for label in moved_labels:
+                candidates.update(loads.get(label, ()))
+
+            dirty = {}
+            for piece, item in candidates.values():
+                if item.relax(labels):
+                    piece.invalidate_layout()
+                    rebuilt.add(piece)
+                    name = piece.get_name()
+                    index = self._pieces[name].index(piece)
+                    first_index, last_index = dirty.get(name, (index, index))
+                    dirty[name] = (min(first_index, index), max(last_index, index))
+        if any([item.is_oversized(labels) for piece, item in candidates.values()]):
+            return self._link_all()
+        changed_labels = [label for label, value in saved.items() if labels.get(label) != value]
+
+        # Every write is worked out before the images change, so an undefined label leaves them as they were. The
+        # pieces from the first one that changed or moved to the last one are written again as a single region, the
+        # ones that only moved by whole alignments are copied from their old place.
+        images = self._images
+        writes = []
+        ranges = []
+        compiled = set()
+        for name, (address, size, alignment) in section_places.items():
+            old_address, old_size = old_section_places[name][:2]
+            if address != old_address:
+                ranges += [(old_address, old_address + old_size), (address, address + size)]
+        for name, (first_index, end_index) in spans.items():
+            pieces = self._pieces[name]
+            address, size = section_places[name][:2]
+            old_address, old_size = old_section_places[name][:2]
+            changed = [index for index in range(first_index, end_index)
+                       if pieces[index] in rebuilt or old_places.get(pieces[index]) != piece_places[pieces[index]]]
+            if len(changed) == 0:
+                # Only pieces at the end were removed
+                if size == old_size:
+                    continue
+                changed = [len(pieces)]
+
+            region = bytearray()
+            for piece in pieces[changed[0]:changed[-1] + 1]:
+                start, phase = piece_places[piece]
+                if piece in rebuilt or old_places[piece][1] != phase:
+                    region += self._compile_piece(piece, labels, phase)
+                    compiled.add(piece)
+                else:
+                    old_start = old_places[piece][0]
+                    region += images[name][old_start:old_start + piece.get_size() - phase]
+            region_start = piece_places[pieces[changed[0]]][0] if changed[0] < len(pieces) else size
+            region_end = piece_places[pieces[changed[-1] + 1]][0] if changed[-1] + 1 < len(pieces) else old_size
+            writes.append((name, region_start, region_end, region))
+            if address == old_address:
+                changed_range = _get_changed_range(images[name][region_start:region_end], region)
+                if changed_range is not None:
+                    ranges.append((address + region_start + changed_range[0],
+                                   address + region_start + changed_range[1]))
+
+        # Where the bytes were moved along, the references to labels that moved are encoded again one by one, or the
+        # whole piece is when most of its references are among them
+        dependents = {}
+        for label in changed_labels:
+            for piece in users.get(label, ()):
+                if piece not in compiled:
+                    dependents.setdefault(piece, []).append(label)
+        patches = []
+        for piece, piece_labels in dependents.items():
+            references = self._references[piece]
+            start, phase = piece_places[piece]
+            if 2 * sum([len(references[label]) for label in piece_labels]) > sum(map(len, references.values())):
+                patches.append((piece.get_name(), start, self._compile_piece(piece, labels, phase)))
+                continue
+            for label in piece_labels:
+                for reference in references[label]:
+                    offset, data = piece.compile_reference(reference, labels)
+                    patches.append((piece.get_name(), start - phase + offset, data))
+
+        for name, region_start, region_end, region in writes:
+            images[name][region_start:region_end] = region
+        for name, offset, data in patches:
+            image = images[name]
+            changed_range = _get_changed_range(image[offset:offset + len(data)], data)
+            if changed_range is not None:
+                image[offset:offset + len(data)] = data
+                address = section_places[name][0] + offset
+                ranges.append((address + changed_range[0], address + changed_range[1]))
+
+        self._labels = labels
+        self._section_places = section_places
+        self._piece_places = piece_places
+        return _merge_ranges(ranges)
@@ -0,0 +1,859 @@
+import argparse
+import collections
+import struct
+import sys
+import time
+
+from mips_assembler import MipsAssembler, MipsCompileError, MipsParsingError, _get_register_id
+from mips_disassembler import _DECODE_MASKS, _DECODE_MATCHES, _DECODE_TABLE, _decode, _decode_key
+
+# Runs the output of the assembler. Note that this assembler doesn't encode branch and jump targets relative to
+# the instruction: it stores the label's address itself, masked to the field. A branch therefore goes to the
+# address in its 16 bit immediate and a jump to the address in its 26 bit field, with the upper bits taken from
+# the address of the delay slot, as a jump's are on hardware. Code placed below 64KB branches as written.
+#
+# Memory is big endian and reads as zero until written. Registers hold unsigned 32 bit values.
+
+_WORD = struct.Struct(">I")
+
+_PAGE_BITS = 12
+_PAGE_SIZE = 1 << _PAGE_BITS
+_OFFSET_MASK = _PAGE_SIZE - 1
+
+# A byte written to the console address is appended to the console output, a word written to the exit address stops
+# the program with it as the exit code
+CONSOLE_ADDRESS = 0xFFFF0000
+EXIT_ADDRESS = 0xFFFF0004
+
+# $ra holds this address when a run starts, so the program stops when the entry point returns
+RETURN_ADDRESS = 0xFFFFFFF0
+STACK_ADDRESS = 0x7FFFFFF0
+
+# HI and LO follow the 32 general purpose registers, writes to $zero go to a scratch register after them
+_HI = 32
+_LO = 33
+_SCRATCH = 34
+
+# Blocks of straight-line code are run without looking up every instruction, up to this many instructions
+_MAX_BLOCK_LENGTH = 64
+
+_BRANCH_MNEMONICS = ("j", "jal", "jr", "jalr", "beq", "bne", "blez", "bgtz", "bltz", "bgez", "bltzal", "bgezal")
+
+MipsRunResult = collections.namedtuple("MipsRunResult", ["reason", "exit_code", "instructions", "seconds",
+                                                         "instructions_per_second"])
+
+
+class MipsTrap(Exception):
+    # A trap instruction that fired, an overflow, a misaligned or unmapped access or a word that isn't an
+    # instruction. The simulator is left at the faulting instruction.
+    def __init__(self, cause, address, message):
+        super().__init__("{} at {}: {}".format(cause, address, message))
+        self.cause = cause
+        self.address = address
+        self.message = message
+
+    def __reduce__(self):
+        return type(self), (self.cause, self.address, self.message)
+
+
+class _Fault(Exception):
+    def __init__(self, cause, message):
+        super().__init__(message)
+        self.cause = cause
+
+
+class _Halt(Exception):
+    def __init__(self, reason, exit_code):
+        super().__init__(reason)
+        self.reason = reason
+        self.exit_code = exit_code
+
+
+class _MipsDevicePage(object):
+    # A page holding memory-mapped devices, as (start, end, read, write) ranges. Accesses outside them are bus errors.
+    __slots__ = ("devices",)
+
+    def __init__(self):
+        self.devices = []
+
+    def find(self, address, size):
+        for start, end, read, write in self.devices:
+            if start <= address and address + size <= end:
+                return read, write
+        raise _Fault("bus_error", "No device is mapped at {}".format(address))
+
+
+# How each instruction's predecoded operands are picked from its fields. Destination registers are replaced with
+# the scratch register when they are $zero, so handlers never have to check for it. Branch and jump targets and
+# link addresses are worked out from the instruction's own address here, once.
+def _destination(register):
+    return register if register != 0 else _SCRATCH
+
+
+def _branch_target(pc, immediate):
+    return ((pc + 4) & 0xFFFF0000) | immediate
+
+
+def _operands_rd_rs_rt(rs, rt, rd, shamt, immediate, pc):
+    return _destination(rd), rs, rt
+
+
+def _operands_rd_rt_shamt(rs, rt, rd, shamt, immediate, pc):
+    return _destination(rd), rt, shamt
+
+
+def _operands_rs_rt(rs, rt, rd, shamt, immediate, pc):
+    return rs, rt, 0
+
+
+def _operands_rt_rs_signed(rs, rt, rd, shamt, immediate, pc):
+    return _destination(rt), rs, immediate - ((immediate & 0x8000) << 1)
+
+
+def _operands_rt_rs_unsigned(rs, rt, rd, shamt, immediate, pc):
+    return _destination(rt), rs, immediate
+
+
+def _operands_lui(rs, rt, rd, shamt, immediate, pc):
+    return _destination(rt), immediate << 16, 0
+
+
+def _operands_store(rs, rt, rd, shamt, immediate, pc):
+    return rt, rs, immediate - ((immediate & 0x8000) << 1)
+
+
+def _operands_branch_rs_rt(rs, rt, rd, shamt, immediate, pc):
+    return rs, rt, _branch_target(pc, immediate)
+
+
+def _operands_branch_rs(rs, rt, rd, shamt, immediate, pc):
+    return rs, _branch_target(pc, immediate), pc + 8
+
+
+def _operands_trap_signed(rs, rt, rd, shamt, immediate, pc):
+    return rs, immediate - ((immediate & 0x8000) << 1), 0
+
+
+def _operands_trap_unsigned(rs, rt, rd, shamt, immediate, pc):
+    return rs, (immediate - ((immediate & 0x8000) << 1)) & 0xFFFFFFFF, 0
+
+
+def _operands_jump(rs, rt, rd, shamt, immediate, pc):
+    return ((pc + 4) & 0xFC000000) | immediate, pc + 8, 0
+
+
+def _operands_jr(rs, rt, rd, shamt, immediate, pc):
+    return rs, 0, 0
+
+
+def _operands_jalr(rs, rt, rd, shamt, immediate, pc):
+    return rs, _destination(rd), pc + 8
+
+
+_OPERANDS = {
+    "j": _operands_jump, "jal": _operands_jump,
+    "beq": _operands_branch_rs_rt, "bne": _operands_branch_rs_rt,
+    "blez": _operands_branch_rs, "bgtz": _operands_branch_rs, "bltz": _operands_branch_rs,
+    "bgez": _operands_branch_rs, "bltzal": _operands_branch_rs, "bgezal": _operands_branch_rs,
+    "addi": _operands_rt_rs_signed, "addiu": _operands_rt_rs_signed, "slti": _operands_rt_rs_signed,
+    "sltiu": _operands_rt_rs_signed, "andi": _operands_rt_rs_unsigned, "ori": _operands_rt_rs_unsigned,
+    "xori": _operands_rt_rs_unsigned, "lui": _operands_lui,
+    "lb": _operands_rt_rs_signed, "lh": _operands_rt_rs_signed, "lwl": _operands_rt_rs_signed,
+    "lw": _operands_rt_rs_signed, "lbu": _operands_rt_rs_signed, "lhu": _operands_rt_rs_signed,
+    "lwr": _operands_rt_rs_signed,
+    "sb": _operands_store, "sh": _operands_store, "swl": _operands_store, "sw": _operands_store,
+    "swr": _operands_store,
+    "tgei": _operands_trap_signed, "tgeiu": _operands_trap_unsigned, "tlti": _operands_trap_signed,
+    "tltiu": _operands_trap_unsigned, "teqi": _operands_trap_signed, "tnei": _operands_trap_signed,
+    "sll": _operands_rd_rt_shamt, "srl": _operands_rd_rt_shamt, "sra": _operands_rd_rt_shamt,
+    "sllv": _operands_rd_rs_rt, "srav": _operands_rd_rs_rt, "srlv": _operands_rd_rs_rt,
+    "jr": _operands_jr, "jalr": _operands_jalr,
+    "mult": _operands_rs_rt, "multu": _operands_rs_rt, "div": _operands_rs_rt, "divu": _operands_rs_rt,
+    "madd": _operands_rs_rt, "maddu": _operands_rs_rt, "msub": _operands_rs_rt, "msubu": _operands_rs_rt,
+    "add": _operands_rd_rs_rt, "addu": _operands_rd_rs_rt, "sub": _operands_rd_rs_rt, "subu": _operands_rd_rs_rt,
+    "and": _operands_rd_rs_rt, "or": _operands_rd_rs_rt, "xor": _operands_rd_rs_rt, "nor": _operands_rd_rs_rt,
+    "slt": _operands_rd_rs_rt, "sltu": _operands_rd_rs_rt, "mul": _operands_rd_rs_rt, "clz": _operands_rd_rs_rt,
+    "clo": _operands_rd_rs_rt,
+    "tge": _operands_rs_rt, "tgeu": _operands_rs_rt, "tlt": _operands_rs_rt, "tltu": _operands_rs_rt,
+    "teq": _operands_rs_rt, "tne": _operands_rs_rt,
+}
+
+
+def _signed_divide(dividend, divisor):
+    # Rounds toward zero like the hardware, returning the quotient and the remainder
+    quotient = abs(dividend) // abs(divisor)
+    if (dividend < 0) != (divisor < 0):
+        quotient = -quotient
+    return quotient, dividend - quotient * divisor
+
+
+class _NaiveCode(object):
+    # Stands in for the predecoded code and decodes the word at every step, the baseline predecoding is measured
+    # against
+    def __init__(self, simulator):
+        self._simulator = simulator
+
+    def __getitem__(self, address):
+        if address == RETURN_ADDRESS:
+            return self._simulator._code[address]
+        return self._simulator._decode_at(address, False)
+
+
+class MipsSimulator(object):
+    # Executes assembled sections. Every loaded word is decoded once into a (handler, a, b, c) tuple held by address,
+    # and running an instruction is a single call to its handler. Handlers return the branch target when a branch or
+    # jump is taken, which becomes the address after the delay slot. Straight-line code up to a branch and its delay
+    # slot is grouped into blocks the first time it runs, so most instructions run without looking anything up.
+    # Stores into predecoded words drop them and every block, the block doing the store runs to its end as decoded.
+    def __init__(self, labels=None):
+        self._labels = dict(labels) if labels is not None else {}
+        self._registers = [0] * (_SCRATCH + 1)
+        self._registers[_get_register_id("$sp")] = STACK_ADDRESS
+        self._pages = {}
+        self._code = {}
+        self._blocks = {}
+        self._console = bytearray()
+        self._pc = 0
+        self._next_pc = 4
+        self._instructions = 0
+        self._seconds = 0.0
+        self._handlers = self._make_handlers()
+        self._branch_handlers = frozenset(self._handlers[mnemonic] for mnemonic in _BRANCH_MNEMONICS)
+
+        self._code[RETURN_ADDRESS] = (self._handlers["return"], 0, 0, 0)
+        self.map_device(CONSOLE_ADDRESS, 4, write=self._write_console)
+        self.map_device(EXIT_ADDRESS, 4, write=self._write_exit)
+
+    @classmethod
+    def from_assembler(cls, assembler, layout=None, address=0):
+        # Links the assembler's sections and loads every one of them at its address
+        compiled_sections = assembler.link(layout, address)
+        simulator = cls(assembler.get_labels())
+        for section in assembler.get_sections():
+            simulator.load(section.get_address(), compiled_sections[section.get_name()])
+        return simulator
+
+    def load(self, address, buffer):
+        # Copies the buffer into memory and predecodes the words in it
+        buffer = bytes(buffer)
+        self._write_bytes(address, buffer)
+        if address & 3 != 0:
+            return
+        words, entries, columns = _decode(buffer)
+        rs, rt, rd, shamts, immediates, jump_targets = columns[0], columns[1], columns[2], columns[3], columns[5], \
+            columns[6]
+        code = self._code
+        for index, entry in enumerate(entries):
+            pc = address + 4 * index
+            code[pc] = self._predecode(entry, rs[index], rt[index], rd[index], shamts[index],
+                                       jump_targets[index] if entry is not None and entry.mnemonic in ("j", "jal")
+                                       else immediates[index], pc)
+
+    def _predecode(self, entry, rs, rt, rd, shamt, immediate, pc):
+        if entry is None:
+            return self._handlers["reserved"], pc, 0, 0
+        return (self._handlers[entry.mnemonic],) + _OPERANDS[entry.mnemonic](rs, rt, rd, shamt, immediate, pc)
+
+    def _decode_at(self, address, cache=True):
+        # Decodes the word at address on its own, for code that wasn't loaded or was written over
+        if address & 3 != 0:
+            raise _Fault("address_error", "The instruction address {} is not aligned".format(address))
+        if type(self._pages.get(address >> _PAGE_BITS)) is not bytearray:
+            raise _Fault("bus_error", "Nothing was loaded at the instruction address {}".format(address))
+        word = self._read(address, 4)
+        key = _decode_key(word >> 26, (word >> 16) & 0x1F, word & 0x3F)
+        entry = _DECODE_TABLE[key] if word & _DECODE_MASKS[key] == _DECODE_MATCHES[key] else None
+        if entry is not None and entry.mnemonic in ("j", "jal"):
+            immediate = word & 0x3FFFFFF
+        else:
+            immediate = word & 0xFFFF
+        decoded = self._predecode(entry, (word >> 21) & 0x1F, (word >> 16) & 0x1F, (word >> 11) & 0x1F,
+                                  (word >> 6) & 0x1F, immediate, address)
+        if cache:
+            self._code[address] = decoded
+        return decoded
+
+    def map_device(self, address, size, read=None, write=None):
+        # Maps read(address, size) and write(address, size, value) over the range. The pages it touches can only
+        # hold devices from then on. Without read the device reads as zero and without write writes are ignored.
+        read = read if read is not None else (lambda device_address, device_size: 0)
+        write = write if write is not None else (lambda device_address, device_size, value: None)
+        for page_number in range(address >> _PAGE_BITS, ((address + size - 1) >> _PAGE_BITS) + 1):
+            page = self._pages.get(page_number)
+            if type(page) is not _MipsDevicePage:
+                page = self._pages[page_number] = _MipsDevicePage()
+            page.devices.append((address, address + size, read, write))
+
+    def _write_console(self, address, size, value):
+        self._console.append(value & 0xFF)
+
+    def _write_exit(self, address, size, value):
+        raise _Halt("exit", value)
+
+    def _read(self, address, size):
+        # The slow path of loads: pages that hold devices or haven't been written yet
+        page = self._pages.get(address >> _PAGE_BITS)
+        if page is None:
+            return 0
+        if type(page) is _MipsDevicePage:
+            return page.find(address, size)[0](address, size) & ((1 << (8 * size)) - 1)
+        return int.from_bytes(page[address & _OFFSET_MASK:(address & _OFFSET_MASK) + size], "big")
+
+    def _write(self, address, size, value):
+        page = self._pages.get(address >> _PAGE_BITS)
+        if type(page) is _MipsDevicePage:
+            page.find(address, size)[1](address, size, value)
+            return
+        if page is None:
+            page = self._pages[address >> _PAGE_BITS] = bytearray(_PAGE_SIZE)
+        offset = address & _OFFSET_MASK
+        page[offset:offset + size] = (value & ((1 << (8 * size)) - 1)).to_bytes(size, "big")
+        self._invalidate(address & ~3)
+
+    def _invalidate(self, address):
+        # Code written over is decoded again, in the blocks that start after the write
+        if self._code.pop(address, None) is not None:
+            self._blocks.clear()
+
+    def _write_bytes(self, address, buffer):
+        # Copied a page at a time, byte by byte only into device pages
+        index = 0
+        while index < len(buffer):
+            offset = address & _OFFSET_MASK
+            size = min(len(buffer) - index, _PAGE_SIZE - offset)
+            page = self._pages.get(address >> _PAGE_BITS)
+            if page is None:
+                page = self._pages[address >> _PAGE_BITS] = bytearray(_PAGE_SIZE)
+            if type(page) is _MipsDevicePage:
+                for device_index in range(size):
+                    self._write(address + device_index, 1, buffer[index + device_index])
+            else:
+                page[offset:offset + size] = buffer[index:index + size]
+                for word_address in range((address & ~3), address + size, 4):
+                    self._invalidate(word_address)
+            index += size
+            address = (address + size) & 0xFFFFFFFF
+
+    def read_memory(self, address, size):
+        return bytes(self._read((address + index) & 0xFFFFFFFF, 1) for index in range(size))
+
+    def write_memory(self, address, buffer):
+        self._write_bytes(address, bytes(buffer))
+
+    def _make_handlers(self):
+        r = self._registers
+        pages = self._pages
+        code = self._code
+        blocks = self._blocks
+        read = self._read
+        write = self._write
+        unpack_word = _WORD.unpack_from
+        pack_word = _WORD.pack_into
+
+        def fault(cause, message):
+            raise _Fault(cause, message)
+
+        def check_alignment(address, size):
+            if address & (size - 1):
+                fault("address_error", "The address {} is not aligned to {} bytes".format(address, size))
+
+        # ---------- Arithmetic and logic ----------
+
+        def add(d, s, t):
+            value = r[s] + r[t] - (((r[s] & 0x80000000) + (r[t] & 0x80000000)) << 1)
+            if not -0x80000000 <= value < 0x80000000:
+                fault("overflow", "add overflowed")
+            r[d] = value & 0xFFFFFFFF
+
+        def addu(d, s, t):
+            r[d] = (r[s] + r[t]) & 0xFFFFFFFF
+
+        def sub(d, s, t):
+            value = r[s] - r[t] - (((r[s] & 0x80000000) - (r[t] & 0x80000000)) << 1)
+            if not -0x80000000 <= value < 0x80000000:
+                fault("overflow", "sub overflowed")
+            r[d] = value & 0xFFFFFFFF
+
+        def subu(d, s, t):
+            r[d] = (r[s] - r[t]) & 0xFFFFFFFF
+
+        def and_(d, s, t):
+            r[d] = r[s] & r[t]
+
+        def or_(d, s, t):
+            r[d] = r[s] | r[t]
+
+        def xor(d, s, t):
+            r[d] = r[s] ^ r[t]
+
+        def nor(d, s, t):
+            r[d] = ~(r[s] | r[t]) & 0xFFFFFFFF
+
+        def slt(d, s, t):
+            r[d] = 1 if r[s] ^ 0x80000000 < r[t] ^ 0x80000000 else 0
+
+        def sltu(d, s, t):
+            r[d] = 1 if r[s] < r[t] else 0
+
+        def mul(d, s, t):
+            r[d] = ((r[s] - ((r[s] & 0x80000000) << 1)) * (r[t] - ((r[t] & 0x80000000) << 1))) & 0xFFFFFFFF
+
+        def clz(d, s, t):
+            r[d] = 32 - r[s].bit_length()
+
+        def clo(d, s, t):
+            r[d] = 32 - (r[s] ^ 0xFFFFFFFF).bit_length()
+
+        def sll(d, t, shamt):
+            r[d] = (r[t] << shamt) & 0xFFFFFFFF
+
+        def srl(d, t, shamt):
+            r[d] = r[t] >> shamt
+
+        def sra(d, t, shamt):
+            r[d] = ((r[t] - ((r[t] & 0x80000000) << 1)) >> shamt) & 0xFFFFFFFF
+
+        def sllv(d, s, t):
+            r[d] = (r[t] << (r[s] & 0x1F)) & 0xFFFFFFFF
+
+        def srlv(d, s, t):
+            r[d] = r[t] >> (r[s] & 0x1F)
+
+        def srav(d, s, t):
+            r[d] = ((r[t] - ((r[t] & 0x80000000) << 1)) >> (r[s] & 0x1F)) & 0xFFFFFFFF
+
+        def addi(t, s, immediate):
+            value = r[s] - ((r[s] & 0x80000000) << 1) + immediate
+            if not -0x80000000 <= value < 0x80000000:
+                fault("overflow", "addi overflowed")
+            r[t] = value & 0xFFFFFFFF
+
+        def addiu(t, s, immediate):
+            r[t] = (r[s] + immediate) & 0xFFFFFFFF
+
+        def slti(t, s, immediate):
+            r[t] = 1 if r[s] - ((r[s] & 0x80000000) << 1) < immediate else 0
+
+        def sltiu(t, s, immediate):
+            r[t] = 1 if r[s] < immediate & 0xFFFFFFFF else 0
+
+        def andi(t, s, immediate):
+            r[t] = r[s] & immediate
+
+        def ori(t, s, immediate):
+            r[t] = r[s] | immediate
+
+        def xori(t, s, immediate):
+            r[t] = r[s] ^ immediate
+
+        def lui(t, value, unused):
+            r[t] = value
+
+        # ---------- HI and LO ----------
+
+        def mult(s, t, unused):
+            product = (r[s] - ((r[s] & 0x80000000) << 1)) * (r[t] - ((r[t] & 0x80000000) << 1))
+            r[_HI] = (product >> 32) & 0xFFFFFFFF
+            r[_LO] = product & 0xFFFFFFFF
+
+        def multu(s, t, unused):
+            product = r[s] * r[t]
+            r[_HI] = product >> 32
+            r[_LO] = product & 0xFFFFFFFF
+
+        def div(s, t, unused):
+            # Dividing by zero leaves HI and LO unchanged, the architecture leaves them unpredictable
+            if r[t] != 0:
+                quotient, remainder = _signed_divide(r[s] - ((r[s] & 0x80000000) << 1),
+                                                     r[t] - ((r[t] & 0x80000000) << 1))
+                r[_HI] = remainder & 0xFFFFFFFF
+                r[_LO] = quotient & 0xFFFFFFFF
+
+        def divu(s, t, unused):
+            if r[t] != 0:
+                r[_HI] = r[s] % r[t]
+                r[_LO] = r[s] // r[t]
+
+        def accumulate(product):
+            value = ((r[_HI] << 32) | r[_LO]) + product
+            r[_HI] = (value >> 32) & 0xFFFFFFFF
+            r[_LO] = value & 0xFFFFFFFF
+
+        def madd(s, t, unused):
+            accumulate((r[s] - ((r[s] & 0x80000000) << 1)) * (r[t] - ((r[t] & 0x80000000) << 1)))
+
+        def maddu(s, t, unused):
+            accumulate(r[s] * r[t])
+
+        def msub(s, t, unused):
+            accumulate(-(r[s] - ((r[s] & 0x80000000) << 1)) * (r[t] - ((r[t] & 0x80000000) << 1)))
+
+        def msubu(s, t, unused):
+            accumulate(-r[s] * r[t])
+
+        # ---------- Traps ----------
+
+        def trap_if(condition, mnemonic):
+            if condition:
+                fault("trap", "{} trapped".format(mnemonic))
+
+        def tge(s, t, unused):
+            trap_if(r[s] ^ 0x80000000 >= r[t] ^ 0x80000000, "tge")
+
+        def tgeu(s, t, unused):
+            trap_if(r[s] >= r[t], "tgeu")
+
+        def tlt(s, t, unused):
+            trap_if(r[s] ^ 0x80000000 < r[t] ^ 0x80000000, "tlt")
+
+        def tltu(s, t, unused):
+            trap_if(r[s] < r[t], "tltu")
+
+        def teq(s, t, unused):
+            trap_if(r[s] == r[t], "teq")
+
+        def tne(s, t, unused):
+            trap_if(r[s] != r[t], "tne")
+
+        def tgei(s, immediate, unused):
+            trap_if(r[s] - ((r[s] & 0x80000000) << 1) >= immediate, "tgei")
+
+        def tgeiu(s, immediate, unused):
+            trap_if(r[s] >= immediate, "tgeiu")
+
+        def tlti(s, immediate, unused):
+            trap_if(r[s] - ((r[s] & 0x80000000) << 1) < immediate, "tlti")
+
+        def tltiu(s, immediate, unused):
+            trap_if(r[s] < immediate, "tltiu")
+
+        def teqi(s, immediate, unused):
+            trap_if(r[s] - ((r[s] & 0x80000000) << 1) == immediate, "teqi")
+
+        def tnei(s, immediate, unused):
+            trap_if(r[s] - ((r[s] & 0x80000000) << 1) != immediate, "tnei")
+
+        # ---------- Branches and jumps ----------
+
+        def beq(s, t, target):
+            if r[s] == r[t]:
+                return target
+
+        def bne(s, t, target):
+            if r[s] != r[t]:
+                return target
+
+        def blez(s, target, link):
+            if r[s] == 0 or r[s] & 0x80000000:
+                return target
+
+        def bgtz(s, target, link):
+            if r[s] != 0 and not r[s] & 0x80000000:
+                return target
+
+        def bltz(s, target, link):
+            if r[s] & 0x80000000:
+                return target
+
+        def bgez(s, target, link):
+            if not r[s] & 0x80000000:
+                return target
+
+        def bltzal(s, target, link):
+            # The condition is read before $ra is written, in case s is $ra
+            taken = r[s] & 0x80000000
+            r[31] = link
+            if taken:
+                return target
+
+        def bgezal(s, target, link):
+            taken = not r[s] & 0x80000000
+            r[31] = link
+            if taken:
+                return target
+
+        def j(target, link, unused):
+            return target
+
+        def jal(target, link, unused):
+            r[31] = link
+            return target
+
+        def jr(s, unused, unused_too):
+            return r[s]
+
+        def jalr(s, d, link):
+            target = r[s]
+            r[d] = link
+            return target
+
+        # ---------- Loads and stores ----------
+
+        def lw(t, s, offset):
+            address = (r[s] + offset) & 0xFFFFFFFF
+            if address & 3:
+                check_alignment(address, 4)
+            try:
+                r[t] = unpack_word(pages[address >> _PAGE_BITS], address & _OFFSET_MASK)[0]
+            except (KeyError, TypeError):
+                # Pages that were never written and device pages
+                r[t] = read(address, 4)
+
+        def lh(t, s, offset):
+            address = (r[s] + offset) & 0xFFFFFFFF
+            check_alignment(address, 2)
+            value = read(address, 2)
+            r[t] = (value - ((value & 0x8000) << 1)) & 0xFFFFFFFF
+
+        def lhu(t, s, offset):
+            address = (r[s] + offset) & 0xFFFFFFFF
+            check_alignment(address, 2)
+            r[t] = read(address, 2)
+
+        def lb(t, s, offset):
+            value = read((r[s] + offset) & 0xFFFFFFFF, 1)
+            r[t] = (value - ((value & 0x80) << 1)) & 0xFFFFFFFF
+
+        def lbu(t, s, offset):
+            r[t] = read((r[s] + offset) & 0xFFFFFFFF, 1)
+
+        def lwl(t, s, offset):
+            # Big endian: the bytes from the address to the end of its word go to the top of the register
+            address = (r[s] + offset) & 0xFFFFFFFF
+            shift = 8 * (address & 3)
+            r[t] = ((read(address & ~3, 4) << shift) | (r[t] & ((1 << shift) - 1))) & 0xFFFFFFFF
+
+        def lwr(t, s, offset):
+            # The bytes from the start of the word to the address go to the bottom of the register
+            address = (r[s] + offset) & 0xFFFFFFFF
+            shift = 8 * (3 - (address & 3))
+            r[t] = (read(address & ~3, 4) >> shift) | (r[t] & ~(0xFFFFFFFF >> shift) & 0xFFFFFFFF)
+
+        def sw(t, s, offset):
+            address = (r[s] + offset) & 0xFFFFFFFF
+            if address & 3:
+                check_alignment(address, 4)
+            try:
+                pack_word(pages[address >> _PAGE_BITS], address & _OFFSET_MASK, r[t])
+            except (KeyError, TypeError):
+                write(address, 4, r[t])
+                return
+            if address in code:
+                del code[address]
+                blocks.clear()
+
+        def sh(t, s, offset):
+            address = (r[s] + offset) & 0xFFFFFFFF
+            check_alignment(address, 2)
+            write(address, 2, r[t])
+
+        def sb(t, s, offset):
+            write((r[s] + offset) & 0xFFFFFFFF, 1, r[t])
+
+        def swl(t, s, offset):
+            address = (r[s] + offset) & 0xFFFFFFFF
+            for index in range(4 - (address & 3)):
+                write(address + index, 1, r[t] >> (24 - 8 * index))
+
+        def swr(t, s, offset):
+            address = (r[s] + offset) & 0xFFFFFFFF
+            for index in range((address & 3) + 1):
+                write((address & ~3) + index, 1, r[t] >> (8 * ((address & 3) - index)))
+
+        # ---------- Outside the instruction set ----------
+
+        def reserved(pc, unused, unused_too):
+            fault("reserved_instruction", "The word at {} is not an instruction".format(pc))
+
+        def return_(unused, unused_too, unused_three):
+            raise _Halt("return", r[2])
+
+        defined = locals()
+        handlers = {mnemonic: defined[mnemonic + "_" if mnemonic in ("and", "or") else mnemonic]
+                    for mnemonic in _OPERANDS}
+        handlers["reserved"] = reserved
+        handlers["return"] = return_
+        return handlers
+
+    def _build_block(self, pc):
+        # The predecoded words from pc up to and including the first branch or jump and its delay slot, as
+        # (body, branch, delay slot, address after the block, length) with the address added to every entry. The
+        # block ends early before a word that can't be fetched, so the fault comes up when it is reached. A length of
+        # zero means the instruction at pc has to be stepped on its own.
+        code = self._code
+        body = []
+        address = pc
+        while len(body) < _MAX_BLOCK_LENGTH:
+            entry = code.get(address)
+            if entry is None:
+                if len(body) == 0:
+                    entry = self._decode_at(address)
+                else:
+                    try:
+                        entry = self._decode_at(address)
+                    except _Fault:
+                        break
+            handler = entry[0]
+            if handler in self._branch_handlers:
+                try:
+                    slot = code.get(address + 4) or self._decode_at(address + 4)
+                except _Fault:
+                    break
+                block = (tuple(body), entry + (address,), slot + (address + 4,), address + 8, len(body) + 2)
+                self._blocks[pc] = block
+                return block
+            body.append(entry + (address,))
+            address += 4
+            if handler is self._handlers["return"]:
+                break
+
+        block = (tuple(body), None, None, address, len(body))
+        self._blocks[pc] = block
+        return block
+
+    def run(self, entry=None, max_instructions=None, predecoded=True):
+        # Runs from entry, a label or an address, or from where the last run stopped. The run ends when the entry
+        # point returns, when the program writes the exit address or after max_instructions. With
+        # predecoded=False every word is decoded again each time it runs, which is only useful to measure what
+        # predecoding saves.
+        if entry is not None:
+            if isinstance(entry, str):
+                if entry not in self._labels:
+                    raise MipsCompileError("The entry point label '{}' is undefined".format(entry))
+                entry = self._labels[entry]
+            self._pc = entry
+            self._next_pc = entry + 4
+            self._registers[31] = RETURN_ADDRESS
+
+        code = self._code if predecoded else _NaiveCode(self)
+        blocks = self._blocks if predecoded else None
+        build_block = self._build_block
+        decode_at = self._decode_at
+        limit = max_instructions if max_instructions is not None else sys.maxsize
+        reason = "budget"
+        exit_code = None
+        executed = 0
+        pc = self._pc
+        next_pc = self._next_pc
+        block_start = None
+        branch = None
+        start = time.perf_counter()
+        try:
+            while executed < limit:
+                # Whole blocks run with the loop over their body, then the branch and its delay slot
+                if blocks is not None and next_pc == pc + 4:
+                    block_start = pc
+                    try:
+                        body, branch, slot, end, length = blocks[pc]
+                    except KeyError:
+                        body, branch, slot, end, length = build_block(pc)
+                    if length > 0 and executed + length <= limit:
+                        for handler, a, b, c, pc in body:
+                            handler(a, b, c)
+                        if branch is None:
+                            pc = end
+                        else:
+                            handler, a, b, c, pc = branch
+                            target = handler(a, b, c)
+                            next_pc = end if target is None else target
+                            handler, a, b, c, pc = slot
+                            handler(a, b, c)
+                            pc = next_pc
+                        next_pc = pc + 4
+                        executed += length
+                        continue
+
+                # One instruction at a time: without predecoding, in the delay slot of a branch that another run
+                # stopped at and for the last instructions before the budget runs out
+                block_start = None
+                try:
+                    handler, a, b, c = code[pc]
+                except KeyError:
+                    handler, a, b, c = decode_at(pc)
+                target = handler(a, b, c)
+                pc = next_pc
+                next_pc = pc + 4 if target is None else target
+                executed += 1
+        except (_Halt, _Fault) as stop:
+            if block_start is not None:
+                executed += (pc - block_start) >> 2
+                if branch is None or pc != slot[4]:
+                    next_pc = pc + 4
+            if type(stop) is _Fault:
+                raise MipsTrap(stop.cause, pc, str(stop))
+            reason = stop.reason
+            exit_code = stop.exit_code
+        finally:
+            seconds = time.perf_counter() - start
+            self._pc = pc
+            self._next_pc = next_pc
+            self._instructions += executed
+            self._seconds += seconds
+
+        return MipsRunResult(reason, exit_code, executed, seconds, executed / seconds if seconds > 0 else None)
+
+    def get_pc(self):
+        return self._pc
+
+    def get_register(self, register):
+        # By name, such as "$t0", or by number
+        if isinstance(register, str):
+            register = _get_register_id(register)
+        return self._registers[register]
+
+    def set_register(self, register, value):
+        if isinstance(register, str):
+            register = _get_register_id(register)
+        if register != 0:
+            self._registers[register] = value & 0xFFFFFFFF
+
+    def get_hi(self):
+        return self._registers[_HI]
+
+    def get_lo(self):
+        return self._registers[_LO]
+
+    def get_console_output(self):
+        return bytes(self._console)
+
+    def get_instruction_count(self):
+        # Every instruction executed over all runs
+        return self._instructions
+
+    def get_instructions_per_second(self):
+        # Over all runs
+        return self._instructions / self._seconds if self._seconds > 0 else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python mips_simulator.py", description="Assemble a file and run it")
+    parser.add_argument("source", help="assembly source file")
+    parser.add_argument("--entry", help="entry point label or address (default: the first section's address)")
+    parser.add_argument("--layout", nargs="+", help="section names in the order they are placed")
+    parser.add_argument("--address", type=lambda value: int(value, 0), default=0,
+                        help="address of the first section (default: 0)")
+    parser.add_argument("--max-instructions", type=int, help="stop after this many instructions")
+    parser.add_argument("--naive", action="store_true", help="decode every instruction each time it runs")
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.source) as file:
+            assembler = MipsAssembler()
+            assembler.add_stream(file)
+        simulator = MipsSimulator.from_assembler(assembler, args.layout, args.address)
+        entry = args.entry if args.entry is not None else args.address
+        if isinstance(entry, str) and entry[:1].isdigit():
+            entry = int(entry, 0)
+        result = simulator.run(entry, args.max_instructions, not args.naive)
+    except (MipsParsingError, MipsCompileError, MipsTrap) as error:
+        print(error, file=sys.stderr)
+        return 1
+
+    sys.stdout.buffer.write(simulator.get_console_output())
+    print("{}: {} instructions in {:.3f}s, {:.0f} instructions/s".format(
+        result.reason, result.instructions, result.seconds, result.instructions_per_second or 0), file=sys.stderr)
+    return result.exit_code if result.reason == "exit" else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
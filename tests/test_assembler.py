@@ -0,0 +1,117 @@
+import io
+import shutil
+import struct
+import tempfile
+import unittest
+
+import mips_assembler
+import mips_simulator
+
+
+class SectionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        mips_assembler.enable_section_cache(self._directory)
+
+    def tearDown(self):
+        mips_assembler.disable_section_cache()
+        shutil.rmtree(self._directory)
+
+    def _link(self, lines, cached, **options):
+        if not cached:
+            mips_assembler.disable_section_cache()
+        assembler = mips_assembler.MipsAssembler(**options)
+        assembler.add_stream(iter(lines))
+        if not cached:
+            mips_assembler.enable_section_cache(self._directory)
+        return {name: bytes(compiled) for name, compiled in assembler.link().items()}, assembler
+
+    def test_section_switches_match_the_uncached_build(self):
+        # Nothing is moved across a section switch, so the addu stays out of the delay slot of the b
+        lines = ["start: addu $t0, $t1, $t2", ".section .data", ".word start", ".section .text", "b start",
+                 ".set noreorder", "j start", "nop"]
+        expected, assembler = self._link(lines, False)
+        for run in range(2):
+            self.assertEqual(self._link(lines, True)[0], expected)
+        self.assertEqual(expected[".text"][:4], bytes.fromhex("012a4021"))
+
+    def test_workers_and_stats_are_used_with_the_cache(self):
+        lines = ["addi $t{}, $t0, {}".format(index % 8, index) for index in range(3 * 8192)]
+        lines += [".section .data", ".word 1"]
+        expected = self._link(lines, False)[0]
+        self.assertEqual(self._link(lines, True, workers=2)[0], expected)
+        for run in range(2):
+            compiled, assembler = self._link(lines, True, stats=True)
+            self.assertEqual(compiled, expected)
+            self.assertEqual(assembler.get_stats()["lines"], len(lines))
+
+
+class ElfOutputTest(unittest.TestCase):
+
+    @staticmethod
+    def _read_elf(data):
+        # Returns {section name: (address, contents)} and {symbol name: value} of a 32 bit big endian ELF file
+        section_headers = struct.unpack_from(">I", data, 32)[0]
+        section_count, names_index = struct.unpack_from(">HH", data, 48)
+        headers = [struct.unpack_from(">IIIIIIIIII", data, section_headers + 40 * index)
+                   for index in range(section_count)]
+
+        def name(table, offset):
+            start = headers[table][4] + offset
+            return data[start:data.index(b"\0", start)].decode("utf-8")
+
+        sections = {}
+        symbols = {}
+        for header in headers[1:]:
+            section_name = name(names_index, header[0])
+            if header[1] == 2:
+                for offset in range(header[4] + 16, header[4] + header[5], 16):
+                    symbol_name, value = struct.unpack_from(">II", data, offset)
+                    symbols[name(header[6], symbol_name)] = value
+            elif section_name.startswith(".") and header[1] == 1:
+                sections[section_name] = (header[3], data[header[4]:header[4] + header[5]])
+        return sections, symbols
+
+    def test_cross_section_load(self):
+        assembler = mips_assembler.MipsAssembler()
+        assembler.add("start: li $t0, data\nj start\n.section .data\ndata: .word 1\n")
+        output = io.BytesIO()
+        assembler.write(output, "elf", entry="start")
+
+        sections, symbols = self._read_elf(output.getvalue())
+        self.assertEqual(symbols, {"start": 0, "data": 12})
+        self.assertEqual({name: contents for name, (address, contents) in sections.items()},
+                         {name: bytes(compiled) for name, compiled in assembler.link().items()})
+
+
+class CompareBranchTest(unittest.TestCase):
+    # Runs every unsigned compare and branch against constants around the edges of what sltiu can hold
+
+    CONSTANTS = [-1, -2, 0, 1, 0x7FFE, 0x7FFF, 0x8000, 0xFFFE, 0xFFFF, 0x10000, 0xFFFF7FFF, 0xFFFF8000, 0xFFFFFFFE,
+                 0xFFFFFFFF]
+    VALUES = [0, 1, 0x7FFF, 0x8000, 0xFFFF, 0x10000, 0xFFFF7FFF, 0xFFFF8000, 0xFFFFFFFE, 0xFFFFFFFF]
+    CONDITIONS = {
+        "bltu": lambda value, constant: value < constant,
+        "bgeu": lambda value, constant: value >= constant,
+        "bgtu": lambda value, constant: value > constant,
+        "bleu": lambda value, constant: value <= constant,
+    }
+
+    def test_unsigned_constants(self):
+        for mnemonic, condition in self.CONDITIONS.items():
+            for constant in self.CONSTANTS:
+                assembler = mips_assembler.MipsAssembler()
+                assembler.add("{} $t0, {}, taken\nli $v0, 0\njr $ra\ntaken: li $v0, 1\njr $ra\n"
+                              .format(mnemonic, constant))
+                for value in self.VALUES:
+                    with self.subTest(mnemonic=mnemonic, constant=constant, value=value):
+                        simulator = mips_simulator.MipsSimulator.from_assembler(assembler)
+                        simulator.set_register("$t0", value)
+                        simulator.run(0)
+                        self.assertEqual(simulator.get_register("$v0"),
+                                         int(condition(value, constant & 0xFFFFFFFF)))
+
+
+if __name__ == "__main__":
+    unittest.main()
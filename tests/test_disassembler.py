@@ -0,0 +1,38 @@
+import unittest
+import unittest.mock
+
+import mips_assembler
+import mips_disassembler
+from benchmarks.generators import GENERATORS
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def test_branches_keep_their_delay_slots(self):
+        # In .set reorder mode a reassembly would add a delay slot after every branch and jump
+        assembler = mips_assembler.MipsAssembler()
+        assembler.add(".set noreorder\nstart: beq $t0, $t1, start\naddi $t0, $t0, 1\njal start\nsw $t0, 4($sp)\n"
+                      "jr $ra\naddu $v0, $t0, $t1\n")
+        self.assertEqual(mips_disassembler.round_trip(assembler.link()[".text"]), [])
+
+    def test_generated_programs(self):
+        for name, generator in sorted(GENERATORS.items()):
+            with self.subTest(generator=name):
+                assembler = mips_assembler.MipsAssembler()
+                assembler.add("\n".join(generator(500)))
+                for compiled_section in assembler.link().values():
+                    self.assertEqual(mips_disassembler.round_trip(compiled_section), [])
+
+    def test_missing_and_extra_words_are_reported(self):
+        original = bytes.fromhex("012a4021" "08000000" "00000000")
+        disassemble = mips_disassembler.disassemble
+        with unittest.mock.patch.object(mips_disassembler, "disassemble",
+                                        lambda buffer, labels=None: disassemble(buffer, labels)[:-1]):
+            self.assertEqual(mips_disassembler.round_trip(original), [(8, 0, None)])
+        with unittest.mock.patch.object(mips_disassembler, "disassemble",
+                                        lambda buffer, labels=None: disassemble(buffer, labels) + ["nop"]):
+            self.assertEqual(mips_disassembler.round_trip(original), [(12, None, 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
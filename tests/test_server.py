@@ -0,0 +1,60 @@
+import asyncio
+import concurrent.futures
+import json
+import socket
+import threading
+import unittest
+
+import mips_server
+
+
+class ServerTest(unittest.TestCase):
+    # Serves connections from an event loop in a background thread, jobs run in a thread pool instead of processes
+
+    def setUp(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.start()
+
+        def handle(reader, writer):
+            return mips_server._handle_connection(reader, writer, self._executor)
+
+        self._server = asyncio.run_coroutine_threadsafe(asyncio.start_server(handle, "127.0.0.1", 0),
+                                                        self._loop).result()
+        self._port = self._server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self._server.close()
+        asyncio.run_coroutine_threadsafe(self._server.wait_closed(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown()
+
+    def _send_header(self, header):
+        # Sends a raw header frame and returns the response header, the connection has to be closed after it
+        with socket.create_connection(("127.0.0.1", self._port)) as connection:
+            connection.sendall(mips_server._FRAME_LENGTH.pack(len(header)) + header)
+            with connection.makefile("rb") as file:
+                response = json.loads(mips_server._receive_frame(file))
+                self.assertEqual(file.read(), b"")
+        return response
+
+    def test_job(self):
+        with mips_server.MipsClient(port=self._port) as client:
+            header, frames = client.assemble("start: j start\n")
+        self.assertTrue(header["ok"])
+        self.assertEqual(frames, [bytes.fromhex("0800000000000000")])
+
+    def test_malformed_headers_get_an_error_response(self):
+        for header in [b"{not json", b"\xff\xfe", b"[]", b"1", b'{"frames": "1"}', b'{"frames": 1, "options": []}']:
+            with self.subTest(header=header):
+                response = self._send_header(header)
+                self.assertFalse(response["ok"])
+                self.assertEqual(response["frames"], 0)
+                self.assertIn("request header", response["errors"][0]["message"])
+
+
+if __name__ == "__main__":
+    unittest.main()